@@ -7,12 +7,14 @@ from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db.models import Count, Q
 from django.db.utils import IntegrityError
+from django.urls import reverse
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from easy_thumbnails.files import get_thumbnailer
 from rest_framework import fields, serializers
 
 from api.fields import DisplayChoiceField
+from core.ingest import pyramid_base, pyramid_ready
 from core.models import (
     AnnotationComponent,
     AnnotationTaxonomy,
@@ -41,9 +43,9 @@ from core.models import (
     TextualWitness,
     Transcription,
 )
-from core.tasks import segment, segtrain, train, transcribe
+from core.tasks import segtrain, train
 from imports.forms import FileImportError, clean_import_uri, clean_upload_file
-from imports.models import DocumentImport
+from imports.models import DocumentImport, Upload
 from imports.tasks import document_import
 from reporting.models import TaskReport
 from users.consumers import send_event
@@ -464,6 +466,8 @@ class ImportSerializer(serializers.Serializer):
     name = serializers.CharField(required=False)
     override = serializers.BooleanField(required=False)
     upload_file = serializers.FileField(required=False)
+    # a finished chunked upload, instead of upload_file
+    upload = serializers.PrimaryKeyRelatedField(queryset=Upload.objects.all(), required=False)
 
     iiif_uri = serializers.URLField(required=False)
 
@@ -480,6 +484,7 @@ class ImportSerializer(serializers.Serializer):
         self.document = Document.objects.get(pk=self.context["view"].kwargs["document_pk"])
         self.mets_base_uri = None
         self.fields['transcription'].queryset = Transcription.objects.filter(document=self.document)
+        self.fields['upload'].queryset = Upload.objects.filter(document=self.document, owner=self.user)
 
     def validate_iiif_uri(self, uri):
         try:
@@ -507,8 +512,21 @@ class ImportSerializer(serializers.Serializer):
         except FileImportError as e:
             raise serializers.ValidationError(repr(e))
 
+    def validate_upload(self, upload):
+        if not upload.complete:
+            raise serializers.ValidationError(_("The upload is not complete."))
+        staged = upload.as_file()
+        try:
+            self.validate_upload_file(staged)
+        except serializers.ValidationError:
+            staged.close()
+            raise
+        return upload
+
     def validate(self, data):
         data = super().validate(data)
+        if 'upload' in data:
+            data['upload_file'] = self.file
 
         # validate different modes
         mode = data.get('mode')
@@ -558,6 +576,11 @@ class ImportSerializer(serializers.Serializer):
             mets_base_uri=self.mets_base_uri
         )
         imp.save()
+        if 'upload' in validated_data:
+            # the staging file was moved in place, the file is reopened from the storage
+            self.file.close()
+            del imp.import_file.file
+            validated_data['upload'].delete()
 
         document_import.delay(
             import_pk=imp.pk,
@@ -568,6 +591,38 @@ class ImportSerializer(serializers.Serializer):
         return imp
 
 
+class UploadSerializer(serializers.ModelSerializer):
+    complete = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = Upload
+        fields = ('id', 'filename', 'size', 'offset', 'complete', 'created_at', 'updated_at')
+        read_only_fields = ('offset',)
+
+    def validate_filename(self, filename):
+        # it ends up in the name of the stored file
+        return os.path.basename(filename)
+
+    def validate_size(self, size):
+        if size <= 0:
+            raise serializers.ValidationError(_("Nothing to upload."))
+        max_size = getattr(settings, 'UPLOAD_MAX_SIZE', 0)
+        if max_size and size > max_size:
+            raise serializers.ValidationError(_("The file is too big."))
+        return size
+
+    def validate(self, data):
+        # If quotas are enforced, assert that the user still has free disk storage
+        if not settings.DISABLE_QUOTAS and not self.context['request'].user.has_free_disk_storage():
+            raise serializers.ValidationError(_("You don't have any disk storage left."))
+        return data
+
+    def create(self, data):
+        data['document'] = self.context['document']
+        data['owner'] = self.context['request'].user
+        return super().create(data)
+
+
 class DocumentTasksSerializer(serializers.ModelSerializer):
     owner = serializers.SerializerMethodField()
     tasks_stats = serializers.SerializerMethodField()
@@ -678,11 +733,14 @@ class DocumentPartMetadataSerializer(serializers.ModelSerializer):
 
 class PartSerializer(serializers.ModelSerializer):
     image = ImageField(required=False, thumbnails=['card', 'large'])
+    # a finished chunked upload, instead of image
+    upload = serializers.PrimaryKeyRelatedField(queryset=Upload.objects.all(), required=False, write_only=True)
     image_file_size = serializers.IntegerField(required=False)
     filename = serializers.CharField(read_only=True)
     bw_image = ImageField(thumbnails=['large'], required=False)
     workflow = serializers.JSONField(read_only=True)
     transcription_progress = serializers.IntegerField(read_only=True)
+    tiles = serializers.SerializerMethodField()
 
     class Meta:
         model = DocumentPart
@@ -693,6 +751,8 @@ class PartSerializer(serializers.ModelSerializer):
             'title',
             'typology',
             'image',
+            'tiles',
+            'upload',
             'image_file_size',
             'original_filename',
             'bw_image',
@@ -712,9 +772,35 @@ class PartSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError(_("You don't have any disk storage left."))
         return data
 
+    def get_tiles(self, part):
+        """
+        The url of the Deep Zoom description of the image for tiled viewers,
+        None if it has no up to date pyramid, the image has to be loaded in full.
+        """
+        if not (getattr(settings, 'IMAGE_PYRAMIDS', False) and part.image
+                and pyramid_ready(pyramid_base(part.image.name), part.image.path)):
+            return None
+        uri = reverse('api:part-tiles', kwargs={'document_pk': part.document_id, 'pk': part.pk})
+        request = self.context.get('request')
+        return request.build_absolute_uri(uri) if request else uri
+
+    def validate_upload(self, upload):
+        if (upload.document_id != int(self.context["view"].kwargs["document_pk"])
+                or upload.owner != self.context['request'].user):
+            raise serializers.ValidationError(_("Invalid upload."))
+        if not upload.complete:
+            raise serializers.ValidationError(_("The upload is not complete."))
+        # the same checks as an image sent with the request
+        with upload.as_file() as staged:
+            self.fields['image'].run_validation(staged)
+        return upload
+
     def create(self, data):
         document = Document.objects.get(pk=self.context["view"].kwargs["document_pk"])
         data['document'] = document
+        upload = data.pop('upload', None)
+        if upload:
+            data['image'] = upload.as_file()
         data['original_filename'] = data['image'].name
         data['image_file_size'] = data['image'].size
 
@@ -729,10 +815,14 @@ class PartSerializer(serializers.ModelSerializer):
             # Can't use DoesNotExist because of legacy documents with duplicate image names
             part = super().create(data)
 
-        # generate card thumbnail right away since we need it
-        get_thumbnailer(part.image).get_thumbnail(settings.THUMBNAIL_ALIASES['']['card'],
-                                                  generate=True)
+        if upload:
+            # the staging file was moved in place, the image is reopened from the storage
+            data['image'].close()
+            del part.image.file
+            upload.delete()
 
+        # the thumbnails are generated by the convert task and pushed to the client,
+        # the request only stores the file
         send_event("document", part.document.pk, "part:new", {"id": part.pk})
         part.task(
             "convert",
@@ -980,15 +1070,13 @@ class SegmentSerializer(ProcessSerializerMixin, serializers.Serializer):
                 ocr_model_document.executed_on = timezone.now()
                 ocr_model_document.save()
 
-        for part in parts:
-            part.chain_tasks(
-                segment.si(instance_pk=part.pk,
-                           user_pk=self.user.pk,
-                           model_pk=model.pk if model else None,  # None means default model
-                           steps=self.validated_data.get('steps'),
-                           text_direction=self.validated_data.get('text_direction'),
-                           override=self.validated_data.get('override'))
-            )
+        self.document.queue_pipeline(
+            parts, 'segment',
+            user_pk=self.user.pk,
+            model_pk=model.pk if model else None,  # None means default model
+            steps=self.validated_data.get('steps'),
+            text_direction=self.validated_data.get('text_direction'),
+            override=self.validated_data.get('override'))
 
 
 class SegTrainSerializer(ProcessSerializerMixin, serializers.Serializer):
@@ -1177,14 +1265,11 @@ class TranscribeSerializer(ProcessSerializerMixin, serializers.Serializer):
             ocr_model_document.executed_on = timezone.now()
             ocr_model_document.save()
 
-        for part in parts:
-            part.chain_tasks(
-                transcribe.si(
-                    transcription_pk=transcription.pk,
-                    instance_pk=part.pk,
-                    model_pk=model.pk,
-                    user_pk=self.user.pk)
-            )
+        self.document.queue_pipeline(
+            parts, 'transcribe',
+            transcription_pk=transcription.pk,
+            model_pk=model.pk,
+            user_pk=self.user.pk)
 
 
 class EditableMultipleChoiceField(serializers.MultipleChoiceField):
@@ -4,12 +4,15 @@ but only our own layer on top of it.
 So no need to test the content unless there is some magic in the serializer.
 """
 
+import os
 import unittest
+from io import BytesIO
 from unittest.mock import patch
 
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import override_settings
 from django.urls import reverse
+from PIL import Image
 
 from core.models import (
     Block,
@@ -23,6 +26,7 @@ from core.models import (
     Transcription,
 )
 from core.tests.factory import CoreFactoryTestCase
+from imports.models import Upload
 
 
 class UserViewSetTestCase(CoreFactoryTestCase):
@@ -722,18 +726,49 @@ class PartViewSetTestCase(CoreFactoryTestCase):
         resp = self.client.get(uri)
         self.assertEqual(resp.status_code, 403)
 
-    @override_settings(THUMBNAIL_ENABLE=False)
+    @override_settings(THUMBNAIL_ENABLE=False, COMPRESS_ENABLE=False, IMAGE_DEDUPLICATION=False)
     def test_create(self):
         self.client.force_login(self.user)
         uri = reverse('api:part-list',
                       kwargs={'document_pk': self.part.document.pk})
-        with self.assertNumQueries(18):
+        with self.assertNumQueries(8):
             img = self.factory.make_image_file()
             resp = self.client.post(uri, {
                 'image': SimpleUploadedFile(
                     'test.png', img.read())})
         self.assertEqual(resp.status_code, 201)
 
+    @override_settings(THUMBNAIL_ENABLE=False, COMPRESS_ENABLE=False, IMAGE_DEDUPLICATION=False)
+    def test_create_from_upload(self):
+        self.client.force_login(self.user)
+        uri = reverse('api:part-list',
+                      kwargs={'document_pk': self.part.document.pk})
+
+        def upload(filename, content):
+            upload = Upload.objects.create(document=self.part.document, owner=self.user,
+                                           filename=filename, size=len(content))
+            upload.write_chunk(BytesIO(content), 0, len(content))
+            return upload
+
+        # validated like an image sent with the request
+        resp = self.client.post(uri, {'upload': upload('test.png', b'not an image').pk})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('image', resp.data['upload'][0])
+        resp = self.client.post(uri, {'upload': upload('test.pdf', b'%PDF-1.4').pk})
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('PDF', resp.data['upload'][0])
+
+        content = self.factory.make_image_file().read()
+        staged = upload('test.png', content)
+        resp = self.client.post(uri, {'upload': staged.pk})
+        self.assertEqual(resp.status_code, 201, resp.content)
+        self.assertFalse(Upload.objects.filter(pk=staged.pk).exists())
+        self.assertFalse(os.path.exists(staged.staging_path))
+        part = self.part.document.parts.get(pk=resp.data['pk'])
+        self.assertEqual(part.original_filename, 'test.png')
+        with part.image.open('rb') as fh:
+            self.assertEqual(fh.read(), content)
+
     @override_settings(THUMBNAIL_ENABLE=False)
     def test_update(self):
         self.client.force_login(self.user)
@@ -758,6 +793,73 @@ class PartViewSetTestCase(CoreFactoryTestCase):
         self.part2.refresh_from_db()
         self.assertEqual(self.part2.order, 0)
 
+    @override_settings(THUMBNAIL_ENABLE=False, IMAGE_PYRAMIDS=True, IMAGE_PYRAMID_TILE_SIZE=256)
+    def test_tiles(self):
+        uri = reverse('api:part-tiles',
+                      kwargs={'document_pk': self.part.document.pk,
+                              'pk': self.part.pk})
+        self.client.force_login(self.user)
+        resp = self.client.get(uri)
+        self.assertEqual(resp.status_code, 404)
+
+        part_uri = reverse('api:part-detail',
+                           kwargs={'document_pk': self.part.document.pk,
+                                   'pk': self.part.pk})
+        self.assertIsNone(self.client.get(part_uri).json()['tiles'])
+
+        self.part.ingest()
+        # advertised to the clients along with the image
+        self.assertEqual(self.client.get(part_uri).json()['tiles'], 'http://testserver' + uri)
+        resp = self.client.get(uri)
+        self.assertEqual(resp.status_code, 200)
+        pyramid = resp.json()['Image']
+        self.assertEqual(pyramid['TileSize'], '256')
+        self.assertEqual(pyramid['Size'], {'Width': str(self.part.image.width),
+                                           'Height': str(self.part.image.height)})
+
+        tile_uri = reverse('api:part-tile',
+                           kwargs={'document_pk': self.part.document.pk,
+                                   'pk': self.part.pk,
+                                   'level': 0, 'column': 0, 'row': 0})
+        self.assertEqual(tile_uri, resp.json()['Image']['Url'].split('testserver')[1] + '0/0_0.jpg')
+        resp = self.client.get(tile_uri)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'image/jpeg')
+        resp = self.client.get(tile_uri.replace('0_0.jpg', '1000_0.jpg'))
+        self.assertEqual(resp.status_code, 404)
+
+        self.client.force_login(self.factory.make_user())
+        resp = self.client.get(tile_uri)
+        self.assertEqual(resp.status_code, 403)
+
+    def test_iiif(self):
+        kwargs = {'document_pk': self.part.document.pk, 'pk': self.part.pk}
+        self.client.force_login(self.user)
+        resp = self.client.get(reverse('api:part-iiif-info', kwargs=kwargs))
+        self.assertEqual(resp.status_code, 200)
+        info = resp.json()
+        self.assertEqual((info['width'], info['height']), (self.part.image.width, self.part.image.height))
+
+        uri = reverse('api:part-iiif-image', kwargs=dict(
+            kwargs, region='pct:0,0,50,50', size='20,', rotation='0', quality='gray', extension='png'))
+        self.assertEqual(uri, info['@id'].split('testserver')[1] + '/pct:0,0,50,50/20,/0/gray.png')
+        for i in range(2):  # the second one comes from the cache
+            resp = self.client.get(uri)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp['Content-Type'], 'image/png')
+            with Image.open(BytesIO(resp.content)) as im:
+                self.assertEqual(im.size[0], 20)
+                self.assertEqual(im.mode, 'L')
+
+        resp = self.client.get(uri.replace('20,', '100000,'))
+        self.assertEqual(resp.status_code, 400)
+        resp = self.client.get(uri.replace('/0/', '/90/'))
+        self.assertEqual(resp.status_code, 501)
+
+        self.client.force_login(self.factory.make_user())
+        resp = self.client.get(uri)
+        self.assertEqual(resp.status_code, 403)
+
 
 class DocumentMetadataTestCase(CoreFactoryTestCase):
     def setUp(self):
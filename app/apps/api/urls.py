@@ -28,6 +28,7 @@ from api.views import (
     TaskReportViewSet,
     TextAnnotationViewSet,
     TextualWitnessViewSet,
+    UploadViewSet,
     UserViewSet,
 )
 
@@ -56,6 +57,7 @@ documents_router.register(r'transcriptions', DocumentTranscriptionViewSet, basen
 documents_router.register(r'taxonomies/annotations', AnnotationTaxonomyViewSet)
 documents_router.register(r'taxonomies/components', AnnotationComponentViewSet)
 documents_router.register(r'import', ImportViewSet, basename='import')
+documents_router.register(r'uploads', UploadViewSet, basename='upload')
 
 parts_router = routers.NestedSimpleRouter(documents_router, r'parts', lookup='part')
 parts_router.register(r'blocks', BlockViewSet)
@@ -67,6 +69,14 @@ parts_router.register(r'metadata', PartMetadataViewSet, basename='partmetadata')
 
 app_name = 'api'
 urlpatterns = [
+    # no trailing slash, tile urls are built by the viewer from the tiles endpoint
+    path('documents/<int:document_pk>/parts/<int:pk>/tiles/<int:level>/<int:column>_<int:row>.jpg',
+         PartViewSet.as_view({'get': 'tile'}), name='part-tile'),
+    # IIIF Image API, the identifier of the image of a part being <part url>iiif
+    path('documents/<int:document_pk>/parts/<int:pk>/iiif/info.json',
+         PartViewSet.as_view({'get': 'iiif_info'}), name='part-iiif-info'),
+    path('documents/<int:document_pk>/parts/<int:pk>/iiif/<str:region>/<str:size>/<str:rotation>/<str:quality>.<str:extension>',
+         PartViewSet.as_view({'get': 'iiif_image'}), name='part-iiif-image'),
     path('', include(router.urls)),
     path('', include(documents_router.urls)),
     path('', include(parts_router.urls)),
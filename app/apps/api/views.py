@@ -1,11 +1,12 @@
 import json
 import logging
+import os.path
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.db import connection, transaction
 from django.db.models import Count, F, Prefetch, Q
-from django.http import HttpResponseRedirect
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.utils.decorators import method_decorator
@@ -19,7 +20,11 @@ from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.decorators import action
 from rest_framework.exceptions import NotAuthenticated
 from rest_framework.filters import OrderingFilter
-from rest_framework.mixins import CreateModelMixin
+from rest_framework.mixins import (
+    CreateModelMixin,
+    DestroyModelMixin,
+    RetrieveModelMixin,
+)
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import BasePermission
 from rest_framework.response import Response
@@ -63,8 +68,11 @@ from api.serializers import (
     TrainSerializer,
     TranscribeSerializer,
     TranscriptionSerializer,
+    UploadSerializer,
     UserSerializer,
 )
+from core.iiif import IIIFError, get_region, image_info, image_size
+from core.ingest import DZI_NAMESPACE, PYRAMID_TILE_FORMAT, pyramid_base, read_pyramid
 from core.merger import MAX_MERGE_SIZE, merge_lines
 from core.models import (
     AlreadyProcessingException,
@@ -92,8 +100,9 @@ from core.models import (
     TextualWitness,
     Transcription,
 )
-from core.tasks import recalculate_masks
+from core.tasks import recalculate_ordering, schedule_recalculate_masks
 from imports.forms import ExportForm, ImportForm
+from imports.models import Upload, UploadError
 from imports.parsers import ParseError
 from reporting.models import TaskReport
 from users.consumers import send_event
@@ -558,18 +567,42 @@ class DocumentViewSet(ModelViewSet):
             return Response({'error': "Invalid transcription."},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        from core.tasks import forced_align
-        for part in parts:
-            forced_align.delay(
-                instance_pk=part.pk,
-                model_pk=request.data['model'],
-                transcription_pk=request.data['transcription'],
-                part_pk=part.pk,
-                user_pk=request.user.pk
-            )
+        from core.tasks import document_forced_align
+        document_forced_align.delay(
+            document_pk=document.pk,
+            part_pks=[part.pk for part in parts],
+            model_pk=request.data['model'],
+            transcription_pk=request.data['transcription'],
+            user_pk=request.user.pk
+        )
 
         return Response({'status': 'success'}, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=['post'])
+    def recalculate_ordering(self, request, pk=None):
+        document = self.get_object()
+
+        pks = request.data.get('parts')
+        if pks is not None:
+            try:
+                pks = [int(pk_) for pk_ in pks]
+            except (TypeError, ValueError):
+                return Response({'error': "'parts' has to be a list."},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+        read_direction = request.data.get('read_direction')
+        if read_direction and read_direction not in dict(Document.READ_DIRECTION_CHOICES):
+            return Response({'error': "Invalid read_direction."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        recalculate_ordering.delay(
+            document_pk=document.pk,
+            part_pks=pks,
+            read_direction=read_direction,
+            user_pk=request.user.pk
+        )
+        return Response({'status': 'ok'}, status=status.HTTP_200_OK)
+
     @action(detail=True, methods=['patch'])
     def modify_ontology(self, request, pk=None):
         # special PATCH action to modify documents' ontology nested relationships
@@ -804,6 +837,63 @@ class ImportViewSet(GenericViewSet, CreateModelMixin):
         return Response({'status': 'ok'}, status=status.HTTP_201_CREATED)
 
 
+class UploadViewSet(DocumentPermissionMixin, CreateModelMixin, RetrieveModelMixin,
+                    DestroyModelMixin, GenericViewSet):
+    """
+    Resumable uploads, for files too big to be sent in a single request.
+
+    POST {filename, size} creates an upload, its content is then sent in chunks
+    with PATCH requests, each holding the raw bytes of the chunk in its body and their
+    position in the file in an Upload-Offset header, optionally checked against
+    an Upload-Checksum header ('sha256 <base64 digest>').
+    An interrupted upload is resumed from the offset given by GET (or HEAD).
+    Once complete, its id is passed to the import or part endpoints as 'upload'.
+    """
+    queryset = Upload.objects.all()
+    serializer_class = UploadSerializer
+
+    def get_queryset(self):
+        return super().get_queryset().filter(document=self.kwargs.get('document_pk'),
+                                             owner=self.request.user)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.action == 'create':
+            try:
+                context['document'] = (Document.objects
+                                       .for_user(self.request.user)
+                                       .get(pk=self.kwargs.get('document_pk')))
+            except Document.DoesNotExist:
+                raise PermissionDenied
+        return context
+
+    def upload_response(self, upload, status=status.HTTP_200_OK, **data):
+        response = Response(dict(self.get_serializer(upload).data, **data), status=status)
+        response['Upload-Offset'] = upload.offset
+        response['Upload-Length'] = upload.size
+        response['Cache-Control'] = 'no-store'
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.upload_response(self.get_object())
+
+    def partial_update(self, request, *args, **kwargs):
+        upload = self.get_object()
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except (KeyError, ValueError):
+            return Response({'error': "'Upload-Offset' and 'Content-Length' headers are mandatory."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            # the body is streamed to the staging file, it's never loaded in memory
+            upload.write_chunk(request._request, offset, length,
+                               checksum=request.META.get('HTTP_UPLOAD_CHECKSUM'))
+        except UploadError as e:
+            return self.upload_response(upload, status=status.HTTP_409_CONFLICT, error=str(e))
+        return self.upload_response(upload)
+
+
 class PartViewSet(DocumentPermissionMixin, ModelViewSet):
     filter_backends = (OrderingFilter,)
     queryset = DocumentPart.objects.all().select_related('document')
@@ -865,7 +955,7 @@ class PartViewSet(DocumentPermissionMixin, ModelViewSet):
         part = DocumentPart.objects.get(document=document_pk, pk=pk)
         onlyParam = request.query_params.get("only")
         only = onlyParam and list(map(int, onlyParam.split(',')))
-        recalculate_masks.delay(instance_pk=part.pk, user_pk=request.user.pk, only=only)
+        schedule_recalculate_masks(part.pk, user_pk=request.user.pk, only=only)
         return Response({'status': 'ok'})
 
     @action(detail=True, methods=['post'])
@@ -903,6 +993,68 @@ class PartViewSet(DocumentPermissionMixin, ModelViewSet):
             return Response({'error': "Post corners as x1, y1 (top left) and x2, y2 (bottom right)."},
                             status=status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=True, methods=['get'])
+    def tiles(self, request, document_pk=None, pk=None):
+        """
+        Describes the Deep Zoom pyramid of the image in the json format of OpenSeadragon,
+        its tiles are served by tile() at <this url><level>/<column>_<row>.jpg
+        """
+        document_part = self.get_object()
+        pyramid = read_pyramid(pyramid_base(document_part.image.name), document_part.image.path)
+        if pyramid is None:
+            return Response({'error': "No tiles for this image."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({'Image': {
+            'xmlns': DZI_NAMESPACE,
+            'Url': request.build_absolute_uri(),
+            'Format': pyramid['format'],
+            'Overlap': str(pyramid['overlap']),
+            'TileSize': str(pyramid['tile_size']),
+            'Size': {'Width': str(pyramid['width']), 'Height': str(pyramid['height'])}
+        }})
+
+    def tile(self, request, document_pk=None, pk=None, level=None, column=None, row=None):
+        document_part = self.get_object()
+        base = pyramid_base(document_part.image.name)
+        if read_pyramid(base, document_part.image.path) is None:
+            raise Http404
+        path = os.path.join(base + '_files', str(level), '%d_%d.%s' % (column, row, PYRAMID_TILE_FORMAT))
+        try:
+            response = FileResponse(open(path, 'rb'), content_type='image/jpeg')
+        except FileNotFoundError:
+            raise Http404
+        # tiles only change along with the url of the image
+        response['Cache-Control'] = 'private, max-age=86400'
+        return response
+
+    def iiif_info(self, request, document_pk=None, pk=None):
+        """
+        The IIIF Image API (2.1, level 1) description of the image,
+        regions of it are served by iiif_image() at <identifier>/<region>/<size>/<rotation>/<quality>.<format>
+        """
+        document_part = self.get_object()
+        if not document_part.image or not os.path.exists(document_part.image.path):
+            raise Http404
+        width, height = image_size(document_part.image.path)
+        identifier = request.build_absolute_uri().rsplit('/', 1)[0]
+        response = Response(image_info(identifier, width, height))
+        response['Access-Control-Allow-Origin'] = '*'
+        return response
+
+    def iiif_image(self, request, document_pk=None, pk=None,
+                   region=None, size=None, rotation=None, quality=None, extension=None):
+        document_part = self.get_object()
+        if not document_part.image or not os.path.exists(document_part.image.path):
+            raise Http404
+        try:
+            data, content_type = get_region(document_part.image.path, region, size, rotation, quality, extension)
+        except IIIFError as e:
+            return Response({'error': str(e)}, status=e.status)
+        response = HttpResponse(data, content_type=content_type)
+        # a region only changes along with the url of the image
+        response['Cache-Control'] = 'private, max-age=86400'
+        response['Access-Control-Allow-Origin'] = '*'
+        return response
+
 
 class DocumentTranscriptionViewSet(DocumentPermissionMixin, ModelViewSet):
     # Note: there is no dedicated Transcription viewset, it's always in the context of a Document
@@ -0,0 +1,108 @@
+import math
+
+import numpy as np
+import pyvips
+
+from core.utils import process_pool_imap
+
+# the background is estimated on a copy of the image whose biggest side is at most this size
+BACKGROUND_SIZE = 2048
+# same parameters as kraken.binarization.nlbin
+PERCENTILE = 80  # of the background filter
+RANGE = 40  # size of the background filter at full resolution (20 at zoom 0.5)
+BORDER = 0.1  # ignored when estimating the black and white levels
+ESCALE = 20  # the levels are estimated near the ink only, in regions of this much variance
+LOW = 5  # percentile of the black level
+HIGH = 90  # percentile of the white level
+
+
+def _grey(image):
+    if image.hasalpha():
+        image = image.flatten(background=255)
+    if image.interpretation != 'b-w' or image.format != 'uchar':
+        image = image.colourspace('b-w').cast('uchar')
+    return image[0]
+
+
+def _background(image, size):
+    # percentile filter, separable like in nlbin
+    index = lambda width, height: min(int(PERCENTILE / 100 * width * height), width * height - 1)  # noqa: E731
+    image = image.rank(size, 2, index(size, 2))
+    return image.rank(2, size, index(2, size))
+
+
+def _levels(flat, scale):
+    """
+    The black and white levels of the flattened image, estimated like nlbin from the
+    regions that contain significant variance, scale being the shrink factor of flat.
+    """
+    bx, by = int(flat.width * BORDER), int(flat.height * BORDER)
+    estimate = flat.crop(bx, by, flat.width - 2 * bx, flat.height - 2 * by).cast('float')
+    sigma = max(ESCALE / scale, 0.5)
+    variance = estimate - estimate.gaussblur(sigma)
+    variance = (variance * variance).gaussblur(sigma) ** 0.5
+    mask = variance > 0.3 * variance.max()
+    # dilated by 50 pixels at full resolution
+    size = max(math.ceil(50 / scale), 1)
+    mask = mask.rank(size, 1, size - 1).rank(1, size, size - 1)
+
+    values = np.ndarray(buffer=estimate.write_to_memory(), dtype=np.float32,
+                        shape=(estimate.height, estimate.width))
+    mask = np.ndarray(buffer=mask.write_to_memory(), dtype=np.uint8, shape=(mask.height, mask.width))
+    values = values[mask > 0]
+    if not values.size:
+        # a blank page
+        return 0, 255
+    return np.percentile(values, LOW), np.percentile(values, HIGH)
+
+
+def vips_binarize(src_path, dest_path, threshold=None):
+    """
+    Binarizes the image at src_path in a 1 bit png file at dest_path, like nlbin.
+
+    The background is estimated on a shrunk copy of the image, the full resolution image
+    is then streamed by libvips, a few strips at a time, so that the memory used doesn't
+    depend on the size of the image.
+    """
+    threshold = 0.5 if threshold is None else threshold
+
+    # first pass: the background and the black and white levels, at low resolution
+    small = _grey(pyvips.Image.thumbnail(src_path, BACKGROUND_SIZE, height=BACKGROUND_SIZE, size='down')).copy_memory()
+    info = pyvips.Image.new_from_file(src_path)
+    scale = info.width / small.width
+    size = max(3, math.ceil(RANGE / scale))
+    background = _background(small, size).copy_memory()
+    low, high = _levels((small - background + 255).clamp(min=0, max=255), scale)
+
+    # second pass: the full resolution image, streamed
+    image = _grey(pyvips.Image.new_from_file(src_path, access='sequential'))
+    background = background.resize(image.width / background.width,
+                                   vscale=image.height / background.height,
+                                   kernel='linear').embed(0, 0, image.width, image.height, extend='copy')
+    flat = (image - background + 255).clamp(min=0, max=255)
+    if high > low:
+        flat = (flat - low) * (255 / (high - low))
+    bw = flat > threshold * 255
+    bw.pngsave(dest_path, bitdepth=1)
+
+
+def binarize_file(job):
+    """
+    Runs vips_binarize in a pool worker, returns an error message or None.
+    It doesn't touch the database.
+    """
+    src_path, dest_path, threshold = job
+    try:
+        vips_binarize(src_path, dest_path, threshold=threshold)
+    except pyvips.error.Error as e:
+        return e.args[0]
+    return None
+
+
+def binarize_files(jobs, workers, window=None):
+    """
+    jobs is an iterable of (image path, destination path, threshold) tuples,
+    they are binarized by a pool of workers processes, at most window images in advance.
+    Yields (job, error message) tuples in the order of jobs.
+    """
+    return process_pool_imap(binarize_file, jobs, workers, window=window)
@@ -637,9 +637,9 @@ class DocumentProcessFormBase(forms.Form):
 
 
 class BinarizeForm(BootstrapFormMixin, DocumentProcessFormBase):
-    # binarizer = forms.ChoiceField(required=False,
-    #                               choices=BINARIZER_CHOICES,
-    #                               initial='kraken')
+    binarizer = forms.ChoiceField(required=False,
+                                  choices=DocumentPart.BW_BACKEND_CHOICES,
+                                  initial=DocumentPart.BW_BACKEND_KRAKEN)
 
     bw_image = forms.ImageField(required=False)
     threshold = forms.FloatField(
@@ -672,10 +672,11 @@ class BinarizeForm(BootstrapFormMixin, DocumentProcessFormBase):
             self.parts[0].bw_image = self.cleaned_data['bw_image']
             self.parts[0].save()
         else:
-            for part in parts:
-                part.task('binarize',
-                          user_pk=self.user.pk,
-                          threshold=self.cleaned_data.get('threshold'))
+            if self.cleaned_data.get('binarizer'):
+                parts.update(bw_backend=self.cleaned_data['binarizer'])
+            self.document.queue_binarization(parts,
+                                             user_pk=self.user.pk,
+                                             threshold=self.cleaned_data.get('threshold'))
 
 
 class SegmentForm(BootstrapFormMixin, DocumentProcessFormBase):
@@ -734,13 +735,13 @@ class SegmentForm(BootstrapFormMixin, DocumentProcessFormBase):
                 ocr_model_document.executed_on = timezone.now()
                 ocr_model_document.save()
 
-        for part in self.cleaned_data.get('parts'):
-            part.task('segment',
-                      user_pk=self.user.pk,
-                      steps=self.cleaned_data.get('segmentation_steps'),
-                      text_direction=self.cleaned_data.get('text_direction'),
-                      model_pk=model and model.pk or None,  # None means default model
-                      override=self.cleaned_data.get('override'))
+        self.document.queue_pipeline(
+            self.cleaned_data.get('parts'), 'segment',
+            user_pk=self.user.pk,
+            steps=self.cleaned_data.get('segmentation_steps'),
+            text_direction=self.cleaned_data.get('text_direction'),
+            model_pk=model and model.pk or None,  # None means default model
+            override=self.cleaned_data.get('override'))
 
 
 class TranscribeForm(BootstrapFormMixin, DocumentProcessFormBase):
@@ -793,11 +794,11 @@ class TranscribeForm(BootstrapFormMixin, DocumentProcessFormBase):
             ocr_model_document.executed_on = timezone.now()
             ocr_model_document.save()
 
-        for part in self.cleaned_data.get('parts'):
-            part.task('transcribe',
-                      user_pk=self.user.pk,
-                      model_pk=model.pk,
-                      transcription_pk=transcription and transcription.pk or None)
+        self.document.queue_pipeline(
+            self.cleaned_data.get('parts'), 'transcribe',
+            user_pk=self.user.pk,
+            model_pk=model.pk,
+            transcription_pk=transcription and transcription.pk or None)
 
 
 class AlignForm(BootstrapFormMixin, DocumentProcessFormBase, RegionTypesFormMixin):
@@ -0,0 +1,264 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import namedtuple
+
+import pyvips
+from django.conf import settings
+
+from core.ingest import jpeg_compatible
+
+logger = logging.getLogger(__name__)
+
+# Image API 2.1, compliance level 1
+IIIF_CONTEXT = 'http://iiif.io/api/image/2/context.json'
+IIIF_PROTOCOL = 'http://iiif.io/api/image'
+IIIF_PROFILE = 'http://iiif.io/api/image/2/level1.json'
+FORMATS = {'jpg': 'image/jpeg', 'png': 'image/png'}
+QUALITIES = ('default', 'color', 'gray')
+# tiles advertised to viewers, any other region can be requested
+TILE_SIZE = 512
+JPEG_QUALITY = 85
+
+ImageRequest = namedtuple('ImageRequest', ('x', 'y', 'width', 'height',
+                                           'output_width', 'output_height', 'quality', 'format'))
+
+
+class IIIFError(ValueError):
+    """
+    A request the image server can't satisfy, status is the http status to answer with.
+    """
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _numbers(value, count, cast):
+    try:
+        numbers = [cast(n) for n in value.split(',')]
+    except ValueError:
+        numbers = []
+    if len(numbers) != count or any(n < 0 for n in numbers):
+        raise IIIFError('Invalid parameter: %s' % value)
+    return numbers
+
+
+def parse_region(region, width, height):
+    """
+    Returns the x, y, width, height in pixels of the region of an image of width x height.
+    """
+    if region == 'full':
+        x, y, w, h = 0, 0, width, height
+    elif region == 'square':
+        side = min(width, height)
+        x, y, w, h = (width - side) // 2, (height - side) // 2, side, side
+    elif region.startswith('pct:'):
+        x, y, w, h = _numbers(region[4:], 4, float)
+        x, y, w, h = (round(x * width / 100), round(y * height / 100),
+                      round(w * width / 100), round(h * height / 100))
+    else:
+        x, y, w, h = _numbers(region, 4, int)
+    # the region is cropped to the image
+    w, h = min(w, width - x), min(h, height - y)
+    if w <= 0 or h <= 0:
+        raise IIIFError('Region %s is outside of the image.' % region)
+    return x, y, w, h
+
+
+def parse_size(size, width, height):
+    """
+    Returns the size in pixels of the render of a region of width x height.
+    Renders bigger than the region are refused, they would only cost memory.
+    """
+    if size in ('full', 'max'):
+        w, h = width, height
+    elif size.startswith('pct:'):
+        pct, = _numbers(size[4:], 1, float)
+        w, h = round(width * pct / 100), round(height * pct / 100)
+    else:
+        confined = size.startswith('!')
+        w, separator, h = size.lstrip('!').partition(',')
+        if not separator or not (w or h) or (confined and not (w and h)):
+            raise IIIFError('Invalid size: %s' % size)
+        w = _numbers(w, 1, int)[0] if w else None
+        h = _numbers(h, 1, int)[0] if h else None
+        if confined:
+            scale = min(w / width, h / height)
+            w, h = round(width * scale), round(height * scale)
+        elif w is None:
+            w = round(width * h / height)
+        elif h is None:
+            h = round(height * w / width)
+    if w > width or h > height:
+        raise IIIFError('Size %s is bigger than the region.' % size)
+    return max(w, 1), max(h, 1)
+
+
+def parse_request(region, size, rotation, quality, format, width, height):
+    """
+    Validates the parameters of an image request against an image of width x height.
+    Equivalent requests result in the same ImageRequest.
+    """
+    if format not in FORMATS:
+        raise IIIFError('Unsupported format: %s' % format, status=501)
+    if quality not in QUALITIES:
+        raise IIIFError('Unsupported quality: %s' % quality, status=501)
+    if rotation not in ('0', '0.0'):
+        raise IIIFError('Unsupported rotation: %s' % rotation, status=501)
+    x, y, w, h = parse_region(region, width, height)
+    output_width, output_height = parse_size(size, w, h)
+    return ImageRequest(x, y, w, h, output_width, output_height,
+                        'gray' if quality == 'gray' else 'default', format)
+
+
+def image_info(identifier, width, height):
+    """
+    The info.json of an image of width x height served at identifier.
+    """
+    scale_factors = [1]
+    while max(width, height) / scale_factors[-1] > TILE_SIZE:
+        scale_factors.append(scale_factors[-1] * 2)
+    return {
+        '@context': IIIF_CONTEXT,
+        '@id': identifier,
+        'protocol': IIIF_PROTOCOL,
+        'width': width,
+        'height': height,
+        'profile': [IIIF_PROFILE, {
+            'formats': list(FORMATS),
+            'qualities': list(QUALITIES),
+            'supports': ['regionByPct', 'regionSquare', 'sizeByConfinedWh', 'sizeByWh'],
+        }],
+        'tiles': [{'width': TILE_SIZE, 'scaleFactors': scale_factors}],
+    }
+
+
+def render(path, request):
+    """
+    Renders the ImageRequest for the image at path, returns the encoded bytes.
+    """
+    # jpeg images can be shrunk by 2, 4 or 8 while being decoded, much faster for small renders of big pages
+    shrink = 1
+    if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg'):
+        factor = min(request.width / request.output_width, request.height / request.output_height)
+        while shrink < 8 and shrink * 2 <= factor:
+            shrink *= 2
+    if shrink > 1:
+        image = pyvips.Image.new_from_file(path, access='sequential', shrink=shrink)
+    else:
+        image = pyvips.Image.new_from_file(path, access='sequential')
+    x, y = request.x // shrink, request.y // shrink
+    w = max(min(-(-request.width // shrink), image.width - x), 1)
+    h = max(min(-(-request.height // shrink), image.height - y), 1)
+    image = image.crop(x, y, w, h)
+    if (w, h) != (request.output_width, request.output_height):
+        image = image.thumbnail_image(request.output_width, height=request.output_height, size='force')
+    image = jpeg_compatible(image)
+    if request.quality == 'gray' and image.interpretation != 'b-w':
+        image = image.colourspace('b-w')
+    if request.format == 'png':
+        return image.pngsave_buffer()
+    return image.jpegsave_buffer(Q=JPEG_QUALITY)
+
+
+class RegionCache:
+    """
+    A disk cache of rendered regions shared by all the processes of a host,
+    bounded by max_disk_size (in bytes), the least recently used regions being evicted first.
+    Entries are keyed by path, modification time and size of the image,
+    an image overwritten on disk is never served stale.
+    """
+
+    def __init__(self, directory=None, max_disk_size=None):
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self._written = 0  # bytes stored since the last eviction
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.directory and self.max_disk_size)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + '.region')
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        disk_path = self._disk_path(key)
+        try:
+            with open(disk_path, 'rb') as fh:
+                data = fh.read()
+            os.utime(disk_path)  # keep track of the last use for the eviction
+        except OSError:
+            return None
+        return data
+
+    def store(self, key, data):
+        if not self.enabled:
+            return
+        disk_path = self._disk_path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp_path, disk_path)
+            # regions are small, only scan the directory once in a while
+            with self._lock:
+                self._written += len(data)
+                evict = self._written > self.max_disk_size / 100
+                if evict:
+                    self._written = 0
+            if evict:
+                self._evict_disk()
+        except OSError as e:
+            # the cache is an optimization, never fail because of it
+            logger.warning('Could not store a region of %s in the cache: %s', key[0], e)
+
+    def _evict_disk(self):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.region'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_disk_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+region_cache = RegionCache(
+    directory=getattr(settings, 'IIIF_IMAGE_CACHE_DIR', None),
+    max_disk_size=getattr(settings, 'IIIF_IMAGE_CACHE_DISK_SIZE', 1024) * 1024 * 1024,
+)
+
+
+def image_size(path):
+    # only reads the header
+    image = pyvips.Image.new_from_file(path)
+    return image.width, image.height
+
+
+def get_region(path, region, size, rotation, quality, format):
+    """
+    Returns the bytes of the image request for the image at path and its mime type,
+    from the cache if it was rendered before.
+    """
+    stat = os.stat(path)
+    request = parse_request(region, size, rotation, quality, format, *image_size(path))
+    key = (path, stat.st_mtime_ns, stat.st_size) + tuple(request)
+    data = region_cache.get(key)
+    if data is None:
+        data = render(path, request)
+        region_cache.store(key, data)
+    return data, FORMATS[request.format]
@@ -0,0 +1,178 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+STATS_CACHE_PREFIX = 'page-image-cache'
+STATS_KEYS = ('hits', 'disk_hits', 'misses', 'evictions')
+
+# modes that survive a round trip through a numpy array
+ARRAY_MODES = ('1', 'L', 'LA', 'RGB', 'RGBA', 'I', 'I;16', 'I;16B', 'F')
+
+
+class PageImageCache:
+    """
+    A per process cache of decoded page images.
+
+    Decoded rasters are stored as numpy arrays, in memory (LRU bounded by max_size, in bytes)
+    and on disk as .npy files in directory (bounded by max_disk_size, in bytes)
+    that are memory-mapped when read back, so that all the processes of a host share them.
+    Entries are keyed by path, modification time, size and mode of the image,
+    an image overwritten on disk is never served stale.
+    Hits, disk hits, misses and evictions are counted locally and in the shared django cache
+    (cf the model_cache_stats command).
+    """
+
+    def __init__(self, max_size=None, directory=None, max_disk_size=None):
+        self.max_size = max_size
+        self.directory = directory
+        self.max_disk_size = max_disk_size
+        self._entries = OrderedDict()  # key -> array
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return sum(array.nbytes for array in self._entries.values())
+
+    def _count(self, name):
+        setattr(self, name, getattr(self, name) + 1)
+        key = '%s:%s' % (STATS_CACHE_PREFIX, name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the key doesn't exist yet (or the cache backend is a dummy one)
+            cache.set(key, 1, None)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, digest + '.npy')
+
+    @staticmethod
+    def _decode(path, mode):
+        with Image.open(path) as im:
+            if mode and im.mode != mode:
+                im = im.convert(mode)
+            if im.mode not in ARRAY_MODES:
+                # eg palette or CMYK images, they are not cached rather than converted
+                return im.copy()
+            return np.asarray(im)
+
+    def get(self, path, mode=None):
+        """
+        Returns the decoded image at path as a PIL image, converted to mode if given.
+        The image shares its memory with the cache, it is read only.
+        Images whose mode can't be stored as an array are decoded every time.
+        """
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size, mode)
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+                self._count('hits')
+                return Image.fromarray(array)
+
+        array = None
+        if self.directory and self.max_disk_size:
+            disk_path = self._disk_path(key)
+            try:
+                array = np.load(disk_path, mmap_mode='r')
+            except (OSError, ValueError):
+                pass
+            else:
+                self._count('disk_hits')
+                os.utime(disk_path)  # keep track of the last use for the eviction
+
+        if array is None:
+            self._count('misses')
+            array = self._decode(path, mode)
+            if isinstance(array, Image.Image):
+                return array
+            if self.directory and self.max_disk_size:
+                array = self._store(key, array)
+
+        if self.max_size:
+            with self._lock:
+                # drop stale versions of the same image
+                for stale in [k for k in self._entries if k[0] == path and k[3] == mode]:
+                    del self._entries[stale]
+                self._entries[key] = array
+                self._evict()
+        return Image.fromarray(array)
+
+    def _store(self, key, array):
+        disk_path = self._disk_path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                np.save(fh, array)
+            os.replace(tmp_path, disk_path)
+            self._evict_disk(keep=disk_path)
+            return np.load(disk_path, mmap_mode='r')
+        except OSError as e:
+            # the cache is an optimization, never fail because of it
+            logger.warning('Could not store %s in the page image cache: %s', key[0], e)
+            return array
+
+    def _evict(self):
+        while len(self._entries) > 1 and self.size > self.max_size:
+            key, array = self._entries.popitem(last=False)
+            self._count('evictions')
+
+    def _evict_disk(self, keep=None):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npy') and entry.path != keep:
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in files) + (os.path.getsize(keep) if keep else 0)
+        for mtime, size, path in sorted(files):
+            if total <= self.max_disk_size:
+                break
+            try:
+                # already mapped arrays stay valid
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self._count('evictions')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def shared_stats():
+        """
+        Returns the hits/disk_hits/misses/evictions counters aggregated over all the workers.
+        """
+        values = cache.get_many(['%s:%s' % (STATS_CACHE_PREFIX, name) for name in STATS_KEYS])
+        return {name: values.get('%s:%s' % (STATS_CACHE_PREFIX, name), 0) for name in STATS_KEYS}
+
+
+page_image_cache = PageImageCache(
+    max_size=getattr(settings, 'PAGE_IMAGE_CACHE_MAX_SIZE', 128) * 1024 * 1024,
+    directory=getattr(settings, 'PAGE_IMAGE_CACHE_DIR', None),
+    max_disk_size=getattr(settings, 'PAGE_IMAGE_CACHE_DISK_SIZE', 1024) * 1024 * 1024,
+)
+
+
+def open_page_image(path, mode=None):
+    return page_image_cache.get(path, mode=mode)
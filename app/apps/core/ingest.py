@@ -0,0 +1,191 @@
+import hashlib
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from xml.etree import ElementTree
+
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from easy_thumbnails.files import ThumbnailFile, get_thumbnailer
+
+logger = logging.getLogger(__name__)
+
+# stands for an unconstrained side of a thumbnail
+UNBOUNDED = 10000000
+# Deep Zoom pyramids of the part images are stored in MEDIA_ROOT/PYRAMIDS_DIR, cf settings.IMAGE_PYRAMIDS
+PYRAMIDS_DIR = 'pyramids'
+PYRAMID_TILE_FORMAT = 'jpg'
+PYRAMID_TILE_QUALITY = 85
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+# the content-addressed store of the part images is MEDIA_ROOT/IMAGE_STORE_DIR, cf settings.IMAGE_DEDUPLICATION
+IMAGE_STORE_DIR = 'images'
+
+
+class StageTimer:
+    """
+    Measures the duration of the stages of a pipeline, in seconds.
+    """
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - start, 3)
+
+
+def image_is_bitonal(image):
+    """
+    Same as kraken.lib.util.is_bitonal for a pyvips image, true if it's made of exactly two grey levels.
+    """
+    if image.hasalpha():
+        image = image[:image.bands - 1]
+    if image.format != 'uchar':
+        return False
+    if image.bands > 1:
+        # a colored image can't be bitonal unless all its bands are the same
+        for band in range(1, image.bands):
+            if (image[band] != image[0]).max():
+                return False
+        image = image[0]
+    histogram = np.frombuffer(image.hist_find().write_to_memory(), dtype=np.uint32)
+    return np.count_nonzero(histogram) == 2
+
+
+def make_thumbnail(image, config):
+    """
+    Resizes image according to an easy_thumbnails alias configuration.
+    """
+    width, height = config['size']
+    crop = config.get('crop')
+    if not crop:
+        crop = 'none'
+    elif crop == 'smart':
+        crop = 'attention'
+    else:
+        crop = 'centre'
+    thumbnail = image.thumbnail_image(width or UNBOUNDED, height=height or UNBOUNDED, crop=crop,
+                                      size='both' if config.get('upscale') else 'down')
+    return jpeg_compatible(thumbnail)
+
+
+def jpeg_compatible(image):
+    # jpeg only handles 8 bits grey or rgb
+    if image.hasalpha():
+        image = image.flatten(background=255)
+    if image.format != 'uchar' or image.interpretation not in ('b-w', 'srgb'):
+        image = image.colourspace('srgb')
+    return image
+
+
+def save_thumbnails(field_file, image):
+    """
+    Generates the thumbnails of all the settings.THUMBNAIL_ALIASES from a decoded image
+    and registers them with easy_thumbnails as if it had generated them itself.
+    Returns the urls of the thumbnails by alias.
+    """
+    thumbnailer = get_thumbnailer(field_file)
+    urls = {}
+    for alias, config in settings.THUMBNAIL_ALIASES[''].items():
+        data = make_thumbnail(image, config).jpegsave_buffer(Q=config.get('quality', 85))
+        thumbnail = ThumbnailFile(thumbnailer.get_thumbnail_name(config),
+                                  file=ContentFile(data),
+                                  storage=thumbnailer.thumbnail_storage)
+        thumbnailer.save_thumbnail(thumbnail)
+        urls[alias] = thumbnail.url
+    return urls
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    The sha256 of the content of the file at path, in hex.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def image_store_name(digest, extension):
+    """
+    Name in the storage of the image of the content-addressed store whose content hashes to digest.
+    """
+    return os.path.join(IMAGE_STORE_DIR, digest[:2], digest + extension.lower())
+
+
+def in_image_store(name):
+    """
+    True if the file stored as name belongs to the content-addressed store,
+    it's then deleted along with its ImageBlob, never with a part.
+    """
+    return bool(name) and name.startswith(IMAGE_STORE_DIR + '/')
+
+
+def pyramid_base(image_name):
+    """
+    Path of the pyramid of the image stored as image_name, without extension:
+    its descriptor is base.dzi and its tiles are in base_files/<level>/<column>_<row>.jpg.
+    """
+    return os.path.join(settings.MEDIA_ROOT, PYRAMIDS_DIR, os.path.splitext(image_name)[0])
+
+
+def save_pyramid(image, base):
+    """
+    Writes the Deep Zoom pyramid of a decoded image, replacing the previous one at once.
+    """
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    tmp = base + '.tmp'
+    remove_pyramid(tmp)
+    jpeg_compatible(image).dzsave(tmp, tile_size=getattr(settings, 'IMAGE_PYRAMID_TILE_SIZE', 256), overlap=0,
+                                  suffix='.%s[Q=%d]' % (PYRAMID_TILE_FORMAT, PYRAMID_TILE_QUALITY))
+    remove_pyramid(base)
+    os.rename(tmp + '_files', base + '_files')
+    os.rename(tmp + '.dzi', base + '.dzi')
+
+
+def remove_pyramid(base):
+    # the descriptor first, tiles are only served along with it
+    try:
+        os.remove(base + '.dzi')
+    except FileNotFoundError:
+        pass
+    shutil.rmtree(base + '_files', ignore_errors=True)
+
+
+def pyramid_ready(base, image_path):
+    """
+    Whether there is a pyramid at base that is not older than the image at image_path.
+    """
+    try:
+        return os.path.getmtime(base + '.dzi') >= os.path.getmtime(image_path)
+    except OSError:
+        return False
+
+
+def read_pyramid(base, image_path):
+    """
+    Returns the descriptor of the pyramid at base as a dict, or None if there is none
+    or if it's older than the image at image_path, ie the image was edited since.
+    """
+    if not pyramid_ready(base, image_path):
+        return None
+    try:
+        root = ElementTree.parse(base + '.dzi').getroot()
+    except (OSError, ElementTree.ParseError):
+        return None
+    size = root.find('{%s}Size' % DZI_NAMESPACE)
+    return {
+        'format': root.get('Format'),
+        'overlap': int(root.get('Overlap')),
+        'tile_size': int(root.get('TileSize')),
+        'width': int(size.get('Width')),
+        'height': int(size.get('Height')),
+    }
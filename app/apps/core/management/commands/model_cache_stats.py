@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from core.image_cache import PageImageCache
+from core.model_cache import ModelCache
+
+
+class Command(BaseCommand):
+    help = ("Display the kraken model cache and page image cache hits, misses and evictions "
+            "aggregated over all workers.")
+
+    def handle(self, *args, **options):
+        for title, stats in (("Model cache", ModelCache.shared_stats()),
+                             ("Page image cache", PageImageCache.shared_stats())):
+            self.stdout.write(title)
+            total = sum(value for name, value in stats.items() if name != 'evictions')
+            for name, value in stats.items():
+                self.stdout.write(f"  {name}: {value}")
+            if total:
+                hits = stats['hits'] + stats.get('disk_hits', 0)
+                self.stdout.write(f"  hit rate: {hits / total:.1%}")
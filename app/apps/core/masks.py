@@ -0,0 +1,81 @@
+import logging
+
+import numpy as np
+import shapely
+from django.conf import settings
+from kraken.lib.segmentation import calculate_polygonal_environment
+from shapely.geometry import LineString
+from shapely.strtree import STRtree
+from skimage.measure import approximate_polygon
+
+from core.image_cache import open_page_image
+from core.utils import process_pool_imap, shared_process_pool
+
+logger = logging.getLogger(__name__)
+
+# baselines further than this factor times the median distance between neighbouring baselines
+# are not considered as context when computing a mask
+CONTEXT_DISTANCE_FACTOR = 3
+
+
+def neighbours(baselines, indices):
+    """
+    Returns, for each baseline of indices, the indices of the other baselines
+    that are close enough to bound its mask.
+    The nearest baselines are always part of it, even for isolated lines.
+    """
+    if len(baselines) < 2:
+        return [[] for i in indices]
+
+    geoms = [LineString(baseline) for baseline in baselines]
+    tree = STRtree(geoms)
+    (src, dst), distances = tree.query_nearest(geoms, exclusive=True, return_distance=True)
+    nearest = np.full(len(geoms), np.inf)
+    np.minimum.at(nearest, src, distances)
+    spacing = np.median(nearest[np.isfinite(nearest)])
+
+    indices = np.asarray(indices, dtype=int)
+    radii = np.maximum(CONTEXT_DISTANCE_FACTOR * spacing, nearest[indices] * 1.5)
+    areas = shapely.buffer(np.take(np.array(geoms, dtype=object), indices), radii)
+    src, dst = tree.query(areas, predicate='intersects')
+
+    result = [[] for i in indices]
+    for s, d in zip(src, dst):
+        if d != indices[s]:
+            result[s].append(int(d))
+    return result
+
+
+def _make_mask(job, im):
+    baseline, context, topline = job
+    mask = calculate_polygonal_environment(
+        im, [baseline], suppl_obj=context, scale=(1200, 0), topline=topline
+    )
+    if not mask[0]:
+        return None
+    if len(mask[0]) > 50:
+        return approximate_polygon(np.array(mask[0]), 2).tolist()
+    return mask[0]
+
+
+def _make_page_mask(job):
+    # runs in a pool worker, the page is decoded once per worker thanks to its page image cache
+    image_path, baseline, context, topline = job
+    return _make_mask((baseline, context, topline), open_page_image(image_path, mode="L"))
+
+
+def compute_masks(image_path, jobs):
+    """
+    jobs is a list of (baseline, context, topline) tuples,
+    returns the list of the corresponding masks (or None if none could be found).
+    Big pages are spread over a pool of settings.MASKS_WORKERS processes,
+    started once per worker process, masks are computed after each edit of a page.
+    """
+    workers = getattr(settings, 'MASKS_WORKERS', 4)
+    if workers > 1 and len(jobs) >= getattr(settings, 'MASKS_PARALLEL_MIN_LINES', 50):
+        page_jobs = [(image_path, baseline, context, topline) for baseline, context, topline in jobs]
+        masks = process_pool_imap(_make_page_mask, page_jobs, workers, executor=shared_process_pool(workers))
+        return [mask for job, mask in masks]
+
+    im = open_page_image(image_path, mode="L")
+    return [_make_mask(job, im) for job in jobs]
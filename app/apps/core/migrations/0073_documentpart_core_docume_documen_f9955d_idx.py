@@ -0,0 +1,17 @@
+# Generated by Django 4.2.13 on 2026-10-18 11:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0072_transcription_comments'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='documentpart',
+            index=models.Index(fields=['document', 'original_filename'], name='core_docume_documen_f9955d_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0074_imageblob_documentpart_blob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='documentpart',
+            name='bw_backend',
+            field=models.CharField(choices=[('kraken', 'Kraken'), ('vips', 'Streaming (libvips)')], default='kraken', max_length=128),
+        ),
+    ]
@@ -0,0 +1,110 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from kraken.lib import models as kraken_models
+from kraken.lib import vgsl
+
+logger = logging.getLogger(__name__)
+
+STATS_CACHE_PREFIX = 'kraken-model-cache'
+STATS_KEYS = ('hits', 'misses', 'evictions')
+
+
+class ModelCache:
+    """
+    A per process LRU cache of loaded kraken models.
+
+    It is bounded both in number of models and in cumulated size (of the model files, in bytes).
+    Entries are keyed by loader, path, modification time and size of the file,
+    so a model overwritten on disk (retrained or reverted) is never served stale.
+    Hits, misses and evictions are counted locally and in the shared django cache
+    so that they can be aggregated across workers (cf the model_cache_stats command).
+    """
+
+    def __init__(self, max_count=4, max_size=None):
+        self.max_count = max_count
+        self.max_size = max_size
+        self._entries = OrderedDict()  # key -> (model, file size)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return sum(size for model, size in self._entries.values())
+
+    def _count(self, name):
+        setattr(self, name, getattr(self, name) + 1)
+        key = '%s:%s' % (STATS_CACHE_PREFIX, name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the key doesn't exist yet (or the cache backend is a dummy one)
+            cache.set(key, 1, None)
+
+    def get(self, path, loader):
+        stat = os.stat(path)
+        key = (loader, path, stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._count('hits')
+                return self._entries[key][0]
+
+        self._count('misses')
+        model = loader(path)
+
+        with self._lock:
+            # drop stale versions of the same file
+            for stale in [k for k in self._entries if k[:2] == key[:2]]:
+                del self._entries[stale]
+            self._entries[key] = (model, stat.st_size)
+            self._evict()
+        return model
+
+    def _evict(self):
+        while len(self._entries) > 1 and (
+                (self.max_count and len(self._entries) > self.max_count)
+                or (self.max_size and self.size > self.max_size)):
+            key, value = self._entries.popitem(last=False)
+            logger.debug('Evicting model %s from the cache.', key[1])
+            self._count('evictions')
+
+    def invalidate(self, path):
+        with self._lock:
+            for key in [k for k in self._entries if k[1] == path]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def shared_stats():
+        """
+        Returns the hits/misses/evictions counters aggregated over all the workers.
+        """
+        values = cache.get_many(['%s:%s' % (STATS_CACHE_PREFIX, name) for name in STATS_KEYS])
+        return {name: values.get('%s:%s' % (STATS_CACHE_PREFIX, name), 0) for name in STATS_KEYS}
+
+
+model_cache = ModelCache(
+    max_count=getattr(settings, 'KRAKEN_MODEL_CACHE_MAX_COUNT', 4),
+    max_size=getattr(settings, 'KRAKEN_MODEL_CACHE_MAX_SIZE', 512) * 1024 * 1024
+)
+
+
+def load_segmentation_model(path):
+    return model_cache.get(path, vgsl.TorchVGSLModel.load_model)
+
+
+def load_recognition_model(path):
+    return model_cache.get(path, kraken_models.load_any)
@@ -1,5 +1,3 @@
-import functools
-import itertools
 import json
 import logging
 import math
@@ -9,12 +7,14 @@ import shutil
 import subprocess
 import time
 import uuid
+from contextlib import nullcontext
 from datetime import datetime
 from glob import glob
 from os import makedirs, path
 from statistics import mean
 
 import numpy as np
+import pyvips
 from celery import chain
 from django.conf import settings
 from django.contrib.auth.models import Group
@@ -22,38 +22,56 @@ from django.contrib.postgres.fields import ArrayField
 from django.core.files.uploadedfile import File
 from django.core.validators import FileExtensionValidator
 from django.db import models, transaction
-from django.db.models import Avg, JSONField, Prefetch, Q, Sum
+from django.db.models import Avg, JSONField, Max, Prefetch, Q, Sum
 from django.db.models.functions import Coalesce, Length
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_init, post_save, pre_delete
 from django.dispatch import receiver
 from django.forms import ValidationError
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
+from django_cleanup import cleanup
 from django_prometheus.models import ExportModelOperationsMixin
 from easy_thumbnails.files import get_thumbnailer
 from kraken import blla, rpred
 from kraken.binarization import nlbin
 from kraken.containers import BaselineLine, Segmentation
 from kraken.kraken import SEGMENTATION_DEFAULT_MODEL
-from kraken.lib import models as kraken_models
-from kraken.lib import vgsl
-from kraken.lib.segmentation import calculate_polygonal_environment
 from kraken.lib.util import is_bitonal
 from ordered_model.models import OrderedModel, OrderedModelManager
 from PIL import Image
-from shapely import affinity
 from shapely.geometry import LineString, Polygon
-from skimage.measure import approximate_polygon
+from shapely.strtree import STRtree
 from sklearn import preprocessing
 from sklearn.cluster import DBSCAN
 
+from core.binarization import vips_binarize
+from core.image_cache import open_page_image
+from core.ingest import (
+    StageTimer,
+    file_digest,
+    image_is_bitonal,
+    image_store_name,
+    in_image_store,
+    pyramid_base,
+    read_pyramid,
+    remove_pyramid,
+    save_pyramid,
+    save_thumbnails,
+)
+from core.masks import compute_masks, neighbours
+from core.model_cache import (
+    load_recognition_model,
+    load_segmentation_model,
+    model_cache,
+)
 from core.tasks import (
     align,
     binarize,
-    convert,
+    document_binarize,
+    document_pipeline,
     generate_part_thumbnails,
-    lossless_compression,
+    ingest,
     segment,
     segtrain,
     train,
@@ -64,7 +82,7 @@ from core.validators import JSONSchemaValidator
 from reporting.models import TASK_FINAL_STATES, TaskReport
 from users.consumers import send_event
 from users.models import User
-from versioning.models import Versioned
+from versioning.models import NoChangeException, Versioned
 
 logger = logging.getLogger(__name__)
 
@@ -820,6 +838,92 @@ class Document(ExportModelOperationsMixin("Document"), models.Model):
             **kwargs,
         )
 
+    def recalculate_ordering(self, parts=None, read_direction=None):
+        """
+        Re-order the lines of all the parts of the document (or only the given ones).
+        """
+        read_direction = read_direction or self.read_direction
+        parts = self.parts.all() if parts is None else parts
+        for part in parts:
+            part.recalculate_ordering(read_direction=read_direction)
+
+    def queue_pipeline(self, parts, process, **kwargs):
+        """
+        Queues the segmentation or transcription (process) of parts in chunks of
+        settings.INFERENCE_PIPELINE_CHUNK_SIZE parts per task (cf core.tasks.document_pipeline).
+        Parts that are not converted yet, or all of them if the chunk size is 0,
+        go through the per part tasks chain.
+        """
+        parts = list(parts)
+        for part in parts:
+            if not part.tasks_finished():
+                raise AlreadyProcessingException
+
+        chunk_size = getattr(settings, 'INFERENCE_PIPELINE_CHUNK_SIZE', 10)
+        ready = []
+        for part in parts:
+            if chunk_size and part.workflow_state >= DocumentPart.WORKFLOW_STATE_CONVERTED:
+                ready.append(part)
+            else:
+                part.task(process, **kwargs)
+
+        label = 'Segment in %s' if process == 'segment' else 'Transcribe in %s'
+        for i in range(0, len(ready), chunk_size or 1):
+            self.queue_batch(document_pipeline, ready[i:i + chunk_size], process,
+                             report_label=label % self.name, process=process, **kwargs)
+
+    def queue_batch(self, task, parts, method, user_pk=None, report_label=None, **kwargs):
+        """
+        Queues a task processing several parts at once (cf core.tasks.document_pipeline).
+        Each part gets its own report, as if it was processed by the per part task method,
+        so that the workflow state of the part, its cancelation and recovery work the same.
+        """
+        task_id = str(uuid.uuid4())
+        if user_pk:
+            TaskReport.objects.bulk_create([
+                TaskReport(user_id=user_pk,
+                           label=report_label,
+                           document=self,
+                           document_part=part,
+                           task_id=task_id,
+                           method="core.tasks.%s" % method)
+                for part in parts
+            ])
+        send_event('document', self.pk, 'parts:workflow', {
+            'parts': [{'id': part.pk, 'process': method, 'status': 'pending'}
+                      for part in parts]
+        })
+        task.apply_async(kwargs=dict(document_pk=self.pk,
+                                     instance_pks=[part.pk for part in parts],
+                                     user_pk=user_pk,
+                                     report_label=report_label,
+                                     **kwargs),
+                         task_id=task_id)
+
+    def queue_binarization(self, parts, **kwargs):
+        """
+        Queues the binarization of parts, those using the streaming backend in a single task,
+        their images being spread over a pool of processes (cf core.tasks.document_binarize),
+        the others in a task each.
+        """
+        parts = list(parts)
+        for part in parts:
+            if not part.tasks_finished():
+                raise AlreadyProcessingException
+
+        always_convert = getattr(settings, "ALWAYS_CONVERT", False)
+        batch = []
+        for part in parts:
+            # images waiting for their conversion go through the per part tasks chain
+            if part.bw_backend == DocumentPart.BW_BACKEND_VIPS and (part.converted or not always_convert):
+                batch.append(part)
+            else:
+                part.task("binarize", **kwargs)
+
+        if batch:
+            self.queue_batch(document_binarize, batch, "binarize",
+                             report_label="Binarize in %s" % self.name, **kwargs)
+
     def cancel_alignment(self, revoke_task=True, username=None):
         """Cancel the alignment task; adapted from OcrModel"""
         task_id = None
@@ -851,17 +955,73 @@ def document_images_path(instance, filename):
     return "documents/{0}/{1}".format(instance.document.pk, filename)
 
 
+@cleanup.ignore
+class ImageBlob(models.Model):
+    """
+    An image of the content-addressed store, shared by all the parts whose uploaded
+    image had the same content, along with its thumbnails and tiles.
+    The parts using it are its references, the blob and its files are deleted with the last one,
+    django_cleanup would delete them with the first one so it ignores both models.
+    """
+
+    digest = models.CharField(max_length=64, unique=True)  # sha256 of the uploaded file
+    image = models.ImageField(max_length=1024)
+    size = models.BigIntegerField()
+    bitonal = models.BooleanField(default=False)
+    # the master, its thumbnails and tiles are ready to be reused
+    ingested = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.digest
+
+    @property
+    def references(self):
+        return self.parts.count()
+
+    def delete_files(self):
+        remove_pyramid(pyramid_base(self.image.name))
+        # the master and its thumbnails
+        get_thumbnailer(self.image).delete(save=False)
+
+    @classmethod
+    def delete_orphan(cls, pk):
+        """
+        Deletes the blob and its files if no part uses it anymore,
+        the lock keeps a new copy of the image from reusing it meanwhile.
+        """
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(pk=pk).first()
+            if blob is not None and not blob.parts.exists():
+                blob.delete_files()
+                blob.delete()
+
+
+@cleanup.ignore
 class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
     """
     Represents a physical part of a larger document that is usually a page
+    Its files are deleted by the signals at the end of this module instead of django_cleanup,
+    they can be shared with other parts, cf ImageBlob.
     """
 
     name = models.CharField(max_length=512, blank=True)
     image = models.ImageField(upload_to=document_images_path)
     original_filename = models.CharField(max_length=1024, blank=True)
     image_file_size = models.BigIntegerField()
+    # set when the image is shared with the identical images of other parts
+    blob = models.ForeignKey(
+        ImageBlob, null=True, blank=True, on_delete=models.SET_NULL, related_name="parts"
+    )
     source = models.CharField(max_length=1024, blank=True)
-    bw_backend = models.CharField(max_length=128, default="kraken")
+    BW_BACKEND_KRAKEN = "kraken"
+    # streams the image instead of loading it in memory, cf core.binarization
+    BW_BACKEND_VIPS = "vips"
+    BW_BACKEND_CHOICES = (
+        (BW_BACKEND_KRAKEN, "Kraken"),
+        (BW_BACKEND_VIPS, _("Streaming (libvips)")),
+    )
+    bw_backend = models.CharField(max_length=128, default=BW_BACKEND_KRAKEN, choices=BW_BACKEND_CHOICES)
     bw_image = models.ImageField(
         upload_to=document_images_path,
         null=True,
@@ -911,7 +1071,10 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
     transcription_progress = models.PositiveSmallIntegerField(default=0)
 
     class Meta(OrderedModel.Meta):
-        pass
+        indexes = [
+            # uploads replace the image of the part with the same file name
+            models.Index(fields=['document', 'original_filename']),
+        ]
 
     def __str__(self):
         if self.name:
@@ -966,128 +1129,84 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
     def recalculate_ordering(self, read_direction=None):
         """
         Re-order the lines of the DocumentPart depending on read direction.
+        Lines are sorted by block (distance of the block origin to the page origin),
+        then by level inside the block (lines vertically closer than the average line height
+        of the block share a level), then by distance of the line origin to the page origin.
+        Lines without a block are placed among the blocks by the distance of their own origin.
+        Lines without geometry can't be placed, they come last in their current order.
         """
         read_direction = read_direction or self.document.read_direction
-        # imgbox = ((0, 0), (self.image.width, self.image.height))
-
-        origin_box = [
-            self.image.width if read_direction == Document.READ_DIRECTION_RTL else 0,
-            0,
-        ]
-
-        def distance(x, y):
-            return math.sqrt(sum([(a - b) ** 2 for a, b in zip(x, y)]))
+        rtl = read_direction == Document.READ_DIRECTION_RTL
+        origin = np.array([self.image.width if rtl else 0, 0], dtype=float)
 
         def poly_origin_pt(shape):
-            return min(shape, key=lambda pt: distance(pt, origin_box))
-
-        def baseline_origin_pt(baseline_, read_direction_):
-            return baseline_[
-                -1 if read_direction_ == Document.READ_DIRECTION_RTL else 0
-            ]
-
-        def line_origin_pt(line_, read_direction_):
-            return (
-                baseline_origin_pt(line_.baseline, read_direction_)
-                if line_.baseline
-                else poly_origin_pt(line_.mask)
-            )
+            pts = np.asarray(shape, dtype=float)
+            return pts[np.argmin(np.linalg.norm(pts - origin, axis=1))]
+
+        def line_origin_pt(line_):
+            if line_.baseline:
+                return line_.baseline[-1 if rtl else 0]
+            if line_.mask:
+                return poly_origin_pt(line_.mask)
+            return None
 
-        def line_block_pk(line_):
-            return line_.block.pk if line_.block else 0
-
-        def avg_line_height_column(y_origins_np, line_labels):
-            """ "Return the min of the averages line heights of the columns"""
-            labels = np.unique(line_labels)
-            line_heights_list = []
-            for label in labels:
-                y_origins_column = y_origins_np[line_labels == label]
-                column_height = (
-                    y_origins_column.max() - y_origins_column.min()
-                ) / y_origins_column.size
-                line_heights_list.append(column_height)
-            return min(line_heights_list)
-
-        def avg_line_height_block(lines_in_block, read_direction_):
+        def avg_line_height_block(origins_np):
             """Returns the average line height in the block taking into account devising number of columns
             based on x lines origins clustering. Key parameters of the algorithm:
             x_cluster: tolerance used to gather lines in a column
             line_height_decrease: scaling factor to avoid over gathering of lines"""
             x_cluster, line_height_decrease = 0.1, 0.8
 
-            origins_np = np.array(
-                list(map(lambda line: line_origin_pt(line, read_direction_), lines_in_block))
-            )
-
             # Devise the number of columns by performing DBSCAN clustering on x coordinate of line origins
-            x_origins_np = origins_np[:, 0].reshape(-1, 1)
-            scaler = preprocessing.MinMaxScaler()
-            scaler.fit(x_origins_np)
-            x_scaled = scaler.transform(x_origins_np)
-            clustering = DBSCAN(eps=x_cluster)
-            clustering.fit(x_scaled)
-
-            # Compute the average line size based on the guessed number of columns
-            y_origins_np = origins_np[:, 1]
-            return (
-                avg_line_height_column(y_origins_np, clustering.labels_)
-                * line_height_decrease
-            )
-
-        def avg_lines_heights_dict(lines, read_direction_):
-            """Returns a dictionary with block.pk (or 0 if None) as keys and average lines height
-            in the block as values"""
-            sorted_by_block = sorted(lines, key=line_block_pk)
-            organized_by_block = itertools.groupby(sorted_by_block, key=line_block_pk)
+            x_scaled = preprocessing.MinMaxScaler().fit_transform(origins_np[:, :1])
+            labels = DBSCAN(eps=x_cluster).fit(x_scaled).labels_
 
-            avg_heights = {}
-            for block_pk, lines_in_block in organized_by_block:
-                avg_heights[block_pk] = avg_line_height_block(
-                    lines_in_block, read_direction_
-                )
-            return avg_heights
+            # Compute the average line size based on the guessed number of columns,
+            # the min of the averages line heights of the columns
+            y_origins_np = origins_np[:, 1]
+            return min(
+                np.ptp(y_origins_np[labels == label]) / np.count_nonzero(labels == label)
+                for label in np.unique(labels)
+            ) * line_height_decrease
 
-        # fetch all lines and regroup them by block
-        qs = self.lines.select_related("block").all()
-        ls = list(qs)
+        ls = list(self.lines.select_related("block").all())
         if len(ls) == 0:
             return
 
-        dict_avg_heights = avg_lines_heights_dict(ls, read_direction)
+        line_origins = [line_origin_pt(line) for line in ls]
+        invalid = sorted((line for line, pt in zip(ls, line_origins) if pt is None), key=lambda line: line.order)
+        ls = [line for line, pt in zip(ls, line_origins) if pt is not None]
+        if not ls:
+            return
+
+        origins = np.array([pt for pt in line_origins if pt is not None], dtype=float)
+        distances = np.linalg.norm(origins - origin, axis=1)
+        block_pks = np.array([line.block_id or 0 for line in ls])
+        block_distances = np.empty(len(ls))
+        levels = np.zeros(len(ls), dtype=int)
 
-        def cmp_lines(a, b):
-            # cache origin pts for efficiency
-            if not hasattr(a, "origin_pt"):
-                a.origin_pt = line_origin_pt(a, read_direction)
-            if not hasattr(b, "origin_pt"):
-                b.origin_pt = line_origin_pt(b, read_direction)
+        for block_pk in np.unique(block_pks):
+            idx = np.flatnonzero(block_pks == block_pk)
+            if block_pk:
+                block_distances[idx] = np.linalg.norm(poly_origin_pt(ls[idx[0]].block.box) - origin)
+            else:
+                block_distances[idx] = distances[idx]
 
-            try:
-                if a.block != b.block:
-                    pt1 = poly_origin_pt(a.block.box) if a.block else a.origin_pt
-                    pt2 = poly_origin_pt(b.block.box) if b.block else b.origin_pt
+            # a new level starts when a line is lower than the previous one by more than the average height
+            avg_height = avg_line_height_block(origins[idx])
+            by_y = np.argsort(origins[idx, 1], kind="stable")
+            levels[idx[by_y]] = np.concatenate(
+                ([0], np.cumsum(np.diff(origins[idx[by_y], 1]) >= avg_height)))
 
-                    # when comparing blocks we can use the distance
-                    return distance(pt1, origin_box) - distance(pt2, origin_box)
-                else:
-                    pt1 = a.origin_pt
-                    pt2 = b.origin_pt
-
-                    # # 2 lines more or less on the same level
-                    avg_height = dict_avg_heights[line_block_pk(a)]
-                    if abs(pt1[1] - pt2[1]) < avg_height:
-                        return distance(pt1, origin_box) - distance(pt2, origin_box)
-                return pt1[1] - pt2[1]
-            except TypeError:  # invalid line
-                return 0
-
-        # sort depending on the distance to the origin
-        ls.sort(key=functools.cmp_to_key(lambda a, b: cmp_lines(a, b)))
-        # one query / line, super gory
-        for order, line in enumerate(ls):
+        # last key is the primary one
+        sorted_idx = np.lexsort((distances, levels, block_pks, block_distances))
+
+        to_update = []
+        for order, line in enumerate([ls[i] for i in sorted_idx] + invalid):
             if line.order != order:
                 line.order = order
-                line.save()
+                to_update.append(line)
+        Line.objects.bulk_update(to_update, ["order"])
 
     def save(self, *args, **kwargs):
         new = self.pk is None
@@ -1147,6 +1266,7 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
     def cancel_tasks(self, username=None):
         uncancelable = [
             "core.tasks.convert",
+            "core.tasks.ingest",
             "core.tasks.lossless_compression",
             "core.tasks.generate_part_thumbnails",
         ]
@@ -1160,18 +1280,33 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
 
         for report in self.reports.all():
             if report.method not in uncancelable and report.workflow_state not in TASK_FINAL_STATES:
+                canceled = [report]
                 if report.task_id:  # if not, it is still pending
-                    report.cancel(username)
-
-                try:
-                    send_event('document', self.document.pk, 'part:workflow',
-                               {'id': self.id,
-                                'process': report.method.split('.')[-1],
-                                'status': 'error',
-                                'reason': _('Canceled.')})
-                except Exception as e:
-                    # don't crash on websocket error
-                    logger.exception(e)
+                    # the reports of the other parts of a batch, cf Document.queue_batch
+                    batch = list(TaskReport.objects
+                                 .filter(task_id=report.task_id, document_part__isnull=False)
+                                 .exclude(pk=report.pk)
+                                 .exclude(workflow_state__in=TASK_FINAL_STATES))
+                    if batch and report.workflow_state == TaskReport.WORKFLOW_STATE_QUEUED:
+                        # the batch skips the part when it gets to it
+                        report.cancel(username, revoke=False)
+                    else:
+                        # stopping the batch cancels its remaining parts too
+                        report.cancel(username)
+                        for other in batch:
+                            other.cancel(username, revoke=False)
+                        canceled += batch
+
+                for canceled_report in canceled:
+                    try:
+                        send_event('document', self.document.pk, 'part:workflow',
+                                   {'id': canceled_report.document_part_id,
+                                    'process': canceled_report.method.split('.')[-1],
+                                    'status': 'error',
+                                    'reason': _('Canceled.')})
+                    except Exception as e:
+                        # don't crash on websocket error
+                        logger.exception(e)
 
     def recoverable(self):
         now = round(datetime.utcnow().timestamp())
@@ -1189,6 +1324,10 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                 self.WORKFLOW_STATE_CONVERTING,
                 self.WORKFLOW_STATE_CREATED,
             ),
+            "core.tasks.ingest": (
+                self.WORKFLOW_STATE_CONVERTING,
+                self.WORKFLOW_STATE_CREATED,
+            ),
             "core.tasks.segment": (
                 self.WORKFLOW_STATE_SEGMENTING,
                 self.WORKFLOW_STATE_CONVERTED,
@@ -1257,27 +1396,205 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
             self.image_file_size = self.image.size
             self.save()
 
-    def binarize(self, threshold=None):
-        fname = os.path.basename(self.image.file.name)
-        # should be formatted to png already by lossless_compression but better safe than sorry
-        form = None
-        f_, ext = os.path.splitext(self.image.file.name)
-        if ext[1] in [".jpg", ".jpeg", ".JPG", ".JPEG", ""]:
-            if ext:
-                logger.warning("jpeg does not support 1bpp images. Forcing to png.")
-            form = "png"
-            fname = "%s.%s" % (f_, form)
-        bw_file_name = "bw_" + fname
-        bw_file = os.path.join(os.path.dirname(self.image.file.name), bw_file_name)
-        with Image.open(self.image.path) as im:
-            # threshold, zoom, escale, border, perc, range, low, high
-            if threshold is not None:
-                res = nlbin(im, threshold)
+    def deduplicate(self):
+        """
+        Shares the image of the part with the parts whose image has the same content, cf ImageBlob.
+        If an identical image was already ingested the part uses its master, thumbnails
+        and tiles and its own copy is deleted, otherwise its image is moved to the
+        content-addressed store for the next copies to use it.
+        Returns True if an already ingested image is reused.
+        """
+        if self.blob_id:
+            if self.image.name == self.blob.image.name:
+                return self.blob.ingested
+            # the image was replaced since
+            self.detach_image()
+
+        path = self.image.path
+        digest = file_digest(path)
+        with transaction.atomic():
+            blob, created = ImageBlob.objects.select_for_update().get_or_create(
+                digest=digest,
+                defaults={"image": image_store_name(digest, os.path.splitext(path)[1]),
+                          "size": os.path.getsize(path)})
+            if created:
+                store_path = os.path.join(settings.MEDIA_ROOT, blob.image.name)
+                makedirs(os.path.dirname(store_path), exist_ok=True)
+                os.rename(path, store_path)
+            elif blob.ingested:
+                # quotas account for the size of the shared image
+                self.image_file_size = blob.size
+                if blob.bitonal:
+                    self.bw_image = blob.image.name
             else:
-                res = nlbin(im)
-            res.save(bw_file, format=form)
+                # the same image is being ingested for another part right now, keep this copy
+                return False
 
-        self.bw_image = document_images_path(self, bw_file_name)
+            # the copy of the part is deleted once it uses the blob, cf delete_replaced_files
+            self.image = blob.image.name
+            self.blob = blob
+            try:
+                self.save()
+            except Exception:
+                if created:
+                    os.rename(store_path, path)
+                raise
+
+        return not created
+
+    def detach_image(self):
+        """
+        Stops sharing the image of the part, before it gets modified or after it was replaced.
+        The part gets its own copy of the image, the files of the store only belong to the blob,
+        which is deleted if no other part uses it.
+        """
+        if not self.blob_id:
+            return
+        blob_pk = self.blob_id
+        with transaction.atomic():
+            if in_image_store(self.image.name):
+                name = self.image.storage.save(
+                    document_images_path(self, os.path.basename(self.image.name)), self.image)
+                self.image.close()
+                if self.bw_image and self.bw_image.name == self.image.name:
+                    self.bw_image = name
+                self.image = name
+            if in_image_store(self.bw_image.name):
+                # a binarization of a master that was replaced since
+                self.bw_image = None
+            self.blob = None
+            self.save()
+            ImageBlob.delete_orphan(blob_pk)
+
+    def ingest(self):
+        """
+        Does the work of convert(), compress() and the thumbnails generation
+        in a single process, decoding the image once, and writes the tiles of
+        the image if settings.IMAGE_PYRAMIDS is set.
+        An image identical to an already ingested one reuses its files instead
+        if settings.IMAGE_DEDUPLICATION is set, cf deduplicate().
+        Returns the duration of each stage, in seconds.
+        """
+        always_convert = getattr(settings, "ALWAYS_CONVERT", False)
+        timer = StageTimer()
+        if always_convert and self.workflow_state < self.WORKFLOW_STATE_CONVERTING:
+            self.workflow_state = self.WORKFLOW_STATE_CONVERTING
+            self.save()
+
+        reused = False
+        if getattr(settings, "IMAGE_DEDUPLICATION", False):
+            with timer.stage("deduplicate"):
+                reused = self.deduplicate()
+
+        old_name = self.image.path
+        filename, extension = os.path.splitext(old_name)
+        # a reused master is already converted and compressed
+        convert = not reused and always_convert and extension.lower() != ".png"
+        compress = (not reused and getattr(settings, "COMPRESS_ENABLE", True)
+                    and extension.lower() == ".png")
+        bitonal = not reused and always_convert
+        thumbnails = getattr(settings, "THUMBNAIL_ENABLE", True)
+        pyramid = getattr(settings, "IMAGE_PYRAMIDS", False) and not (
+            reused and read_pyramid(pyramid_base(self.image.name), old_name))
+
+        image = None
+        if convert or compress or bitonal or pyramid or (thumbnails and not reused):
+            with timer.stage("decode"):
+                image = pyvips.Image.new_from_file(old_name).copy_memory()
+
+        changed = always_convert
+        if convert:
+            with timer.stage("convert"):
+                new_name = filename + ".png"
+                image.pngsave(new_name, compression=9)
+                self.image = new_name.split(settings.MEDIA_ROOT)[1][1:]
+                self.image_file_size = os.path.getsize(new_name)
+                os.remove(old_name)
+                changed = True
+        elif compress:
+            with timer.stage("compress"):
+                opti_name = filename + "_opti.png"
+                image.pngsave(opti_name, compression=9)
+                # lossless, only worth it if smaller
+                if os.path.getsize(opti_name) < os.path.getsize(old_name):
+                    os.rename(opti_name, old_name)
+                    self.image_file_size = os.path.getsize(old_name)
+                    changed = True
+                else:
+                    os.remove(opti_name)
+
+        if bitonal:
+            with timer.stage("bitonal"):
+                if image_is_bitonal(image):
+                    self.bw_image = self.image.name
+        if always_convert and self.workflow_state < self.WORKFLOW_STATE_CONVERTED:
+            self.workflow_state = self.WORKFLOW_STATE_CONVERTED
+        if changed:
+            self.save()
+
+        if thumbnails:
+            # after the master is written, easy_thumbnails considers older thumbnails stale
+            with timer.stage("thumbnails"):
+                if reused:
+                    # only the missing ones are generated
+                    thumbnailer = get_thumbnailer(self.image)
+                    urls = {alias: thumbnailer[alias].url for alias in settings.THUMBNAIL_ALIASES[""]}
+                else:
+                    urls = save_thumbnails(self.image, image)
+            send_event("document", self.document_id, "part:workflow", {
+                "id": self.pk,
+                "process": "generate_part_thumbnails",
+                "status": "done",
+                "data": urls
+            })
+
+        if pyramid:
+            with timer.stage("pyramid"):
+                save_pyramid(image, pyramid_base(self.image.name))
+
+        if self.blob_id and not reused:
+            # the next copies of the image can use its files
+            ImageBlob.objects.filter(pk=self.blob_id).update(
+                image=self.image.name,
+                size=self.image_file_size,
+                bitonal=bool(self.bw_image) and self.bw_image.name == self.image.name,
+                ingested=True)
+
+        logger.info("Ingested part %d in %s", self.pk, timer.timings)
+        return timer.timings
+
+    def bw_image_name(self, png=False):
+        """
+        Name in the storage of the binarized image, next to the images of the document
+        as the image itself might be shared with other parts.
+        """
+        fname = os.path.basename(self.image.name)
+        base, extension = os.path.splitext(fname)
+        # jpeg does not support 1bpp images
+        if png or extension.lower() in (".jpg", ".jpeg", ""):
+            fname = base + ".png"
+        if in_image_store(self.image.name):
+            # parts of the same document can share the image
+            fname = "%d_%s" % (self.pk, fname)
+        return document_images_path(self, "bw_" + fname)
+
+    def binarize(self, threshold=None):
+        vips = self.bw_backend == self.BW_BACKEND_VIPS
+        bw_name = self.bw_image_name(png=vips)
+        bw_file = os.path.join(settings.MEDIA_ROOT, bw_name)
+        makedirs(os.path.dirname(bw_file), exist_ok=True)
+        if vips:
+            vips_binarize(self.image.path, bw_file, threshold=threshold)
+        else:
+            with Image.open(self.image.path) as im:
+                # threshold, zoom, escale, border, perc, range, low, high
+                if threshold is not None:
+                    res = nlbin(im, threshold)
+                else:
+                    res = nlbin(im)
+                res.save(bw_file)
+
+        self.bw_image = bw_name
         self.save()
 
     def segment(
@@ -1287,9 +1604,12 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         read_direction=None,
         model=None,
         override=False,
+        image=None,
     ):
         """
         steps: lines regions masks
+        image: an already opened (and possibly decoded) PIL image of the part,
+               it is left open for the caller to close.
         """
         self.workflow_state = self.WORKFLOW_STATE_SEGMENTING
         self.save()
@@ -1298,12 +1618,12 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
             model_path = model.file.path
         else:
             model_path = SEGMENTATION_DEFAULT_MODEL
-        model_ = vgsl.TorchVGSLModel.load_model(model_path)
+        model_ = load_segmentation_model(model_path)
 
         # TODO: check model_type [None, 'recognition', 'segmentation']
         #    &  seg_type [None, 'bbox', 'baselines']
 
-        im = Image.open(self.image.file.name)
+        im = image if image is not None else open_page_image(self.image.path)
         # will be fixed sometime in the future
         # if model_.one_channel_mode == '1':
         #     # TODO: need to binarize, probably not live...
@@ -1322,6 +1642,9 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         if text_direction:
             options["text_direction"] = text_direction
 
+        # inference happens outside of the transaction to keep it short
+        res = blla.segment(im, **options)
+
         with transaction.atomic():
             # cleanup pre-existing
             if steps in ["lines", "both"] and override:
@@ -1329,61 +1652,91 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
             if steps in ["regions", "both"] and override:
                 self.blocks.all().delete()
 
-            res = blla.segment(im, **options)
-
             if steps in ["regions", "both"]:
+                block_types = self._typologies_map(
+                    self.document.valid_block_types, BlockType, res.regions.keys())
+                order = self._next_order(self.blocks.all())
+                blocks = []
                 for region_type, regions in res.regions.items():
-                    try:
-                        typo, created = self.document.valid_block_types.get_or_create(
-                            name=region_type)
-                    except BlockType.MultipleObjectsReturned:
-                        # Note: this should not happen if the modelisation was alright
-                        # but for now we hack
-                        typo = self.document.valid_block_types.filter(name=region_type)[0]
                     for region in regions:
-                        Block.objects.create(
+                        block = Block(
                             document_part=self,
-                            typology=typo,
+                            typology=block_types[region_type],
                             box=region.boundary,
+                            order=order,
                         )
+                        block.make_external_id()
+                        blocks.append(block)
+                        order += 1
+                Block.objects.bulk_create(blocks)
 
-            regions = self.blocks.all()
             if steps in ["lines", "both"]:
+                regions = list(self.blocks.all())
+                tree = STRtree([Polygon(r.box) for r in regions]) if regions else None
+                line_types = self._typologies_map(
+                    self.document.valid_line_types, LineType,
+                    {line.tags.get("type") for line in res.lines})
+                order = self._next_order(self.lines.all())
+                lines = []
                 for line in res.lines:
-                    mask = line.boundary if line.boundary is not None else None
-                    baseline = line.baseline
-
                     # calculate if the center of the line is contained in one of the region
                     # (pick the first one that matches)
-                    center = LineString(baseline).interpolate(0.5, normalized=True)
-                    region = next(
-                        (r for r in regions if Polygon(r.box).contains(center)), None
-                    )
-                    try:
-                        typo, created = self.document.valid_line_types.get_or_create(
-                            name=line.tags.get("type"))
-                    except LineType.MultipleObjectsReturned:
-                        # Note: this should not happen if the modelisation was alright
-                        # but for now we hack
-                        typo = self.document.valid_line_types.filter(name=line.tags.get("type"))[0]
-                    Line.objects.create(
+                    region = None
+                    if tree is not None:
+                        center = LineString(line.baseline).interpolate(0.5, normalized=True)
+                        matches = tree.query(center, predicate="within")
+                        if len(matches):
+                            region = regions[min(matches)]
+                    new_line = Line(
                         document_part=self,
-                        typology=typo,
+                        typology=line_types[line.tags.get("type")],
                         block=region,
-                        baseline=baseline,
-                        mask=mask,
+                        baseline=line.baseline,
+                        mask=line.boundary,
+                        order=order,
                     )
-
-        im.close()
+                    new_line.make_external_id()
+                    lines.append(new_line)
+                    order += 1
+                Line.objects.bulk_create(lines)
 
         self.workflow_state = self.WORKFLOW_STATE_SEGMENTED
         self.save()
         self.recalculate_ordering(read_direction=read_direction)
 
-    def transcribe(self, model, transcription, text_direction=None, user=None):
-        model_ = kraken_models.load_any(model.file.path)
+    @staticmethod
+    def _typologies_map(valid_types, typology_class, names):
+        """
+        Returns a {name: typology} dict, fetching or creating (and linking) each typology only once.
+        """
+        typologies = {}
+        for name in set(names):
+            try:
+                typologies[name], created = valid_types.get_or_create(name=name)
+            except typology_class.MultipleObjectsReturned:
+                # Note: this should not happen if the modelisation was alright
+                # but for now we hack
+                typologies[name] = valid_types.filter(name=name)[0]
+        return typologies
+
+    @staticmethod
+    def _next_order(qs):
+        # OrderedModel.save is bypassed by bulk_create, so we have to number the objects ourselves
+        max_order = qs.aggregate(Max("order"))["order__max"]
+        return 0 if max_order is None else max_order + 1
+
+    def transcribe(self, model, transcription, text_direction=None, user=None, batch_size=None, image=None):
+        """
+        Recognizes all the lines of the part with the given model.
+        Lines are fed to the recognizer in batches of batch_size
+        (defaults to settings.KRAKEN_RECOGNITION_BATCH_SIZE, 0 means the whole page at once)
+        and the results are written back with bulk operations.
+        An already opened image can be passed to avoid reading it again, it is not closed.
+        """
+        model_ = load_recognition_model(model.file.path)
 
-        lines = self.lines.all()
+        # bypass lines without baseline
+        lines = [line for line in self.lines.all() if line.baseline]
         text_direction = (
             text_direction
             or (self.document.main_script and self.document.main_script.text_direction)
@@ -1397,21 +1750,29 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         else:
             reorder = 'L'
 
-        with Image.open(self.image.file.name) as im:
-            line_confidences = []
-            for line in lines:
-                if not line.baseline:
-                    # bypass lines without baseline
-                    continue
-                else:
-                    bll = BaselineLine(id='foo',
-                                       baseline=line.baseline,
-                                       boundary=line.mask)
-                    seg = Segmentation(type='baselines',
-                                       imagename='/dummy.png',
-                                       text_direction=text_direction,
-                                       script_detection=False,
-                                       lines=[bll])
+        batch_size = (batch_size
+                      or getattr(settings, 'KRAKEN_RECOGNITION_BATCH_SIZE', 0)
+                      or len(lines)
+                      or 1)
+
+        existing = {
+            lt.line_id: lt for lt in
+            LineTranscription.objects.filter(line__in=lines, transcription=transcription)
+        }
+        to_create, to_update = [], []
+        line_confidences = []
+
+        with nullcontext(image if image is not None else open_page_image(self.image.path)) as im:
+            for i in range(0, len(lines), batch_size):
+                batch = lines[i:i + batch_size]
+                seg = Segmentation(type='baselines',
+                                   imagename='/dummy.png',
+                                   text_direction=text_direction,
+                                   script_detection=False,
+                                   lines=[BaselineLine(id=str(line.pk),
+                                                       baseline=line.baseline,
+                                                       boundary=line.mask)
+                                          for line in batch])
 
                 it = rpred.rpred(
                     model_,
@@ -1420,17 +1781,23 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                     pad=16,
                     bidi_reordering=reorder
                 )
-                lt, created = LineTranscription.objects.get_or_create(
-                    line=line, transcription=transcription
-                )
-
-                if not created:
-                    lt.new_version()
 
-                lt.version_author = user and user.username or ''
-                lt.version_source = 'kraken:' + model.name
+                # rpred yields exactly one record per line, in order
+                for line, pred in zip(batch, it):
+                    lt = existing.get(line.pk)
+                    if lt is None:
+                        lt = LineTranscription(line=line, transcription=transcription)
+                        to_create.append(lt)
+                    else:
+                        try:
+                            lt.new_version()
+                        except NoChangeException:
+                            pass
+                        to_update.append(lt)
+
+                    lt.version_author = user and user.username or ''
+                    lt.version_source = 'kraken:' + model.name
 
-                for pred in it:
                     lt.content = pred.prediction
                     lt.graphs = [{
                         'c': letter,
@@ -1438,12 +1805,19 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                         'confidence': float(confidence)
                     } for letter, poly, confidence in zip(
                         pred.prediction, pred.cuts, pred.confidences)]
-                if lt.graphs:
-                    line_avg_confidence = mean([graph['confidence'] for graph in lt.graphs if "confidence" in graph])
-                    lt.avg_confidence = line_avg_confidence
-                    line_confidences.append(line_avg_confidence)
+                    if lt.graphs:
+                        line_avg_confidence = mean([graph['confidence'] for graph in lt.graphs if "confidence" in graph])
+                        lt.avg_confidence = line_avg_confidence
+                        line_confidences.append(line_avg_confidence)
+
+        with transaction.atomic():
+            LineTranscription.objects.bulk_create(to_create)
+            LineTranscription.objects.bulk_update(to_update, [
+                'content', 'graphs', 'avg_confidence',
+                'versions', 'revision', 'version_author', 'version_source',
+                'version_created_at', 'version_updated_at',
+            ])
 
-                lt.save()
         if line_confidences:
             # calculate and set all avg confidence values on models
             avg_line_confidence = mean(line_confidences)
@@ -1456,7 +1830,7 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         self.save()
 
         # overall avg recalculations; may use DB aggregation so run after self.save()
-        if line_confidences and not created:
+        if line_confidences and to_update:
             # if new line_confidences have been added to existing transcription,
             # then recalculate average confidence across the transcription
             lines_with_confidence = transcription.linetranscription_set.filter(avg_confidence__isnull=False)
@@ -1477,14 +1851,8 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         tasks = []
 
         if task_name == 'convert' or self.workflow_state < self.WORKFLOW_STATE_CONVERTED:
-            sig = convert.si(instance_pk=self.pk, **kwargs)
-
-            if getattr(settings, 'THUMBNAIL_ENABLE', True):
-                sig.link(chain(lossless_compression.si(instance_pk=self.pk, **kwargs),
-                               generate_part_thumbnails.si(instance_pk=self.pk, **kwargs)))
-            else:
-                sig.link(lossless_compression.si(instance_pk=self.pk, **kwargs))
-            tasks.append(sig)
+            # a single pass, the thumbnails are pushed to the client
+            tasks.append(ingest.si(instance_pk=self.pk, **kwargs))
 
         if task_name == 'binarize':
             tasks.append(binarize.si(instance_pk=self.pk,
@@ -1513,33 +1881,36 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         return tasks
 
     def make_masks(self, only=None):
-        im = Image.open(self.image).convert("L")
-        lines = list(self.lines.filter(baseline__isnull=False))
-        to_calc = [line for line in lines if (only and line.pk in only) or (only is None)]
+        """
+        Computes the masks of the lines (or only the ones whose pk are in only),
+        using the neighbouring baselines and the line's region as context.
+        """
+        lines = list(self.lines.select_related("block").filter(baseline__isnull=False))
+        indices = [i for i, line in enumerate(lines) if (only and line.pk in only) or (only is None)]
+        to_calc = [lines[i] for i in indices]
+        if not to_calc:
+            return to_calc
+
+        if self.document.line_offset == Document.LINE_OFFSET_TOPLINE:
+            topline = True
+        elif self.document.line_offset == Document.LINE_OFFSET_CENTERLINE:
+            topline = None
+        else:
+            topline = False
 
-        for line in to_calc:
-            context = [line_.baseline for line_ in lines if line_.pk != line.pk]
+        jobs = []
+        for line, neighbours_ in zip(to_calc, neighbours([line.baseline for line in lines], indices)):
+            context = [lines[i].baseline for i in neighbours_]
             if line.block:
-                poly = line.block.box
-                poly.append(line.block.box[0])  # close it
-                context.append(poly)
-
-            if self.document.line_offset == Document.LINE_OFFSET_TOPLINE:
-                topline = True
-            elif self.document.line_offset == Document.LINE_OFFSET_CENTERLINE:
-                topline = None
-            else:
-                topline = False
+                context.append(line.block.box + [line.block.box[0]])  # close it
+            jobs.append((line.baseline, context, topline))
 
-            mask = calculate_polygonal_environment(
-                im, [line.baseline], suppl_obj=context, scale=(1200, 0), topline=topline
-            )
-            if mask[0]:
-                if len(mask[0]) > 50:
-                    line.mask = approximate_polygon(np.array(mask[0]), 2).tolist()
-                else:
-                    line.mask = mask[0]
-                line.save()
+        updated = []
+        for line, mask in zip(to_calc, compute_masks(self.image.path, jobs)):
+            if mask:
+                line.mask = mask
+                updated.append(line)
+        Line.objects.bulk_update(updated, ["mask"])
 
         return to_calc
 
@@ -1549,6 +1920,7 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         images, lines and regions.
         Changes the file system image path to deal with browser cache.
         """
+        self.detach_image()
         angle_match = re.search(r"_rot(\d+)", self.image.name)
         old_angle = angle_match and int(angle_match.group(1)) or 0
         new_angle = (old_angle + angle) % 360
@@ -1568,30 +1940,26 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
                 new_name = f"{name}_rot{new_angle}{ext}"
             return new_name
 
-        # rotate image
-        with Image.open(self.image.file.name) as im:
-            # store center point while it's open with old bounds
-            center = (im.width / 2, im.height / 2)
-            rim = im.rotate(360 - angle, expand=True, fillcolor=None)
+        # rotate image, pyvips streams it instead of holding the whole raster and its rotated copy
+        im = pyvips.Image.new_from_file(self.image.file.name)
+        # store center point with old bounds
+        center = (im.width / 2, im.height / 2)
+        rim = self._vips_rotate(im, angle)
 
-            # the image size is shifted so we need to calculate by which offset
-            # to update points accordingly
-            new_center = (rim.width / 2, rim.height / 2)
-            offset = (center[0] - new_center[0], center[1] - new_center[1])
+        # the image size is shifted so we need to calculate by which offset
+        # to update points accordingly
+        new_center = (rim.width / 2, rim.height / 2)
 
-            # Note: self.image.file.name (full path) != self.image.name (relative path)
-            rim.save(update_name(self.image.file.name))
-            rim.close()
-            # save the updated file name in db
-            self.image = update_name(self.image.name)
+        # Note: self.image.file.name (full path) != self.image.name (relative path)
+        rim.write_to_file(update_name(self.image.file.name))
+        # save the updated file name in db
+        self.image = update_name(self.image.name)
 
         # rotate bw image
         if self.bw_image:
-            with Image.open(self.bw_image.file.name) as im:
-                rim = im.rotate(360 - angle, expand=True)
-                rim.save(update_name(self.bw_image.file.name))
-                rim.close()
-                self.bw_image = update_name(self.bw_image.name)
+            im = pyvips.Image.new_from_file(self.bw_image.file.name)
+            self._vips_rotate(im, angle).write_to_file(update_name(self.bw_image.file.name))
+            self.bw_image = update_name(self.bw_image.name)
 
         self.save()
 
@@ -1601,67 +1969,90 @@ class DocumentPart(ExportModelOperationsMixin("DocumentPart"), OrderedModel):
         )
         generate_part_thumbnails.delay(instance_pk=self.pk)
 
-        # rotate lines
-        for line in self.lines.all():
+        # rotate lines, regions and image annotations around the old center
+        # and move them to the new one
+        theta = math.radians(angle)
+        cos, sin = math.cos(theta), math.sin(theta)
+        self._transform_geometries(np.array([
+            [cos, -sin, new_center[0] - cos * center[0] + sin * center[1]],
+            [sin, cos, new_center[1] - sin * center[0] - cos * center[1]],
+        ]))
+
+    @staticmethod
+    def _vips_rotate(im, angle):
+        angle = angle % 360
+        if angle in (90, 180, 270):
+            # lossless
+            return im.rot("d%d" % angle)
+        # similarity rotates clockwise and expands the output to contain the whole image
+        return im.similarity(angle=angle, interpolate=pyvips.Interpolate.new("nearest"))
+
+    def _transform_geometries(self, matrix):
+        """
+        Applies the 2x3 affine transformation matrix to all the lines, regions
+        and image annotations of the part at once, and saves them in bulk.
+        """
+        lines = list(self.lines.all())
+        blocks = list(self.blocks.all())
+        annotations = list(self.imageannotation_set.all())
+
+        polygons = ([line.baseline for line in lines if line.baseline]
+                    + [line.mask for line in lines if line.mask]
+                    + [block.box for block in blocks]
+                    + [annotation.coordinates for annotation in annotations])
+        if not polygons:
+            return
+
+        lengths = [len(polygon) for polygon in polygons]
+        points = np.array([point[:2] for polygon in polygons for point in polygon], dtype=float)
+        # round first so that float errors of the rotation don't get truncated to the wrong integer
+        points = np.trunc(np.round(points @ matrix[:, :2].T + matrix[:, 2], 6)).astype(int)
+        transformed = iter(np.split(points, np.cumsum(lengths)[:-1]))
+
+        for line in lines:
             if line.baseline:
-                poly = affinity.rotate(LineString(line.baseline), angle, origin=center)
-                line.baseline = [
-                    (int(x - offset[0]), int(y - offset[1])) for x, y in poly.coords
-                ]
+                line.baseline = next(transformed).tolist()
+        for line in lines:
             if line.mask:
-                poly = affinity.rotate(Polygon(line.mask), angle, origin=center)
-                line.mask = [
-                    (int(x - offset[0]), int(y - offset[1]))
-                    for x, y in poly.exterior.coords
-                ]
-            line.save()
-
-        # rotate regions
-        for region in self.blocks.all():
-            poly = affinity.rotate(Polygon(region.box), angle, origin=center)
-            region.box = [
-                (int(x - offset[0]), int(y - offset[1]))
-                for x, y in poly.exterior.coords
-            ]
-            region.save()
-
-        # rotate img annotations
-        for annotation in self.imageannotation_set.prefetch_related('taxonomy'):
-            poly = affinity.rotate(Polygon(annotation.coordinates), angle, origin=center)
-            annotation.coordinates = [
-                (int(x - offset[0]), int(y - offset[1]))
-                for x, y in poly.exterior.coords
-            ]
+                line.mask = next(transformed).tolist()
+        for block in blocks:
+            block.box = next(transformed).tolist()
+        for annotation in annotations:
+            annotation.coordinates = next(transformed).tolist()
 
-            annotation.save()
+        with transaction.atomic():
+            Line.objects.bulk_update(lines, ["baseline", "mask"])
+            Block.objects.bulk_update(blocks, ["box"])
+            ImageAnnotation.objects.bulk_update(annotations, ["coordinates"])
 
     def crop(self, x1, y1, x2, y2):
         """
         Crops the image outside the rectangle defined
         by top left (x1, y1) and bottom right (x2, y2) points.
-        Moves the lines and regions accordingly.
+        Moves the lines, regions and image annotations accordingly.
         """
-        with Image.open(self.image.file.name) as im:
-            cim = im.crop((x1, y1, x2, y2))
-            cim.save(self.image.file.name)
-            cim.close()
-
+        x1, y1, x2, y2 = (int(float(v)) for v in (x1, y1, x2, y2))
+        # the image is cropped in place
+        self.detach_image()
+
+        def crop_file(fpath):
+            im = pyvips.Image.new_from_file(fpath, access="sequential")
+            # pad with black like PIL does if the rectangle goes over the borders
+            cim = im.embed(-x1, -y1, x2 - x1, y2 - y1)
+            # can't stream into the file we are reading from
+            base, ext = os.path.splitext(fpath)
+            tmp_path = base + ".crop" + ext
+            cim.write_to_file(tmp_path)
+            os.replace(tmp_path, fpath)
+
+        crop_file(self.image.file.name)
         if self.bw_image:
-            with Image.open(self.image.file.name) as im:
-                cim = im.crop((x1, y1, x2, y2))
-                cim.save(self.image.file.name)
-                cim.close()
+            crop_file(self.bw_image.file.name)
 
-        for line in self.lines.all():
-            if line.baseline:
-                line.baseline = [(int(x - x1), int(y - y1)) for x, y in line.baseline]
-            if line.mask:
-                line.mask = [(int(x - x1), int(y - y1)) for x, y in line.mask]
-            line.save()
-
-        for region in self.blocks.all():
-            region.box = [(int(x - x1), int(y - y1)) for x, y in region.box]
-            region.save()
+        self._transform_geometries(np.array([
+            [1, 0, -x1],
+            [0, 1, -y1],
+        ]))
 
     def enforce_line_order(self):
         # django-ordered-model doesn't care about unicity and linearity...
@@ -2096,6 +2487,7 @@ class OcrModel(ExportModelOperationsMixin("OcrModel"), Versioned, models.Model):
         os.rename(current_filename, tmp_filename)
         os.rename(target_filename, current_filename)
         os.rename(tmp_filename, target_filename)
+        model_cache.invalidate(current_filename)
         super().revert(revision)
 
     def delete_revision(self, revision):
@@ -2179,9 +2571,48 @@ class TextualWitness(models.Model):
         return f"{self.name} (id: {self.pk})"
 
 
+def _file_names(part):
+    # the fields deferred by only() or defer() are left out, reading them would query them
+    names = {}
+    for field in ("image", "bw_image"):
+        if field in part.__dict__:
+            value = part.__dict__[field]
+            names[field] = getattr(value, "name", value) or None
+    return names
+
+
+@receiver(post_init, sender=DocumentPart, dispatch_uid="files_init_signal")
+def remember_files(sender, instance, **kwargs):
+    instance._stored_file_names = _file_names(instance)
+
+
+@receiver(post_save, sender=DocumentPart, dispatch_uid="replaced_files_delete_signal")
+def delete_replaced_files(sender, instance, created, raw, using, update_fields=None, **kwargs):
+    """
+    Deletes the files the part doesn't use anymore once the transaction is committed,
+    like django_cleanup, except for the files of the image store.
+    """
+    names = {field: name for field, name in _file_names(instance).items()
+             if update_fields is None or field in update_fields}
+    replaced = set()
+    if not created and not raw:
+        used = set(_file_names(instance).values())
+        replaced = {name for field, name in instance._stored_file_names.items()
+                    if field in names and name and name not in used and not in_image_store(name)}
+    instance._stored_file_names.update(names)
+    if replaced:
+        storage = instance.image.storage
+        transaction.on_commit(lambda: [storage.delete(name) for name in replaced], using=using)
+
+
 @receiver(pre_delete, sender=DocumentPart, dispatch_uid="thumbnails_delete_signal")
 def delete_thumbnails(sender, instance, using, **kwargs):
-    thumbnailer = get_thumbnailer(instance.image)
-    thumbnailer.delete()
-    thumbnailer = get_thumbnailer(instance.bw_image)
-    thumbnailer.delete()
+    if instance.blob_id:
+        # the files of the store are deleted along with the last part using them
+        blob_pk = instance.blob_id
+        transaction.on_commit(lambda: ImageBlob.delete_orphan(blob_pk), using=using)
+    if instance.image and not in_image_store(instance.image.name):
+        remove_pyramid(pyramid_base(instance.image.name))
+        get_thumbnailer(instance.image).delete(save=False)
+    if instance.bw_image and not in_image_store(instance.bw_image.name):
+        get_thumbnailer(instance.bw_image).delete(save=False)
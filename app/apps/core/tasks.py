@@ -3,16 +3,20 @@ import os
 import os.path
 import shutil
 import tempfile
-from collections import defaultdict
-from itertools import groupby
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby, islice
 from pathlib import Path
 from typing import List
 
 import numpy as np
 from celery import shared_task
+from celery.signals import worker_process_init
 from django.apps import apps
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.db.models import F, Q
 from django.utils.html import strip_tags
 from django.utils.text import slugify
@@ -25,6 +29,13 @@ from kraken.lib.default_specs import RECOGNITION_HYPER_PARAMS, SEGMENTATION_HYPE
 from kraken.lib.train import KrakenTrainer, RecognitionModel, SegmentationModel
 from lightning.pytorch.callbacks import Callback
 
+from core.binarization import binarize_files
+from core.image_cache import open_page_image
+from core.model_cache import (
+    load_recognition_model,
+    load_segmentation_model,
+    model_cache,
+)
 from core.search import (
     REGEX_SEARCH_MODE,
     WORD_BY_WORD_SEARCH_MODE,
@@ -45,8 +56,23 @@ class DidNotConverge(Exception):
     pass
 
 
+@worker_process_init.connect
+def preload_models(**kwargs):
+    # load the default segmentation model once per worker process instead of once per task
+    if not getattr(settings, 'KRAKEN_MODEL_CACHE_PRELOAD', True):
+        return
+    try:
+        load_segmentation_model(SEGMENTATION_DEFAULT_MODEL)
+    except Exception as e:
+        # don't prevent the worker from booting
+        logger.exception(e)
+
+
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=60)
-def generate_part_thumbnails(instance_pk=None, user_pk=None, **kwargs):
+def generate_part_thumbnails(instance_pk=None, user_pk=None, aliases=None, **kwargs):
+    """
+    Generates the thumbnails of the given aliases (all by default) and pushes them to the client.
+    """
     if not getattr(settings, 'THUMBNAIL_ENABLE', True):
         return
 
@@ -57,11 +83,20 @@ def generate_part_thumbnails(instance_pk=None, user_pk=None, **kwargs):
         logger.error('Trying to compress non-existent DocumentPart : %d', instance_pk)
         return
 
-    aliases = {}
+    thumbnails = {}
     thbnr = get_thumbnailer(part.image)
     for alias, config in settings.THUMBNAIL_ALIASES[''].items():
-        aliases[alias] = thbnr.get_thumbnail(config).url
-    return aliases
+        if aliases is None or alias in aliases:
+            thumbnails[alias] = thbnr.get_thumbnail(config).url
+
+    # the task is not reported, tell the client ourselves
+    send_event('document', part.document_id, 'part:workflow', {
+        'id': part.pk,
+        'process': 'generate_part_thumbnails',
+        'status': 'done',
+        'data': thumbnails
+    })
+    return thumbnails
 
 
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=3 * 60)
@@ -84,6 +119,30 @@ def convert(instance_pk=None, user_pk=None, **kwargs):
     part.convert()
 
 
+@shared_task(autoretry_for=(MemoryError,), default_retry_delay=3 * 60)
+def ingest(instance_pk=None, user_pk=None, **kwargs):
+    """
+    Normalizes the image of a part, detects bitonal images and generates its thumbnails,
+    in place of the convert, lossless_compression and generate_part_thumbnails chain.
+    """
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+            # If quotas are enforced, assert that the user still has free CPU minutes
+            if not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() is not None:
+                assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+        except User.DoesNotExist:
+            user = None
+
+    try:
+        DocumentPart = apps.get_model('core', 'DocumentPart')
+        part = DocumentPart.objects.get(pk=instance_pk)
+    except DocumentPart.DoesNotExist:
+        logger.error('Trying to ingest non-existent DocumentPart : %d', instance_pk)
+        return
+    return part.ingest()
+
+
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=5 * 60)
 def lossless_compression(instance_pk=None, user_pk=None, **kwargs):
     if user_pk:
@@ -140,6 +199,102 @@ def binarize(instance_pk=None, user_pk=None, binarizer=None, threshold=None, **k
                         id="binarization-success", level='success')
 
 
+@shared_task(bind=True, autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
+def document_binarize(task, document_pk=None, instance_pks=None, user_pk=None, threshold=None, **kwargs):
+    """
+    Binarizes a batch of parts of a document with the streaming backend in a single task,
+    the images being spread over a pool of settings.BINARIZATION_WORKERS processes.
+    Progress is sent per part through the usual part:workflow events, and written to the report
+    of each part, the parts already processed are skipped when the task is retried.
+    """
+    reports = _part_reports(task.request.id)
+    try:
+        _document_binarize(task, reports, document_pk, instance_pks, user_pk, threshold)
+    except MemoryError:
+        raise
+    except Exception as e:
+        _fail_part_reports(reports, str(e))
+        raise
+
+
+def _document_binarize(task, reports, document_pk, instance_pks, user_pk, threshold):
+    try:
+        Document = apps.get_model('core', 'Document')
+        doc = Document.objects.get(pk=document_pk)
+    except Document.DoesNotExist:
+        logger.error('Trying to binarize non-existent Document: %d', document_pk)
+        return
+
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+            # If quotas are enforced, assert that the user still has free CPU minutes
+            if not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() is not None:
+                assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+        except User.DoesNotExist:
+            user = None
+    else:
+        user = None
+
+    # keep the requested order
+    parts = sorted((part for part in doc.parts.filter(pk__in=instance_pks or [])
+                    if _part_pending(reports.get(part.pk))),
+                   key=lambda part: instance_pks.index(part.pk))
+
+    def send_state(part, status, **data):
+        send_event('document', doc.pk, 'part:workflow', {
+            'id': part.pk,
+            'process': 'binarize',
+            'status': status,
+            'task_id': task.request.id,
+            'data': data,
+        })
+
+    total = len(parts)
+    # (part, name of the binarized image) of the jobs in the pool, in order
+    outputs = deque()
+
+    def jobs():
+        # consumed as the pool gets free
+        for i, part in enumerate(parts):
+            report = reports.get(part.pk)
+            if not _part_pending(report):
+                # canceled meanwhile
+                continue
+            if report:
+                report.start()
+            send_state(part, 'ongoing', progress=i, total=total)
+            name = part.bw_image_name(png=True)
+            bw_file = os.path.join(settings.MEDIA_ROOT, name)
+            os.makedirs(os.path.dirname(bw_file), exist_ok=True)
+            outputs.append((part, name))
+            yield part.image.path, bw_file, threshold
+
+    errors = 0
+    results = binarize_files(jobs(), getattr(settings, 'BINARIZATION_WORKERS', 4))
+    for i, (job, error) in enumerate(results):
+        part, name = outputs.popleft()
+        report = reports.get(part.pk)
+        if error is not None:
+            errors += 1
+            logger.error('Failed to binarize part %d: %s', part.pk, error)
+            _end_part_report(report, error=f"Failed to binarize {part}: {error}")
+            send_state(part, 'error', progress=i + 1, total=total)
+        else:
+            part.bw_image = name
+            part.save()
+            _end_part_report(report)
+            send_state(part, 'done', progress=i + 1, total=total)
+
+    if user:
+        if errors:
+            user.notify(_("Something went wrong during the binarization!"),
+                        id="binarization-error", level='danger')
+        else:
+            user.notify(_("Binarization done!"),
+                        id="binarization-success", level='success')
+
+
 def make_recognition_segmentation(lines) -> List[Segmentation]:
     """
     Groups training data by image for optimized compilation and returns a list
@@ -348,12 +503,14 @@ def segtrain(model_pk=None, part_pks=[], document_pk=None, user_pk=None, **kwarg
         try:
             logger.info(f'Moving best model {best_version} (accuracy: {kraken_model.best_metric}) to {model.file.path}.')
             shutil.copy(best_version, model.file.path)  # os.path.join(model_dir, filename)
+            model_cache.invalidate(model.file.path)
             model.training_accuracy = kraken_model.best_metric
         except FileNotFoundError:
             logger.info(f'Model {os.path.split(model.file.path)[0]} did not improve.')
             user.notify(_("Training didn't get better results than base model!"),
                         id="seg-no-gain-error", level='warning')
             shutil.copy(load, model.file.path)
+            model_cache.invalidate(model.file.path)
 
     except DidNotConverge:
         send_event('document', ground_truth[0].document.pk, "training:error", {
@@ -441,8 +598,94 @@ def segment(instance_pk=None, user_pk=None, model_pk=None,
                         id="segmentation-success", level='success')
 
 
+MASKS_CACHE_PREFIX = 'masks-recalculation'
+
+
+def _masks_key(instance_pk, name, generation=None):
+    key = '%s:%s:%s' % (MASKS_CACHE_PREFIX, instance_pk, name)
+    return key if generation is None else '%s:%d' % (key, generation)
+
+
+def _masks_timeout():
+    window = getattr(settings, 'MASKS_COALESCE_WINDOW', 1)
+    return int(window + getattr(settings, 'MASKS_COALESCE_MAX_DELAY', 5)) + 60
+
+
+def schedule_recalculate_masks(instance_pk, user_pk=None, only=None):
+    """
+    Debounces and coalesces the recalculation of the masks of a part,
+    requests received within settings.MASKS_COALESCE_WINDOW seconds are merged in a single task,
+    the tasks superseded by a later one don't do anything.
+    """
+    window = getattr(settings, 'MASKS_COALESCE_WINDOW', 1)
+    generation = None
+    if window:
+        key = _masks_key(instance_pk, 'generation')
+        try:
+            generation = cache.incr(key)
+        except ValueError:
+            cache.add(key, 0, None)
+            try:
+                generation = cache.incr(key)
+            except ValueError:
+                # the cache backend doesn't support counters (dummy one)
+                pass
+
+    if generation is None:
+        recalculate_masks.delay(instance_pk=instance_pk, user_pk=user_pk, only=only)
+        return
+
+    timeout = _masks_timeout()
+    cache.set(_masks_key(instance_pk, 'request', generation), list(only) if only else '*', timeout)
+    # the date of the oldest pending request, to avoid postponing it forever during continuous editing
+    cache.add(_masks_key(instance_pk, 'since'), time.time(), timeout)
+    recalculate_masks.apply_async(
+        kwargs={'instance_pk': instance_pk, 'user_pk': user_pk, 'generation': generation},
+        countdown=window)
+
+
+def _coalesced_masks_lines(instance_pk, generation):
+    """
+    Merges the pending requests for the part, returns the list of line pks to recalculate
+    (None meaning all of them) or False if there is nothing to do in this task.
+    """
+    current = cache.get(_masks_key(instance_pk, 'generation')) or generation
+    since = cache.get(_masks_key(instance_pk, 'since'))
+    if (current > generation
+            and (since is None or time.time() - since < getattr(settings, 'MASKS_COALESCE_MAX_DELAY', 5))):
+        # superseded, a later task will take care of it
+        return False
+
+    # only where to start looking from, a stale value makes the scan longer, nothing else
+    done = min(cache.get(_masks_key(instance_pk, 'done')) or 0, generation - 1)
+    generations = range(done + 1, current + 1)
+    keys = [_masks_key(instance_pk, 'request', gen) for gen in generations]
+    requests = cache.get_many(keys)
+    # a task that waited for too long may run concurrently with a later one,
+    # each request is claimed atomically so that a single task merges it
+    claimed = [key for gen, key in zip(generations, keys)
+               if key in requests and cache.add(_masks_key(instance_pk, 'claim', gen), True, _masks_timeout())]
+    cache.set(_masks_key(instance_pk, 'done'), current, None)
+    cache.delete_many(claimed + [_masks_key(instance_pk, 'since')])
+    if not claimed:
+        # already handled by another task
+        return False
+
+    only = set()
+    for value in (requests[key] for key in claimed):
+        if value == '*':
+            return None
+        only.update(value)
+    return list(only)
+
+
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=60)
-def recalculate_masks(instance_pk=None, user_pk=None, only=None, **kwargs):
+def recalculate_masks(instance_pk=None, user_pk=None, only=None, generation=None, **kwargs):
+    if generation is not None:
+        only = _coalesced_masks_lines(instance_pk, generation)
+        if only is False:
+            return
+
     if user_pk:
         try:
             user = User.objects.get(pk=user_pk)
@@ -466,6 +709,31 @@ def recalculate_masks(instance_pk=None, user_pk=None, only=None, **kwargs):
     })
 
 
+@shared_task(autoretry_for=(MemoryError,), default_retry_delay=60)
+def recalculate_ordering(document_pk=None, part_pks=None, user_pk=None, read_direction=None, **kwargs):
+    try:
+        Document = apps.get_model('core', 'Document')
+        doc = Document.objects.get(pk=document_pk)
+    except Document.DoesNotExist:
+        logger.error('Trying to recalculate ordering of non-existent Document: %d', document_pk)
+        return
+
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+        except User.DoesNotExist:
+            user = None
+    else:
+        user = None
+
+    parts = doc.parts.filter(pk__in=part_pks) if part_pks else doc.parts.all()
+    doc.recalculate_ordering(parts=parts, read_direction=read_direction)
+
+    if user:
+        user.notify(_("Reading order recalculated!"),
+                    id="ordering-success", level='success')
+
+
 def train_(qs, document, transcription, model=None, user=None):
     # # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
     from multiprocessing import current_process
@@ -562,6 +830,7 @@ def train_(qs, document, transcription, model=None, user=None):
         best_version = os.path.join(model_dir, kraken_model.best_model)
         logger.info(f'Moving best model {best_version} (accuracy: {kraken_model.best_metric}) to {model.file.path}.')
         shutil.copy(best_version, model.file.path)
+        model_cache.invalidate(model.file.path)
         model.training_accuracy = kraken_model.best_metric
 
 
@@ -633,58 +902,203 @@ def train(transcription_pk=None, model_pk=None, part_pks=None, user_pk=None, **k
         })
 
 
+def kraken_forced_align(seg, model, im):
+    """
+    kraken.align.forced_align working on an already decoded image instead of seg.imagename.
+    It relies on the private predictor._scale_val() and predictor.box of kraken 5.2,
+    which is why requirements.txt pins kraken~=5.2.5.
+    """
+    import torch
+    from bidi.algorithm import get_display
+    from kraken import rpred
+    from kraken.align import backtrack, get_trellis, merge_repeats
+    from kraken.containers import BaselineOCRRecord
+
+    predictor = rpred.rpred(model, im, seg)
+    # enable training mode in last layer to get log_softmax output,
+    # the model comes from the cache of load_recognition_model, so restore it afterwards
+    training = model.nn.nn[-1].training
+    model.nn.nn[-1].training = True
+
+    records = []
+    try:
+        for line in seg.lines:
+            do_text = get_display(line.text)
+            labels = model.codec.encode(do_text).long()
+            next(predictor)
+            if model.outputs.shape[2] < 2 * len(labels):
+                logger.warning('Could not align line %s, the output sequence is shorter than its text.', line.id)
+                records.append(BaselineOCRRecord('', [], [], line))
+                continue
+            emission = torch.tensor(model.outputs).squeeze().T
+            trellis = get_trellis(emission, labels)
+            path = merge_repeats(backtrack(trellis, emission, labels), do_text)
+            records.append(BaselineOCRRecord(
+                [s.label for s in path],
+                [(predictor._scale_val(s.start, 0, predictor.box.size[0]),
+                  predictor._scale_val(s.end, 0, predictor.box.size[0])) for s in path],
+                [s.score for s in path],
+                line, display_order=True))
+    finally:
+        model.nn.nn[-1].training = training
+    return records
+
+
+def forced_align_part(part, model, transcription, image=None):
+    """
+    Aligns the existing transcription of all the lines of the part in a single kraken call,
+    the image being decoded only once (or given), and writes the graphs back in bulk.
+    Returns the number of aligned lines.
+    """
+    LineTranscription = apps.get_model('core', 'LineTranscription')
+
+    text_direction = (
+        (part.document.main_script and part.document.main_script.text_direction)
+        or "horizontal-lr"
+    )
+
+    linetrans = [lt for lt in (LineTranscription.objects
+                               .filter(line__document_part=part, transcription=transcription)
+                               .select_related('line', 'line__typology'))
+                 # can't align without text or geometry
+                 if lt.content and lt.line.baseline and lt.line.mask]
+    if not linetrans:
+        return 0
+
+    im = image if image is not None else open_page_image(part.image.path)
+
+    def align(lts):
+        seg = Segmentation(
+            type='baselines',
+            imagename=part.image.path,
+            text_direction=text_direction,
+            script_detection=False,
+            lines=[BaselineLine(
+                id=str(lt.line.pk),
+                baseline=lt.line.baseline,
+                boundary=lt.line.mask,
+                text=lt.content,
+                tags={'type': lt.line.typology and lt.line.typology.name or 'default'},
+            ) for lt in lts])
+        # one record per line, in order
+        return kraken_forced_align(seg, model, im)
+
+    try:
+        records = align(linetrans)
+    except ValueError as e:
+        # a single line that can't be aligned makes the whole call fail, isolate it
+        logger.warning('Batched forced alignment of %s failed (%s), aligning line by line.', part, e)
+        records = []
+        for lt in linetrans:
+            try:
+                records.extend(align([lt]))
+            except ValueError:
+                records.append(None)
+
+    aligned = []
+    for lt, pred in zip(linetrans, records):
+        if pred is None or not pred.prediction:
+            continue
+        lt.graphs = [{
+            'c': letter,
+            'poly': poly,
+            'confidence': float(confidence)
+        } for letter, poly, confidence in zip(
+            pred.prediction, pred.cuts, pred.confidences)]
+        aligned.append(lt)
+
+    LineTranscription.objects.bulk_update(aligned, ['graphs'])
+    return len(aligned)
+
+
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
 def forced_align(instance_pk=None, model_pk=None, transcription_pk=None,
                  part_pk=None, user_pk=None, **kwargs):
-
-    from kraken.align import forced_align as kraken_forced_align
-    from kraken.lib import models as kraken_models
-
     OcrModel = apps.get_model('core', 'OcrModel')
     DocumentPart = apps.get_model('core', 'DocumentPart')
     Transcription = apps.get_model('core', 'Transcription')
-    LineTranscription = apps.get_model('core', 'LineTranscription')
 
     ocrmodel = OcrModel.objects.get(pk=model_pk)
-    model = kraken_models.load_any(ocrmodel.file.path)
+    model = load_recognition_model(ocrmodel.file.path)
     transcription = Transcription.objects.get(pk=transcription_pk)
+    part = DocumentPart.objects.select_related('document__main_script').get(pk=instance_pk)
 
-    part = DocumentPart.objects.get(pk=instance_pk)
-    document = part.document
+    forced_align_part(part, model, transcription)
 
-    text_direction = (
-        (document.main_script and document.main_script.text_direction)
-        or "horizontal-lr"
-    )
 
-    linetrans = LineTranscription.objects.filter(
-        line__document_part=part,
-        transcription=transcription
-    ).select_related('line')
-
-    for lt in linetrans:
-        data = {
-            'image': part.image,
-            "lines": [{
-                "text": lt.content,
-                "baseline": lt.line.baseline,
-                "boundary": lt.line.mask,
-                "text_direction": text_direction,
-                "tags": {'type': lt.line.typology and lt.line.typology.name or 'default'},
-            }],
-            "type": "baselines"
-        }
-
-        records = kraken_forced_align(data, model)  # base_dir = L,R
-        for pred in records:
-            # lt.content = pred.prediction
-            lt.graphs = [{
-                'c': letter,
-                'poly': poly,
-                'confidence': float(confidence)
-            } for letter, poly, confidence in zip(
-                pred.prediction, pred.cuts, pred.confidences)]
-            lt.save()
+@shared_task(bind=True, autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
+def document_forced_align(task, document_pk=None, part_pks=None, model_pk=None, transcription_pk=None,
+                          user_pk=None, **kwargs):
+    """
+    Forced alignment of the given parts (or all the parts) of a document in a single job,
+    the model is loaded only once and the progress is sent page by page.
+    """
+    try:
+        Document = apps.get_model('core', 'Document')
+        doc = Document.objects.select_related('main_script').get(pk=document_pk)
+    except Document.DoesNotExist:
+        logger.error('Trying to align non-existent Document: %d', document_pk)
+        return
+
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+            # If quotas are enforced, assert that the user still has free CPU minutes
+            if not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() is not None:
+                assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+        except User.DoesNotExist:
+            user = None
+    else:
+        user = None
+
+    OcrModel = apps.get_model('core', 'OcrModel')
+    model = load_recognition_model(OcrModel.objects.get(pk=model_pk).file.path)
+    transcription = doc.transcriptions.get(pk=transcription_pk)
+
+    parts = doc.parts.all()
+    if part_pks:
+        parts = parts.filter(pk__in=part_pks)
+    parts = list(parts)
+    for part in parts:
+        # avoid a query per part
+        part.document = doc
+
+    def send_state(part, status, **data):
+        # the same events as the per part forced_align task
+        send_event('document', doc.pk, 'part:workflow', {
+            'id': part.pk,
+            'process': 'forced_align',
+            'status': status,
+            'task_id': task.request.id,
+            'data': data,
+        })
+
+    total = len(parts)
+    send_event('document', doc.pk, 'parts:workflow', {
+        'parts': [{'id': part.pk, 'process': 'forced_align', 'status': 'pending', 'task_id': task.request.id}
+                  for part in parts]
+    })
+    for i, part in enumerate(parts):
+        send_state(part, 'ongoing', progress=i, total=total)
+        try:
+            aligned = forced_align_part(part, model, transcription)
+        except Exception as e:
+            if user:
+                user.notify(_("Something went wrong during the alignment!"),
+                            id="forced-align-error", level='danger')
+            send_state(part, 'error', reason=str(e))
+            # the parts left won't be aligned
+            send_event('document', doc.pk, 'parts:workflow', {
+                'parts': [{'id': p.pk, 'process': 'forced_align', 'status': 'error', 'task_id': task.request.id}
+                          for p in parts[i + 1:]]
+            })
+            logger.exception(e)
+            raise e
+        send_state(part, 'done', progress=i + 1, total=total, lines=aligned)
+
+    if user:
+        user.notify(_("Alignment done!"),
+                    id="forced-align-success", level='success')
 
 
 @shared_task(autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
@@ -733,6 +1147,207 @@ def transcribe(instance_pk=None, model_pk=None, user_pk=None,
                         level='success')
 
 
+def _load_part_image(part):
+    # decoded in the prefetching thread, and kept in the page image cache
+    return open_page_image(part.image.path)
+
+
+def prefetch_part_images(parts, depth=2, loader=_load_part_image):
+    """
+    Yields (part, future) tuples, the image of the next `depth` parts being
+    read and decoded in a background thread while the current one is processed.
+    """
+    parts = iter(parts)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = deque((part, executor.submit(loader, part)) for part in islice(parts, max(depth, 1)))
+        try:
+            while pending:
+                part, future = pending.popleft()
+                next_part = next(parts, None)
+                if next_part is not None:
+                    pending.append((next_part, executor.submit(loader, next_part)))
+                yield part, future
+        finally:
+            # the consumer stopped early, don't leak the already decoded images
+            for part, future in pending:
+                if not future.cancel() and future.exception() is None and future.result() is not None:
+                    future.result().close()
+
+
+def _part_reports(task_id):
+    """
+    The reports of the parts processed by a batch task by part pk, cf Document.queue_batch.
+    """
+    TaskReport = apps.get_model('reporting', 'TaskReport')
+    return {report.document_part_id: report
+            for report in TaskReport.objects.filter(task_id=task_id, document_part__isnull=False)}
+
+
+def _part_pending(report):
+    # canceled, or processed before the task was retried
+    from reporting.models import TASK_FINAL_STATES
+
+    if report is None:
+        return True
+    report.refresh_from_db()
+    return report.workflow_state not in TASK_FINAL_STATES
+
+
+def _end_part_report(report, error=None):
+    if report is None:
+        return
+    if error:
+        report.error(error)
+    else:
+        report.end()
+    report.calc_cpu_cost(os.cpu_count())
+
+
+def _fail_part_reports(reports, error):
+    # the batch stopped, the parts it didn't process are not left queued
+    for report in reports.values():
+        if _part_pending(report):
+            report.error(error)
+
+
+@shared_task(bind=True, autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
+def document_pipeline(task, document_pk=None, instance_pks=None, process=None, user_pk=None,
+                      model_pk=None, transcription_pk=None,
+                      steps=None, text_direction=None, override=None, **kwargs):
+    """
+    Segments or transcribes (process = 'segment' or 'transcribe') a batch of parts of a document
+    in a single task, the user, quotas, model and transcription being resolved only once.
+    Images of the next parts are decoded in the background during inference on the current one.
+    Progress is sent per part through the usual part:workflow events, and written to the report
+    of each part, the parts already processed are skipped when the task is retried.
+    """
+    reports = _part_reports(task.request.id)
+    try:
+        _document_pipeline(task, reports, document_pk, instance_pks, process, user_pk,
+                           model_pk, transcription_pk, steps, text_direction, override)
+    except MemoryError:
+        raise
+    except Exception as e:
+        _fail_part_reports(reports, str(e))
+        raise
+
+
+def _document_pipeline(task, reports, document_pk, instance_pks, process, user_pk,
+                       model_pk, transcription_pk, steps, text_direction, override):
+    try:
+        Document = apps.get_model('core', 'Document')
+        doc = Document.objects.get(pk=document_pk)
+    except Document.DoesNotExist:
+        logger.error('Trying to run a pipeline on non-existent Document: %d', document_pk)
+        return
+
+    if user_pk:
+        try:
+            user = User.objects.get(pk=user_pk)
+            # If quotas are enforced, assert that the user still has free CPU minutes
+            if not settings.DISABLE_QUOTAS and user.cpu_minutes_limit() is not None:
+                assert user.has_free_cpu_minutes(), f"User {user.id} doesn't have any CPU minutes left"
+        except User.DoesNotExist:
+            user = None
+    else:
+        user = None
+
+    OcrModel = apps.get_model('core', 'OcrModel')
+    try:
+        model = OcrModel.objects.get(pk=model_pk)
+    except OcrModel.DoesNotExist:
+        model = None
+
+    if process == 'transcribe':
+        Transcription = apps.get_model('core', 'Transcription')
+        transcription = Transcription.objects.get(pk=transcription_pk)
+
+    # keep the requested order
+    parts = sorted((part for part in doc.parts.filter(pk__in=instance_pks or [])
+                    if _part_pending(reports.get(part.pk))),
+                   key=lambda part: instance_pks.index(part.pk))
+
+    if process == 'segment' and steps == 'masks':
+        # make_masks reads the image by itself
+        loader = lambda part: None  # noqa: E731
+    else:
+        loader = _load_part_image
+
+    def send_state(part, status, **data):
+        send_event('document', doc.pk, 'part:workflow', {
+            'id': part.pk,
+            'process': process,
+            'status': status,
+            'task_id': task.request.id,
+            'data': data,
+        })
+
+    errors = 0
+    total = len(parts)
+    for i, (part, future) in enumerate(
+            prefetch_part_images(parts, depth=getattr(settings, 'INFERENCE_PIPELINE_PREFETCH', 2),
+                                 loader=loader)):
+        report = reports.get(part.pk)
+        if not _part_pending(report):
+            # canceled meanwhile
+            if not future.cancel() and future.exception() is None and future.result() is not None:
+                future.result().close()
+            continue
+        if report:
+            report.start()
+        send_state(part, 'ongoing', progress=i, total=total)
+        im = None
+        try:
+            im = future.result()
+            if process == 'segment':
+                if steps == 'masks':
+                    part.make_masks()
+                else:
+                    part.segment(steps=steps,
+                                 override=override,
+                                 text_direction=text_direction,
+                                 model=model,
+                                 image=im)
+            elif process == 'transcribe':
+                if not part.segmented:
+                    # same as DocumentPart.task, segment with the default model first
+                    part.segment(text_direction=text_direction, image=im)
+                part.transcribe(model, transcription, user=user, image=im)
+        except MemoryError:
+            raise
+        except Exception as e:
+            errors += 1
+            if process == 'segment':
+                part.workflow_state = part.WORKFLOW_STATE_CONVERTED
+            else:
+                part.workflow_state = part.WORKFLOW_STATE_SEGMENTED
+            part.save()
+            logger.exception(e)
+            _end_part_report(report, error=f"Failed to {process} {part}: {e}")
+            send_state(part, 'error', progress=i + 1, total=total)
+        else:
+            _end_part_report(report)
+            send_state(part, 'done', progress=i + 1, total=total)
+        finally:
+            if im is not None:
+                im.close()
+
+    if user:
+        name = 'segmentation' if process == 'segment' else 'transcription'
+        if errors:
+            if process == 'segment':
+                msg = _("Something went wrong during the segmentation!")
+            else:
+                msg = _("Something went wrong during the transcription!")
+            user.notify(msg, id="%s-error" % name, level='danger')
+        else:
+            if process == 'segment':
+                msg = _("Segmentation done!")
+            else:
+                msg = _("Transcription done!")
+            user.notify(msg, id="%s-success" % name, level='success')
+
+
 @shared_task(bind=True, autoretry_for=(MemoryError,), default_retry_delay=10 * 60)
 def align(
     task,
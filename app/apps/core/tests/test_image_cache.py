@@ -0,0 +1,76 @@
+import os
+import tempfile
+
+from django.test import SimpleTestCase
+from PIL import Image
+
+from core.image_cache import PageImageCache
+
+
+class PageImageCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_image(self, name, size=(60, 40), color=(155, 0, 0)):
+        path = os.path.join(self.tmp_dir.name, name)
+        Image.new('RGB', size, color=color).save(path)
+        return path
+
+    def test_memory_hit(self):
+        cache = PageImageCache(max_size=1024 * 1024)
+        path = self.make_image('a.png')
+        im = cache.get(path)
+        self.assertEqual((im.mode, im.size), ('RGB', (60, 40)))
+        self.assertEqual(cache.get(path).getpixel((0, 0)), (155, 0, 0))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # modes are cached separately
+        self.assertEqual(cache.get(path, mode='L').mode, 'L')
+        self.assertEqual(cache.misses, 2)
+
+    def test_keep_mode(self):
+        cache = PageImageCache(max_size=1024 * 1024)
+        path = os.path.join(self.tmp_dir.name, 'a.tif')
+        Image.new('I;16', (60, 40), color=4000).save(path)
+        im = cache.get(path)
+        self.assertEqual((im.mode, im.getpixel((0, 0))), ('I;16', 4000))
+        self.assertEqual(cache.get(path).mode, 'I;16')
+        self.assertEqual(cache.hits, 1)
+
+        # a palette doesn't survive an array, the image isn't cached
+        path = os.path.join(self.tmp_dir.name, 'b.png')
+        Image.new('P', (60, 40), color=3).save(path)
+        self.assertEqual(cache.get(path).mode, 'P')
+        self.assertEqual(cache.get(path).mode, 'P')
+        self.assertEqual(cache.misses, 3)
+
+    def test_disk_hit(self):
+        path = self.make_image('a.png')
+        PageImageCache(directory=self.cache_dir, max_disk_size=1024 * 1024).get(path)
+
+        # another process with an empty memory cache
+        cache = PageImageCache(directory=self.cache_dir, max_disk_size=1024 * 1024)
+        self.assertEqual(cache.get(path).getpixel((0, 0)), (155, 0, 0))
+        self.assertEqual((cache.disk_hits, cache.misses), (1, 0))
+
+    def test_file_changed(self):
+        cache = PageImageCache(max_size=1024 * 1024, directory=self.cache_dir, max_disk_size=1024 * 1024)
+        path = self.make_image('a.png')
+        cache.get(path)
+        self.make_image('a.png', size=(30, 30))
+        os.utime(path, ns=(0, 0))
+        self.assertEqual(cache.get(path).size, (30, 30))
+        self.assertEqual(len(cache), 1)
+
+    def test_evictions(self):
+        # each raster is 60*40*3 = 7200 bytes
+        cache = PageImageCache(max_size=10000, directory=self.cache_dir, max_disk_size=10000)
+        cache.get(self.make_image('a.png'))
+        cache.get(self.make_image('b.png'))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len([f for f in os.listdir(self.cache_dir) if f.endswith('.npy')]), 1)
+        self.assertEqual(cache.evictions, 2)
@@ -0,0 +1,59 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from core.masks import compute_masks, neighbours
+
+
+class MasksTestCase(SimpleTestCase):
+    def test_neighbours(self):
+        # 10 lines spaced by 10 pixels and an isolated one far below
+        baselines = [[[10, y], [100, y]] for y in range(10, 110, 10)] + [[[10, 500], [100, 500]]]
+
+        result = neighbours(baselines, [0, 5, 10])
+        # only the lines closer than about 3 times the line spacing
+        self.assertTrue({1, 2} <= set(result[0]))
+        self.assertFalse(set(result[0]) & {4, 5, 6, 7, 8, 9, 10})
+        self.assertTrue({3, 4, 6, 7} <= set(result[1]))
+        self.assertFalse(set(result[1]) & {0, 1, 5, 9, 10})
+        # the nearest line is always part of the context
+        self.assertIn(9, result[2])
+        self.assertNotIn(10, result[2])
+
+    def test_neighbours_single_line(self):
+        self.assertEqual(neighbours([[[10, 10], [100, 10]]], [0]), [[]])
+
+    @override_settings(MASKS_WORKERS=4, MASKS_PARALLEL_MIN_LINES=50)
+    @patch("core.masks.open_page_image")
+    @patch("core.masks.calculate_polygonal_environment")
+    def test_compute_masks_small_page(self, mock_env, mock_open):
+        mask = [[0, 0], [10, 0], [10, 10], [0, 10]]
+        mock_env.return_value = [mask]
+        jobs = [([[0, 5], [10, 5]], [], False)] * 3
+        with patch("core.masks.process_pool_imap") as mock_pool:
+            self.assertEqual(compute_masks('/dummy.png', jobs), [mask] * 3)
+            # not worth spawning processes
+            mock_pool.assert_not_called()
+        self.assertEqual(mock_env.call_count, 3)
+
+    @override_settings(MASKS_WORKERS=2, MASKS_PARALLEL_MIN_LINES=2)
+    @patch("core.masks.open_page_image")
+    @patch("core.masks.calculate_polygonal_environment")
+    def test_compute_masks_pool(self, mock_env, mock_open):
+        mock_env.side_effect = lambda im, baselines, **kwargs: [[[0, 0]] + baselines[0]]
+        jobs = [([[0, y], [10, y]], [], False) for y in range(5)]
+
+        def imap(fn, jobs, workers, executor=None):
+            # the pool workers load the page from the path given with each job
+            self.assertEqual({job[0] for job in jobs}, {'/dummy.png'})
+            return ((job, fn(job)) for job in jobs)
+
+        with patch("core.masks.shared_process_pool") as mock_shared, \
+                patch("core.masks.process_pool_imap", side_effect=imap) as mock_pool:
+            masks = compute_masks('/dummy.png', jobs)
+        self.assertEqual(mock_pool.call_args.args[2], 2)
+        # the pool is reused from one call to the next
+        mock_shared.assert_called_once_with(2)
+        self.assertEqual(mock_pool.call_args.kwargs['executor'], mock_shared.return_value)
+        # in the order of the jobs
+        self.assertEqual(masks, [[[0, 0], [0, y], [10, y]] for y in range(5)])
@@ -0,0 +1,66 @@
+import os
+import tempfile
+from unittest.mock import Mock
+
+from django.test import SimpleTestCase
+
+from core.model_cache import ModelCache
+
+
+class ModelCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.loader = Mock(side_effect=lambda path: object())
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def make_file(self, name, size=10):
+        path = os.path.join(self.tmp_dir.name, name)
+        with open(path, 'wb') as fh:
+            fh.write(b'0' * size)
+        return path
+
+    def test_hit_and_miss(self):
+        model_cache = ModelCache(max_count=2)
+        path = self.make_file('a.mlmodel')
+        model = model_cache.get(path, self.loader)
+        self.assertIs(model_cache.get(path, self.loader), model)
+        self.assertEqual(self.loader.call_count, 1)
+        self.assertEqual((model_cache.hits, model_cache.misses), (1, 1))
+
+    def test_lru_count(self):
+        model_cache = ModelCache(max_count=2)
+        a, b, c = [self.make_file(n) for n in ('a', 'b', 'c')]
+        model_cache.get(a, self.loader)
+        model_cache.get(b, self.loader)
+        model_cache.get(a, self.loader)  # a is now the most recently used
+        model_cache.get(c, self.loader)  # evicts b
+        self.assertEqual(len(model_cache), 2)
+        self.assertEqual(model_cache.evictions, 1)
+        model_cache.get(a, self.loader)
+        self.assertEqual(self.loader.call_count, 3)
+
+    def test_lru_size(self):
+        model_cache = ModelCache(max_count=10, max_size=25)
+        a, b = self.make_file('a', size=20), self.make_file('b', size=20)
+        model_cache.get(a, self.loader)
+        model_cache.get(b, self.loader)
+        self.assertEqual(len(model_cache), 1)
+        self.assertEqual(model_cache.size, 20)
+
+    def test_file_changed(self):
+        model_cache = ModelCache()
+        path = self.make_file('a.mlmodel', size=10)
+        model = model_cache.get(path, self.loader)
+        # the model got retrained
+        self.make_file('a.mlmodel', size=12)
+        self.assertIsNot(model_cache.get(path, self.loader), model)
+        self.assertEqual(len(model_cache), 1)
+
+    def test_invalidate(self):
+        model_cache = ModelCache()
+        path = self.make_file('a.mlmodel')
+        model_cache.get(path, self.loader)
+        model_cache.invalidate(path)
+        self.assertEqual(len(model_cache), 0)
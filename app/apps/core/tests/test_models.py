@@ -1,13 +1,26 @@
 import json
 import os
 import subprocess
+from io import BytesIO
 from shutil import copyfile
+from types import SimpleNamespace
 from unittest.mock import patch
 
 from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
-
-from core.models import LineTranscription, Transcription
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
+from easy_thumbnails.files import get_thumbnailer
+from PIL import Image
+
+from core.models import (
+    Block,
+    DocumentPart,
+    ImageBlob,
+    Line,
+    LineTranscription,
+    Transcription,
+)
 from core.tests.factory import CoreFactoryTestCase
 
 
@@ -524,3 +537,219 @@ class DocumentPartTestCase(CoreFactoryTestCase):
             f"{self.outdir}-1.json",
             f"{self.outdir}-1",
         ])
+
+    @patch("core.models.load_recognition_model")
+    @patch("core.models.rpred")
+    def test_transcribe_batched(self, mock_rpred, _):
+        """Lines are recognized in batches and written back in bulk"""
+        self.makeTranscriptionContent()
+        model = self.factory.make_model(self.part.document)
+
+        def fake_rpred(model_, im, bounds=None, **kwargs):
+            return iter([SimpleNamespace(prediction='abc',
+                                         cuts=[[[0, 0], [1, 0], [1, 1]]] * 3,
+                                         confidences=[0.5, 0.6, 0.7])
+                         for line in bounds.lines])
+        mock_rpred.rpred.side_effect = fake_rpred
+
+        # the whole page goes through the recognizer at once by default
+        self.part.transcribe(model, self.transcription)
+        self.assertEqual(mock_rpred.rpred.call_count, 1)
+        self.assertEqual(len(mock_rpred.rpred.call_args.kwargs['bounds'].lines), 30)
+
+        lts = LineTranscription.objects.filter(line__document_part=self.part,
+                                               transcription=self.transcription)
+        self.assertEqual(lts.count(), 30)
+        for lt in lts:
+            self.assertEqual(lt.content, 'abc')
+            self.assertEqual(len(lt.graphs), 3)
+            self.assertAlmostEqual(lt.avg_confidence, 0.6)
+            # the previous content went to the history
+            self.assertEqual(len(lt.versions), 1)
+
+        mock_rpred.rpred.reset_mock()
+        self.part.transcribe(model, self.transcription, batch_size=8)
+        self.assertEqual(mock_rpred.rpred.call_count, 4)
+
+    @patch("core.models.load_segmentation_model")
+    @patch("core.models.blla")
+    def test_segment_bulk(self, mock_blla, _):
+        """Segmentation results are written in bulk and lines are bound to the region containing them"""
+        part = self.factory.make_part()
+        mock_blla.segment.return_value = SimpleNamespace(
+            regions={
+                'Main': [SimpleNamespace(boundary=[[0, 0], [30, 0], [30, 60], [0, 60]])],
+                'Margin': [SimpleNamespace(boundary=[[30, 0], [60, 0], [60, 60], [30, 60]])],
+            },
+            lines=[
+                SimpleNamespace(baseline=[[5, 10], [25, 10]], boundary=[[5, 5], [25, 5], [25, 12], [5, 12]],
+                                tags={'type': 'default'}),
+                SimpleNamespace(baseline=[[35, 10], [55, 10]], boundary=[[35, 5], [55, 5], [55, 12], [35, 12]],
+                                tags={'type': 'default'}),
+                SimpleNamespace(baseline=[[5, 40], [55, 40]], boundary=None,
+                                tags={'type': 'heading'}),
+            ]
+        )
+
+        part.segment(steps='both', override=True)
+
+        blocks = list(Block.objects.filter(document_part=part).order_by('order'))
+        self.assertEqual([b.typology.name for b in blocks], ['Main', 'Margin'])
+        self.assertEqual([b.order for b in blocks], [0, 1])
+        self.assertTrue(all(b.external_id for b in blocks))
+
+        lines = Line.objects.filter(document_part=part).order_by('pk')
+        self.assertEqual([line.block_id for line in lines], [blocks[0].pk, blocks[1].pk, None])
+        self.assertEqual([line.typology.name for line in lines], ['default', 'default', 'heading'])
+        self.assertEqual(sorted(line.order for line in lines), [0, 1, 2])
+        self.assertTrue(part.document.valid_line_types.filter(name='heading').exists())
+
+    def test_recalculate_ordering(self):
+        part = self.factory.make_part()
+        left = Block.objects.create(document_part=part, box=[[0, 0], [25, 0], [25, 60], [0, 60]])
+        right = Block.objects.create(document_part=part, box=[[30, 0], [60, 0], [60, 60], [30, 60]])
+        # created in a scrambled order
+        baselines = [
+            (right, [[32, 20], [58, 20]]),
+            (left, [[2, 40], [22, 40]]),
+            (None, [[2, 58], [58, 58]]),
+            (left, [[12, 10], [22, 10]]),
+            (left, [[2, 11], [10, 11]]),  # same level as the previous one but closer to the origin
+            (right, [[32, 40], [58, 40]]),
+        ]
+        lines = [Line.objects.create(document_part=part, block=block, baseline=baseline)
+                 for block, baseline in baselines]
+        # without geometry, can't be placed
+        Line.objects.create(document_part=part, block=left, baseline=None, order=0)
+
+        part.recalculate_ordering(read_direction='ltr')
+        self.assertEqual(
+            list(part.lines.exclude(baseline=None).order_by('order').values_list('pk', flat=True)),
+            [lines[4].pk, lines[3].pk, lines[1].pk, lines[0].pk, lines[5].pk, lines[2].pk])
+        self.assertEqual(part.lines.get(baseline=None).order, len(lines))
+
+        # the whole document can be re-ordered at once
+        Line.objects.filter(document_part=part).update(order=0)
+        part.document.recalculate_ordering(read_direction='ltr')
+        self.assertEqual(
+            list(part.lines.exclude(baseline=None).order_by('order').values_list('pk', flat=True)),
+            [lines[4].pk, lines[3].pk, lines[1].pk, lines[0].pk, lines[5].pk, lines[2].pk])
+
+    def make_geometries(self, part):
+        block = Block.objects.create(document_part=part, box=[[0, 0], [200, 0], [200, 100], [0, 100]])
+        line = Line.objects.create(document_part=part, block=block,
+                                   baseline=[[10, 20], [100, 20]],
+                                   mask=[[10, 10], [100, 10], [100, 30], [10, 30]])
+        return block, line
+
+    def test_rotate(self):
+        part = self.factory.make_part()  # 864x206
+        block, line = self.make_geometries(part)
+
+        part.rotate(90)
+
+        part.refresh_from_db()
+        self.assertIn('_rot90', part.image.name)
+        self.assertEqual((part.image.width, part.image.height), (206, 864))
+        line.refresh_from_db()
+        self.assertEqual(line.baseline, [[186, 10], [186, 100]])
+        self.assertEqual(line.mask, [[196, 10], [196, 100], [176, 100], [176, 10]])
+        block.refresh_from_db()
+        self.assertEqual(block.box, [[206, 0], [206, 200], [106, 200], [106, 0]])
+
+    def test_crop(self):
+        part = self.factory.make_part()
+        block, line = self.make_geometries(part)
+
+        part.crop(10, 5, 110, 55)
+
+        part.refresh_from_db()
+        self.assertEqual((part.image.width, part.image.height), (100, 50))
+        line.refresh_from_db()
+        self.assertEqual(line.baseline, [[0, 15], [90, 15]])
+        block.refresh_from_db()
+        self.assertEqual(block.box, [[-10, -5], [190, -5], [190, 95], [-10, 95]])
+
+    def test_binarize_vips(self):
+        part = self.factory.make_part()  # 864x206
+        part.bw_backend = part.BW_BACKEND_VIPS
+
+        part.binarize()
+
+        part.refresh_from_db()
+        self.assertTrue(part.bw_image.name.endswith('.png'))
+        with Image.open(part.bw_image.path) as im:
+            self.assertEqual(im.size, (864, 206))
+            self.assertEqual(len(im.getcolors()), 2)
+
+    @override_settings(ALWAYS_CONVERT=True)
+    def test_ingest(self):
+        img = BytesIO()
+        Image.new('L', (300, 200), color=255).save(img, 'jpeg')
+        part = self.factory.make_part(image=SimpleUploadedFile('test.jpg', img.getvalue()))
+        jpg_path = part.image.path
+
+        with patch('core.models.send_event') as send_event:
+            timings = part.ingest()
+
+        part.refresh_from_db()
+        self.assertEqual(part.workflow_state, part.WORKFLOW_STATE_CONVERTED)
+        self.assertTrue(part.image.name.endswith('.png'))
+        self.assertFalse(os.path.exists(jpg_path))
+        self.assertEqual(part.image_file_size, os.path.getsize(part.image.path))
+        self.assertEqual((part.image.width, part.image.height), (300, 200))
+        # a single color, not bitonal
+        self.assertFalse(part.bw_image)
+        self.assertEqual(set(timings), {'decode', 'convert', 'bitonal', 'thumbnails'})
+
+        # the thumbnails are found by easy_thumbnails, and pushed to the client
+        thumbnailer = get_thumbnailer(part.image)
+        for alias, config in settings.THUMBNAIL_ALIASES[''].items():
+            self.assertIsNotNone(thumbnailer.get_thumbnail(config, generate=False), alias)
+        event = send_event.call_args.args
+        self.assertEqual(event[2], 'part:workflow')
+        self.assertEqual(set(event[3]['data']), set(settings.THUMBNAIL_ALIASES['']))
+
+    @override_settings(IMAGE_DEDUPLICATION=True)
+    def test_ingest_deduplication(self):
+        img = BytesIO()
+        Image.new('RGB', (300, 200), color=(255, 0, 0)).save(img, 'png')
+        parts = [self.factory.make_part(image=SimpleUploadedFile('test.png', img.getvalue()),
+                                        image_file_size=len(img.getvalue()))
+                 for i in range(4)]
+        paths = [part.image.path for part in parts]
+
+        with patch('core.models.send_event'):
+            timings = [part.ingest() for part in parts]
+
+        for part in parts:
+            part.refresh_from_db()
+        blob = parts[0].blob
+        self.assertEqual({part.blob for part in parts}, {blob})
+        self.assertEqual({part.image.name for part in parts}, {blob.image.name})
+        self.assertTrue(blob.ingested)
+        self.assertEqual(blob.references, 4)
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+        # quotas still account for each part
+        self.assertEqual({part.image_file_size for part in parts}, {os.path.getsize(blob.image.path)})
+        # the copies are not decoded
+        self.assertIn('decode', timings[0])
+        self.assertNotIn('decode', timings[1])
+
+        # the image is modified in place, the part gets its own copy
+        parts[1].crop(0, 0, 100, 100)
+        parts[1].refresh_from_db()
+        self.assertIsNone(parts[1].blob)
+        self.assertNotEqual(parts[1].image.name, blob.image.name)
+        self.assertEqual(parts[1].image.width, 100)
+        self.assertEqual(blob.references, 3)
+        self.assertTrue(os.path.exists(blob.image.path))
+
+        # the shared files are removed along with the last part using them,
+        # even when they are deleted together
+        parts[3].delete()
+        self.assertTrue(os.path.exists(blob.image.path))
+        DocumentPart.objects.filter(pk__in=[parts[0].pk, parts[2].pk]).delete()
+        self.assertFalse(os.path.exists(blob.image.path))
+        self.assertTrue(os.path.exists(parts[1].image.path))
+        self.assertFalse(ImageBlob.objects.filter(pk=blob.pk).exists())
@@ -1,11 +1,25 @@
+import time
 import unittest
+from types import SimpleNamespace
 from unittest.mock import patch
 
+from django.core.cache import cache
+from django.test import override_settings
 from django.urls import reverse
+from PIL import Image
 
-from core.models import Document, Line
-from core.tasks import align
+from core.image_cache import open_page_image
+from core.models import Document, DocumentPart, Line, LineTranscription
+from core.tasks import (
+    _coalesced_masks_lines,
+    _masks_key,
+    align,
+    document_forced_align,
+    document_pipeline,
+    schedule_recalculate_masks,
+)
 from core.tests.factory import CoreFactoryTestCase
+from reporting.models import TaskReport
 
 # DO NOT REMOVE THIS IMPORT, it will break a lot of tests
 # It is used to trigger Celery signals when running tests
@@ -189,3 +203,221 @@ class TasksTestCase(CoreFactoryTestCase):
                     parts = apps_mock.get_model.return_value.objects.filter.return_value
                     apps_mock.get_model.return_value.objects.bulk_update.assert_called_with(parts, ["workflow_state"])
                     self.assertEqual(mock_log.output[0][:17], "ERROR:core.tasks:")
+
+    def test_document_pipeline_task(self):
+        part = self.factory.make_part()
+        part2 = self.factory.make_part(document=part.document)
+        part3 = self.factory.make_part(document=part.document)
+        pks = [part3.pk, part.pk, part2.pk]
+
+        with patch("core.models.DocumentPart.segment", autospec=True) as segment_mock:
+            # the second part fails, the others should be segmented anyway
+            def segment(part_, **kwargs):
+                self.assertEqual((part_.image.width, part_.image.height), kwargs['image'].size)
+                if part_.pk == part.pk:
+                    raise ValueError('bad image')
+            segment_mock.side_effect = segment
+
+            with patch("core.tasks.send_event") as send_event_mock:
+                with self.assertLogs('core.tasks', level='ERROR'):
+                    document_pipeline.delay(document_pk=part.document.pk,
+                                            instance_pks=pks,
+                                            process='segment',
+                                            user_pk=part.document.owner.pk,
+                                            steps='both')
+
+        # called once per part, in the requested order
+        self.assertEqual([call.args[0].pk for call in segment_mock.call_args_list], pks)
+        statuses = [(call.args[2]['id'], call.args[2]['status'])
+                    for call in send_event_mock.call_args_list]
+        self.assertEqual(statuses, [(part3.pk, 'ongoing'), (part3.pk, 'done'),
+                                    (part.pk, 'ongoing'), (part.pk, 'error'),
+                                    (part2.pk, 'ongoing'), (part2.pk, 'done')])
+        self.assertEqual(DocumentPart.objects.get(pk=part.pk).workflow_state,
+                         DocumentPart.WORKFLOW_STATE_CONVERTED)
+
+    def test_queue_pipeline(self):
+        part = self.factory.make_part(workflow_state=DocumentPart.WORKFLOW_STATE_CONVERTED)
+        part2 = self.factory.make_part(document=part.document,
+                                       workflow_state=DocumentPart.WORKFLOW_STATE_CONVERTED)
+        user = part.document.owner
+
+        with patch("core.models.DocumentPart.segment", autospec=True) as segment_mock:
+            def segment(part_, **kwargs):
+                if part_.pk == part2.pk:
+                    raise ValueError('bad image')
+            segment_mock.side_effect = segment
+
+            with patch("core.models.send_event"), patch("core.tasks.send_event"):
+                with self.assertLogs('core.tasks', level='ERROR'):
+                    part.document.queue_pipeline([part, part2], 'segment', user_pk=user.pk, steps='both')
+
+            # a report per part, as with the per part tasks
+            self.assertFalse(TaskReport.objects.filter(method='core.tasks.document_pipeline').exists())
+            report = TaskReport.objects.get(document_part=part)
+            self.assertEqual(report.method, 'core.tasks.segment')
+            self.assertEqual(report.workflow_state, TaskReport.WORKFLOW_STATE_DONE)
+            report2 = TaskReport.objects.get(document_part=part2)
+            self.assertEqual(report2.task_id, report.task_id)
+            self.assertEqual(report2.workflow_state, TaskReport.WORKFLOW_STATE_ERROR)
+
+            # the parts already processed are skipped when the task is retried
+            segment_mock.reset_mock()
+            with patch("core.tasks.send_event"):
+                document_pipeline.apply(kwargs={'document_pk': part.document.pk,
+                                                'instance_pks': [part.pk, part2.pk],
+                                                'process': 'segment',
+                                                'user_pk': user.pk,
+                                                'steps': 'both'},
+                                        task_id=report.task_id)
+            segment_mock.assert_not_called()
+
+    @override_settings(BINARIZATION_WORKERS=2)
+    def test_queue_binarization(self):
+        part = self.factory.make_part(workflow_state=DocumentPart.WORKFLOW_STATE_CONVERTED,
+                                      bw_backend=DocumentPart.BW_BACKEND_VIPS)
+        part2 = self.factory.make_part(document=part.document,
+                                       workflow_state=DocumentPart.WORKFLOW_STATE_CONVERTED,
+                                       bw_backend=DocumentPart.BW_BACKEND_VIPS)
+        part3 = self.factory.make_part(document=part.document)
+        user = part.document.owner
+
+        with patch.object(DocumentPart, "task") as task_mock:
+            with patch("core.models.send_event"), patch("core.tasks.send_event") as send_event_mock:
+                part.document.queue_binarization([part, part2, part3], user_pk=user.pk, threshold=0.5)
+
+        # the kraken backend still goes through the per part task
+        task_mock.assert_called_once_with("binarize", user_pk=user.pk, threshold=0.5)
+        statuses = [(call.args[2]['id'], call.args[2]['status'])
+                    for call in send_event_mock.call_args_list]
+        self.assertEqual(statuses[-2:], [(part.pk, 'done'), (part2.pk, 'done')])
+        for part_ in (part, part2):
+            part_.refresh_from_db()
+            self.assertTrue(part_.bw_image.name.endswith('.png'))
+            self.assertEqual((part_.bw_image.width, part_.bw_image.height),
+                             (part_.image.width, part_.image.height))
+            report = TaskReport.objects.get(document_part=part_)
+            self.assertEqual(report.method, 'core.tasks.binarize')
+            self.assertEqual(report.workflow_state, TaskReport.WORKFLOW_STATE_DONE)
+        self.assertFalse(TaskReport.objects.filter(document_part=part3).exists())
+
+    def test_cancel_batched_part(self):
+        part = self.factory.make_part()
+        part2 = self.factory.make_part(document=part.document)
+        reports = [TaskReport.objects.create(user=part.document.owner, label='test',
+                                             document=part.document, document_part=part_,
+                                             task_id='batch', method='core.tasks.segment')
+                   for part_ in (part, part2)]
+
+        with patch("reporting.models.app.control.revoke") as revoke_mock:
+            with patch("core.models.send_event"):
+                # a queued part is skipped by the batch, the other parts are still processed
+                part2.cancel_tasks()
+                revoke_mock.assert_not_called()
+                reports[1].refresh_from_db()
+                self.assertEqual(reports[1].workflow_state, TaskReport.WORKFLOW_STATE_CANCELED)
+
+                # stopping the batch cancels its other parts
+                reports[0].start()
+                part2 = self.factory.make_part(document=part.document)
+                reports.append(TaskReport.objects.create(user=part.document.owner, label='test',
+                                                         document=part.document, document_part=part2,
+                                                         task_id='batch', method='core.tasks.segment'))
+                part.cancel_tasks()
+                revoke_mock.assert_called_once_with('batch', terminate=True)
+                reports[2].refresh_from_db()
+                self.assertEqual(reports[2].workflow_state, TaskReport.WORKFLOW_STATE_CANCELED)
+
+    @patch("core.tasks.load_recognition_model")
+    def test_document_forced_align_task(self, load_mock):
+        self.makeTranscriptionContent()
+        part2 = self.factory.make_part(document=self.part.document)
+        self.factory.make_content(part2, amount=2, transcription=self.transcription)
+        model = self.factory.make_model(self.part.document)
+
+        def fake_align(seg, model_, im):
+            return [SimpleNamespace(prediction=line.text[:2],
+                                    cuts=[[[0, 0], [1, 1]]] * 2,
+                                    confidences=[0.5, 0.5])
+                    for line in seg.lines]
+
+        with patch("core.tasks.kraken_forced_align", side_effect=fake_align) as align_mock:
+            with patch("core.tasks.open_page_image", wraps=open_page_image) as open_mock:
+                with patch("core.tasks.send_event") as send_event_mock:
+                    document_forced_align.delay(document_pk=self.part.document.pk,
+                                                model_pk=model.pk,
+                                                transcription_pk=self.transcription.pk,
+                                                user_pk=self.part.document.owner.pk)
+
+        # the model is loaded once, and there is a single inference call per part with content
+        load_mock.assert_called_once_with(model.file.path)
+        self.assertEqual(align_mock.call_count, 2)
+        self.assertEqual(sorted(len(call.args[0].lines) for call in align_mock.call_args_list), [2, 30])
+        # on images read through the page image cache
+        self.assertEqual(open_mock.call_count, 2)
+        self.assertEqual(sorted(call.args[2].size for call in align_mock.call_args_list),
+                         sorted(Image.open(p.image.path).size for p in (self.part, part2)))
+        events = [call.args[1] for call in send_event_mock.call_args_list]
+        # progress is sent per part, like the per part task did
+        self.assertEqual(events, ['parts:workflow'] + ['part:workflow'] * 8)
+        done = [call.args[2] for call in send_event_mock.call_args_list
+                if call.args[1] == 'part:workflow' and call.args[2]['status'] == 'done']
+        self.assertEqual({state['process'] for state in done}, {'forced_align'})
+        self.assertEqual(sorted(state['data']['lines'] for state in done), [0, 0, 2, 30])
+
+        lt = LineTranscription.objects.filter(line__document_part=part2).first()
+        self.assertEqual(lt.graphs, [
+            {'c': lt.content[0], 'poly': [[0, 0], [1, 1]], 'confidence': 0.5},
+            {'c': lt.content[1], 'poly': [[0, 0], [1, 1]], 'confidence': 0.5},
+        ])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                       MASKS_COALESCE_WINDOW=1, MASKS_COALESCE_MAX_DELAY=5)
+    def test_schedule_recalculate_masks(self):
+        cache.clear()
+        with patch("core.tasks.recalculate_masks.apply_async") as apply_async_mock:
+            schedule_recalculate_masks(42, only=[1, 2])
+            schedule_recalculate_masks(42, only=[2, 3])
+            schedule_recalculate_masks(42, only=[4])
+            schedule_recalculate_masks(43, only=[5])
+
+        self.assertEqual([call.kwargs['kwargs']['generation'] for call in apply_async_mock.call_args_list],
+                         [1, 2, 3, 1])
+        self.assertEqual(apply_async_mock.call_args.kwargs['countdown'], 1)
+
+        # superseded tasks don't do anything, the last one handles every request
+        self.assertIs(_coalesced_masks_lines(42, 1), False)
+        self.assertEqual(sorted(_coalesced_masks_lines(42, 3)), [1, 2, 3, 4])
+        self.assertIs(_coalesced_masks_lines(42, 2), False)
+        self.assertEqual(_coalesced_masks_lines(43, 1), [5])
+
+        # all the lines
+        with patch("core.tasks.recalculate_masks.apply_async"):
+            schedule_recalculate_masks(42, only=[1])
+            schedule_recalculate_masks(42)
+        self.assertIsNone(_coalesced_masks_lines(42, 5))
+
+        # continuous editing doesn't postpone the recalculation forever
+        with patch("core.tasks.recalculate_masks.apply_async"):
+            schedule_recalculate_masks(42, only=[1])
+            schedule_recalculate_masks(42, only=[2])
+        cache.set(_masks_key(42, 'since'), time.time() - 10)
+        self.assertEqual(sorted(_coalesced_masks_lines(42, 6)), [1, 2])
+        self.assertIs(_coalesced_masks_lines(42, 7), False)
+
+        # two tasks running at the same time don't merge the same requests
+        with patch("core.tasks.recalculate_masks.apply_async"):
+            schedule_recalculate_masks(42, only=[1])
+            schedule_recalculate_masks(42, only=[2])
+        cache.set(_masks_key(42, 'since'), time.time() - 10)
+        with patch.object(cache, 'delete_many'):
+            # the requests are not deleted yet when the other task reads them
+            self.assertEqual(sorted(_coalesced_masks_lines(42, 8)), [1, 2])
+        cache.set(_masks_key(42, 'done'), 7)
+        self.assertIs(_coalesced_masks_lines(42, 9), False)
+
+    @patch("core.tasks.recalculate_masks.delay")
+    def test_schedule_recalculate_masks_no_cache(self, delay_mock):
+        # without a cache supporting counters, the masks are recalculated right away
+        schedule_recalculate_masks(42, user_pk=1, only=[1, 2])
+        delay_mock.assert_called_once_with(instance_pk=42, user_pk=1, only=[1, 2])
@@ -1,4 +1,11 @@
+import multiprocessing
 import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+from itertools import islice
+from multiprocessing import current_process
 
 from django.db.models import CharField
 from django.forms.widgets import Input
@@ -8,6 +15,66 @@ def random_color():
     return "#%06x" % random.randint(0, 0xFFFFFF)
 
 
+# workers -> pool of processes kept alive for the life of the current process, cf shared_process_pool()
+_shared_pools = {}
+
+
+def _spawn_process_pool(workers):
+    # Note hack to circumvent AssertionError: daemonic processes are not allowed to have children
+    current_process().daemon = False
+    # libvips and torch are not fork safe once initialized, spawn fresh workers instead
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def shared_process_pool(workers):
+    """
+    Returns a pool of workers processes started on first use and reused by the next calls,
+    for frequent work that can't afford to spawn fresh processes each time.
+    """
+    if workers not in _shared_pools:
+        _shared_pools[workers] = _spawn_process_pool(workers)
+    return _shared_pools[workers]
+
+
+def process_pool_imap(fn, jobs, workers, window=None, discard=None, executor=None):
+    """
+    Runs fn on each of jobs in a pool of workers processes, at most window jobs in advance,
+    yields (job, result) tuples in the order of jobs.
+    The pool is started for the call and shut down afterwards, unless an executor is given,
+    e.g. shared_process_pool(workers).
+    When the generator is closed early, discard(job, result) is called for the results
+    computed in advance that were not consumed.
+    fn must be importable from a fresh process, it shouldn't touch the database.
+    """
+    window = window or workers * 2
+    jobs = iter(jobs)
+    pending = deque()
+    with nullcontext(executor) if executor else _spawn_process_pool(workers) as executor:
+        try:
+            for job in islice(jobs, window):
+                pending.append((job, executor.submit(fn, job)))
+            while pending:
+                job, future = pending.popleft()
+                result = future.result()
+                # keep the pool busy while the result is consumed
+                for next_job in islice(jobs, 1):
+                    pending.append((next_job, executor.submit(fn, next_job)))
+                yield job, result
+        except BrokenProcessPool:
+            # a worker died, a shared pool is replaced on its next use
+            for key, pool in list(_shared_pools.items()):
+                if pool is executor:
+                    del _shared_pools[key]
+            raise
+        finally:
+            for job, future in pending:
+                future.cancel()
+            if discard:
+                for job, future in pending:
+                    if not future.cancelled() and future.exception() is None:
+                        discard(job, future.result())
+
+
 class ColorWidget(Input):
     input_type = 'color'
     template_name = 'core/widgets/color.html'
@@ -30,7 +30,6 @@ from django.views.generic import (
     UpdateView,
     View,
 )
-from easy_thumbnails.files import get_thumbnailer
 if settings.USE_OPENSEARCH:
     from opensearchpy import exceptions as es_exceptions
 else:
@@ -126,16 +125,28 @@ class BaseSearch(LoginRequiredMixin, PerPageMixin, FormView, TemplateView):
         # - the search terms are empty
         return not self.form.is_valid() or not self.form.cleaned_data.get('query')
 
-    def get_line_viewbox(self, bounding_box):
-        if not bounding_box:
-            return None, False
-
-        return ' '.join([
-            str(max([bounding_box[0] - 10, 0])),
-            str(max([bounding_box[1] - 10, 0])),
-            str(bounding_box[2] - bounding_box[0] + 20),
-            str(bounding_box[3] - bounding_box[1] + 20)
-        ]), (bounding_box[2] - bounding_box[0]) > (bounding_box[3] - bounding_box[1])
+    def get_line_crop(self, document_pk, part_pk, bounding_box, width, height, scale=1):
+        """
+        Returns the url of the image of a line served by the IIIF endpoint, its size and whether it's wider than tall,
+        bounding_box being given on an image of width x height pixels, the crop being rendered at scale.
+        """
+        if not bounding_box or not width or not height:
+            return None, None, None, False
+
+        x1, y1 = max(bounding_box[0] - 10, 0), max(bounding_box[1] - 10, 0)
+        x2, y2 = min(bounding_box[2] + 10, width), min(bounding_box[3] + 10, height)
+        if x2 <= x1 or y2 <= y1:
+            return None, None, None, False
+
+        # the region is given in percents, the size of the original image doesn't matter
+        region = 'pct:' + ','.join('%g' % round(value, 4) for value in (
+            x1 * 100 / width, y1 * 100 / height, (x2 - x1) * 100 / width, (y2 - y1) * 100 / height))
+        crop_width, crop_height = max(ceil((x2 - x1) * scale), 1), max(ceil((y2 - y1) * scale), 1)
+        url = reverse('api:part-iiif-image', kwargs={
+            'document_pk': document_pk, 'pk': part_pk, 'region': region, 'size': '%d,' % crop_width,
+            'rotation': '0', 'quality': 'default', 'extension': 'jpg'})
+        larger = (bounding_box[2] - bounding_box[0]) > (bounding_box[3] - bounding_box[1])
+        return url, crop_width, crop_height, larger
 
     def get_and_format_results(self, page=None, paginate_by=None):
         """
@@ -208,7 +219,10 @@ class Search(BaseSearch):
     def convert_hit_to_template(self, hit):
         hit_source = hit['_source']
         highlight = hit.get('highlight', {})
-        viewbox, larger = self.get_line_viewbox(hit_source['bounding_box'])
+        # the indexed bounding box is relative to the large thumbnail, shown at its scale
+        img_url, img_w, img_h, larger = self.get_line_crop(
+            hit_source['document_id'], hit_source['document_part_id'], hit_source['bounding_box'],
+            hit_source['image_width'], hit_source['image_height'])
 
         return {
             'object': {
@@ -233,10 +247,9 @@ class Search(BaseSearch):
             'context_after': highlight['context_after'][0] if highlight.get('context_after') else None,
             'replacement_preview': None,
             'score': hit['_score'],
-            'img_url': hit_source['image_url'],
-            'img_w': hit_source['image_width'],
-            'img_h': hit_source['image_height'],
-            'viewbox': viewbox,
+            'img_url': img_url,
+            'img_w': img_w,
+            'img_h': img_h,
             'larger': larger
         }
 
@@ -260,47 +273,23 @@ class FindAndReplace(BaseSearch):
     form_class = FindAndReplaceForm
     template_name = 'core/search/find_and_replace.html'
 
-    def get_part_image_thumbnail(self, part_image):
-        thumbnailer = get_thumbnailer(part_image)
-        try:
-            thumbnail = thumbnailer.get_thumbnail(
-                settings.THUMBNAIL_ALIASES['']['large'], generate=False
-            )
-            assert thumbnail
-        except Exception:
-            thumbnail = part_image
-            pass
-
-        # Factors to scale line bboxes if necessary
-        scale_factors = [
-            thumbnail.width / part_image.width,
-            thumbnail.height / part_image.height,
-        ] * 2
-
-        return thumbnail.url, thumbnail.width, thumbnail.height, scale_factors
-
-    def get_line_bounding_box(self, line, scale_factors):
-        line_box = line.get_box()
-        if not line_box:
-            return None
-
-        return [
-            ceil(value * factor)
-            for value, factor in zip(line_box, scale_factors)
-        ]
-
-    def convert_lt_object_to_template(self, mode, find_terms, replace_term, lt_object, thumbnails):
-        if lt_object.line.document_part_id not in thumbnails:
+    def get_part_image_size(self, part_image):
+        # crops are shown at the scale of the large thumbnail
+        max_width, max_height = settings.THUMBNAIL_ALIASES['']['large']['size']
+        width, height = part_image.width, part_image.height
+        return width, height, min(max_width / width, max_height / height, 1)
+
+    def convert_lt_object_to_template(self, mode, find_terms, replace_term, lt_object, images):
+        part = lt_object.line.document_part
+        if part.pk not in images:
             try:
-                thumbnail_url, thumbnail_width, thumbnail_height, scale_factors = self.get_part_image_thumbnail(lt_object.line.document_part.image)
+                images[part.pk] = self.get_part_image_size(part.image)
             except FileNotFoundError:
-                thumbnail_url, thumbnail_width, thumbnail_height = None, None, None
-                scale_factors = [1, 1, 1, 1]
-
-            thumbnails[lt_object.line.document_part_id] = {'url': thumbnail_url, 'width': thumbnail_width, 'height': thumbnail_height, 'scale_factors': scale_factors}
+                images[part.pk] = None, None, 1
 
-        bounding_box = self.get_line_bounding_box(lt_object.line, thumbnails[lt_object.line.document_part_id]['scale_factors'])
-        viewbox, larger = self.get_line_viewbox(bounding_box)
+        width, height, scale = images[part.pk]
+        img_url, img_w, img_h, larger = self.get_line_crop(
+            part.document_id, part.pk, lt_object.line.get_box(), width, height, scale=scale)
 
         return {
             'object': lt_object,
@@ -308,12 +297,11 @@ class FindAndReplace(BaseSearch):
             'context_after': None,
             'replacement_preview': build_highlighted_replacement_psql(mode, find_terms, replace_term, lt_object.highlighted_content),
             'score': 100,
-            'img_url': thumbnails[lt_object.line.document_part_id]['url'],
-            'img_w': thumbnails[lt_object.line.document_part_id]['width'],
-            'img_h': thumbnails[lt_object.line.document_part_id]['height'],
-            'viewbox': viewbox,
+            'img_url': img_url,
+            'img_w': img_w,
+            'img_h': img_h,
             'larger': larger,
-        }, thumbnails
+        }, images
 
     def get_mandatory_params(self):
         return self.form.cleaned_data.get('mode', WORD_BY_WORD_SEARCH_MODE), self.form.cleaned_data['query'], self.form.cleaned_data['replacement']
@@ -330,10 +318,10 @@ class FindAndReplace(BaseSearch):
             self.form.add_error(None, f'Something went wrong while searching for results - {e}')
             return [], None
 
-        thumbnails = {}
+        images = {}
         template_results = []
         for lt_object in results:
-            template_result, thumbnails = self.convert_lt_object_to_template(mode, find_terms, replace_term, lt_object, thumbnails)
+            template_result, images = self.convert_lt_object_to_template(mode, find_terms, replace_term, lt_object, images)
             template_results.append(template_result)
 
         return template_results, None
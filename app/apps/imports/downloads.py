@@ -0,0 +1,201 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+
+# status codes worth retrying
+TRANSIENT_ERRORS = (500, 502, 503, 504, 507, 508)
+# when a server throttles us without telling for how long, in seconds
+DEFAULT_RETRY_AFTER = 1
+CHUNK_SIZE = 64 * 1024
+
+
+def retry_after(response):
+    """
+    Returns the number of seconds to wait according to the Retry-After header of response,
+    which is either a number of seconds or a http date.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+class TokenBucket:
+    """
+    Delivers at most rate tokens per second, up to capacity at once after an idle period.
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif not self.rate:
+                    return
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                    self._updated_at = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """
+        No token is delivered for the next seconds, ie when a server asks us to slow down.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class Downloader:
+    """
+    Downloads files concurrently, streaming them to temporary files.
+
+    Requests to a same host are limited to settings.IIIF_IMPORT_HOST_CONCURRENCY at once
+    and settings.IIIF_IMPORT_HOST_RATE per second (a token bucket), a 429 or 503 answer
+    pausing all the requests to the host for the duration given by its Retry-After header.
+    Transient errors, network errors and timeouts are retried up to retry_limit times.
+    """
+
+    def __init__(self, workers=None, host_concurrency=None, host_rate=None, retry_limit=4, timeout=10):
+        self.workers = workers or getattr(settings, 'IIIF_IMPORT_WORKERS', 8)
+        self.host_concurrency = host_concurrency or getattr(settings, 'IIIF_IMPORT_HOST_CONCURRENCY', 4)
+        self.host_rate = host_rate if host_rate is not None else getattr(settings, 'IIIF_IMPORT_HOST_RATE', 5)
+        self.retry_limit = retry_limit
+        self.timeout = timeout
+        self._hosts = {}  # host -> (semaphore, token bucket)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def host_limits(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = (threading.BoundedSemaphore(self.host_concurrency),
+                                     TokenBucket(self.host_rate, capacity=self.host_concurrency))
+            return self._hosts[host]
+
+    @property
+    def session(self):
+        # one session per thread, keeping the connections alive between requests
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def fetch(self, url):
+        """
+        Returns a TemporaryUploadedFile holding the content of url, raises a DownloadError
+        if it couldn't be retrieved within the retry limit or the server answered with another error.
+        """
+        from imports.parsers import DownloadError
+
+        semaphore, bucket = self.host_limits(url)
+        current_retry = 0
+        while current_retry < self.retry_limit:
+            current_retry = current_retry + 1
+            if current_retry > 1:
+                time.sleep(0.1 * current_retry)  # add a little backoff
+            bucket.acquire()
+            try:
+                with semaphore:
+                    with self.session.get(url, stream=True, verify=False, timeout=self.timeout) as response:
+                        response.raise_for_status()
+                        tmp = TemporaryUploadedFile(
+                            url.split("/")[-1],
+                            response.headers.get('Content-Type'),
+                            0, None)
+                        try:
+                            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                                tmp.write(chunk)
+                        except BaseException:
+                            tmp.close()
+                            raise
+                        tmp.size = tmp.tell()
+                        tmp.seek(0)
+                        return tmp
+
+            except requests.exceptions.HTTPError as http_error:
+                status_code = http_error.response.status_code
+                if status_code == 429 or (status_code == 503 and 'Retry-After' in http_error.response.headers):
+                    # the server might tell us when we are free to go
+                    bucket.pause(retry_after(http_error.response))
+                    continue
+
+                # retry on transient 5XX errors, but keep a record of the retry count
+                if status_code in TRANSIENT_ERRORS:
+                    continue
+
+                # We probably got a 4XX error, but whatever it is just raise it
+                raise DownloadError(http_error)
+
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError):
+                # network error or timeout, retry
+                continue
+
+        # Max retries has been exceeded
+        raise DownloadError(f"After {current_retry} tries, the server still errors out loading"
+                            f": {url}")
+
+    def _fetch(self, url):
+        from imports.parsers import DownloadError
+
+        try:
+            return self.fetch(url), None
+        except DownloadError as e:
+            return None, e
+
+    def fetch_all(self, urls):
+        """
+        Yields a (TemporaryUploadedFile, None) or (None, DownloadError) tuple for each url,
+        in order, the files being downloaded by a pool of threads, at most two per thread in advance.
+        The files are the consumer's to close, except those downloaded in advance
+        which are removed if the generator is closed early.
+        """
+        urls = iter(urls)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque(executor.submit(self._fetch, url) for url in islice(urls, self.workers * 2))
+            try:
+                while pending:
+                    future = pending.popleft()
+                    next_url = next(urls, None)
+                    if next_url is not None:
+                        pending.append(executor.submit(self._fetch, next_url))
+                    yield future.result()
+            finally:
+                for future in pending:
+                    if not future.cancel() and future.exception() is None:
+                        tmp, error = future.result()
+                        if tmp is not None:
+                            tmp.close()
@@ -0,0 +1,42 @@
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from imports.models import Upload, upload_staging_dir
+
+
+class Command(BaseCommand):
+    help = "Remove the chunked uploads that weren't resumed for a while, and the staging files they left behind."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hours",
+            type=int,
+            help="Age in hours of the last chunk after which an upload is abandoned.",
+            default=getattr(settings, 'UPLOAD_EXPIRATION_HOURS', 48),
+        )
+
+    def handle(self, *args, **options):
+        limit = timezone.now() - timedelta(hours=options["hours"])
+        expired = Upload.objects.filter(updated_at__lt=limit)
+        count = 0
+        for upload in expired:
+            upload.delete()
+            count += 1
+
+        # uploads deleted along with their document don't remove their staging file
+        orphans = 0
+        staging_dir = upload_staging_dir()
+        if os.path.isdir(staging_dir):
+            known = {str(pk) for pk in Upload.objects.values_list('pk', flat=True)}
+            for name in os.listdir(staging_dir):
+                path = os.path.join(staging_dir, name)
+                # leave alone the uploads started after the query
+                if name not in known and os.path.getmtime(path) < limit.timestamp():
+                    os.remove(path)
+                    orphans += 1
+
+        self.stdout.write(f"Removed {count} expired uploads and {orphans} orphan staging files.")
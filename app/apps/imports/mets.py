@@ -1,14 +1,17 @@
-import io
 import logging
 import os
+import tempfile
 import zipfile
-from collections import namedtuple
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin, urlparse
 
 import requests
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.files import File
 from django.core.validators import URLValidator
+from django.utils.functional import cached_property
 from lxml import html
 from PIL import Image
 
@@ -35,6 +38,13 @@ PAGE_METADATA_MAPPING = {
 # For consistency, we use mimetypes for both the remote and the archive parsings
 SUPPORTED_IMAGE_MIMETYPES = ["image/gif", "image/jpeg", "image/png", "image/jp2"]
 
+# files of these groups are never imported
+SKIPPED_FILE_GROUPS = ['DOWNLOAD', 'FULLTEXT', 'MAX', 'MEDIUM', 'MIN', 'PRESENTATION', 'THUMBS']
+
+# remote files bigger than this are spilled to temporary files instead of being kept in memory
+SPOOL_MAX_SIZE = 10 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
 METSPage = namedtuple('METSPage', ['image', 'sources', 'metadata'], defaults=[None, {}, {}])
 
 
@@ -51,6 +61,20 @@ class METSProcessor:
         self.archive = archive
         self.mets_base_uri = mets_base_uri
         self.url_validator = URLValidator()
+        # (uri, future) of the remote files fetched in advance, in the order of the pages, cf prefetch()
+        self.prefetched = deque()
+        self.upcoming = iter(())
+        self.executor = None
+
+    @cached_property
+    def session(self):
+        # shared by the fetching threads, its pool keeps a connection alive for each of them
+        workers = getattr(settings, 'METS_IMPORT_WORKERS', 8)
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
 
     def retrieve_in_archive(self, filename):
         with zipfile.ZipFile(self.archive) as archive:
@@ -197,32 +221,109 @@ class METSProcessor:
         content_type = resp.headers.get("content-type")
         return content_type and content_type.startswith("image/"), content_type
 
+    def is_allowed_uri(self, uri):
+        domain = urlparse(uri).netloc
+        return '*' in settings.IMPORT_ALLOWED_DOMAINS or domain in settings.IMPORT_ALLOWED_DOMAINS
+
+    def fetch_remote_file(self, uri):
+        """
+        Returns the response to a GET on uri and, if it succeeded, its content in a temporary file
+        that is only written on disk if it is big. Called from the fetching threads.
+        """
+        response = self.session.get(uri, stream=True, timeout=60)
+        try:
+            content = None
+            if response.ok:
+                content = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    content.write(chunk)
+                content.seek(0)
+        finally:
+            response.close()
+        return response, content
+
+    def get_remote_file(self, uri):
+        for index, (prefetched_uri, future) in enumerate(self.prefetched):
+            if prefetched_uri == uri:
+                # the files fetched for the pages which failed before using them are dropped
+                for _ in range(index):
+                    self.discard_future(self.prefetched.popleft()[1])
+                self.prefetched.popleft()
+                self.fetch_next()
+                return future.result()
+        return self.fetch_remote_file(uri)
+
+    def remote_uris(self, pages, files):
+        from imports.parsers import ParseError
+
+        for page in pages:
+            for file_pointer in self.get_file_pointers(page):
+                try:
+                    file = files[file_pointer.get("FILEID")]
+                    href = self.get_file_location(file)
+                except (KeyError, ParseError):
+                    continue
+                if self.get_file_group_name(file) in SKIPPED_FILE_GROUPS:
+                    continue
+                uri = self.build_remote_uri(href)
+                if self.is_allowed_uri(uri):
+                    yield uri
+
+    def prefetch(self, executor, pages, files, window):
+        """
+        Starts fetching the remote files of the pages, in order, at most window of them in advance,
+        the next one being submitted each time a prefetched file is used.
+        Invalid pointers are left out, they are reported while processing their page.
+        """
+        self.executor = executor
+        self.upcoming = self.remote_uris(pages, files)
+        for _ in range(window):
+            self.fetch_next()
+
+    def fetch_next(self):
+        uri = next(self.upcoming, None)
+        if uri is not None:
+            self.prefetched.append((uri, self.executor.submit(self.fetch_remote_file, uri)))
+
+    @staticmethod
+    def discard_future(future):
+        if not future.cancel() and future.exception() is None:
+            response, content = future.result()
+            if content is not None:
+                content.close()
+
+    def discard_prefetched(self):
+        self.upcoming = iter(())
+        while self.prefetched:
+            self.discard_future(self.prefetched.popleft()[1])
+
     def handle_remote_pointer(self, href, mets_page_image, mets_page_sources, layer_name, layers_count):
         uri = self.build_remote_uri(href)
 
-        domain = urlparse(uri).netloc
-        if '*' not in settings.IMPORT_ALLOWED_DOMAINS and domain not in settings.IMPORT_ALLOWED_DOMAINS:
+        if not self.is_allowed_uri(uri):
+            domain = urlparse(uri).netloc
             self.report.append(f'The domain of the file URI is not allowed during import. Please contact an administrator to add the following domain to the list: "{domain}".', logger_fct=logger.error)
             return mets_page_image, mets_page_sources, layers_count
 
         # Downloading the file content
         try:
-            get_resp = requests.get(uri)
+            get_resp, content = self.get_remote_file(uri)
             is_image, content_type = self.check_is_image(get_resp)
 
             # Pointing towards an image but we already found one for this METS page or its format isn't supported, we can skip it
             if is_image and (mets_page_image or content_type not in SUPPORTED_IMAGE_MIMETYPES):
+                if content is not None:
+                    content.close()
                 return mets_page_image, mets_page_sources, layers_count
 
             get_resp.raise_for_status()
-            content = get_resp.content
-            file = io.BytesIO(content)
-            file.name = os.path.basename(uri)
-            if file.name == 'default.jpg':
+            name = os.path.basename(uri)
+            if name == 'default.jpg':
                 # Images from IIIF image servers require special handling.
                 # {scheme}://{server}{/prefix}/{identifier}/{region}/{size}/{rotation}/{quality}.{format}
                 scheme_server_prefix, identifier, region, size, rotation, quality_format = uri.rsplit('/', 5)
-                file.name = identifier + '.jpg'
+                name = identifier + '.jpg'
+            file = File(content, name=name)
         except requests.exceptions.RequestException as e:
             self.report.append(f"File not found on remote URI {uri}: {e}", logger_fct=logger.error)
             return mets_page_image, mets_page_sources, layers_count
@@ -253,7 +354,7 @@ class METSProcessor:
             href = self.get_file_location(file)
             layer_name = self.get_file_group_name(file) or f"Layer {layers_count}"
             # Skip files in some file groups
-            if layer_name in ['DOWNLOAD', 'FULLTEXT', 'MAX', 'MEDIUM', 'MIN', 'PRESENTATION', 'THUMBS']:
+            if layer_name in SKIPPED_FILE_GROUPS:
                 continue
 
             if self.archive:
@@ -274,15 +375,23 @@ class METSProcessor:
         files = self.get_files_from_file_sec()
 
         pages = self.get_pages_from_struct_map()
-        for index, page in enumerate(pages, start=1):
-            self.report.append(f"Processing the page n°{index} from the provided METS file", logger_fct=logger.info)
+        workers = getattr(settings, 'METS_IMPORT_WORKERS', 8)
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            if not self.archive and workers > 1:
+                # the remote files are fetched concurrently, pages are still processed in order
+                self.prefetch(executor, pages, files, window=workers * 2)
             try:
-                mets_page = self.process_single_page(page, files)
-            # Catch any exception so that we don't fail when only one page is in error
-            except Exception as e:
-                self.report.append(f"An exception occurred while processing the page: {e}", logger_fct=logger.error)
-                continue
-
-            mets_pages.append(mets_page)
+                for index, page in enumerate(pages, start=1):
+                    self.report.append(f"Processing the page n°{index} from the provided METS file", logger_fct=logger.info)
+                    try:
+                        mets_page = self.process_single_page(page, files)
+                    # Catch any exception so that we don't fail when only one page is in error
+                    except Exception as e:
+                        self.report.append(f"An exception occurred while processing the page: {e}", logger_fct=logger.error)
+                        continue
+
+                    mets_pages.append(mets_page)
+            finally:
+                self.discard_prefetched()
 
         return mets_pages, metadata
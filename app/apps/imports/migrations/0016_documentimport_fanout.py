@@ -0,0 +1,18 @@
+# Generated by Django 4.2.13 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('imports', '0015_alter_documentimport_import_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentimport',
+            name='fanout',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -1,10 +1,19 @@
+import base64
+import hashlib
+import mimetypes
 import os.path
+import shutil
+import tempfile
+import uuid
 
+from celery import chain, group
+from django.conf import settings
+from django.core.files import File
 from django.core.validators import FileExtensionValidator
-from django.db import models
+from django.db import models, transaction
 
 from core.models import Document
-from imports.parsers import XML_EXTENSIONS, make_parser
+from imports.parsers import XML_EXTENSIONS, ZipParser, make_parser
 from reporting.models import TaskReport
 from users.models import User
 
@@ -49,6 +58,9 @@ class DocumentImport(models.Model):
                                on_delete=models.CASCADE)
     processed = models.PositiveIntegerField(default=0)
     total = models.PositiveIntegerField(default=None, null=True, blank=True)
+    # chunks of the members of an archive imported in parallel, cf fan_out()
+    # {"images": [[name, ...], ...], "xml": [[name, ...], ...], "done": [chunk index, ...]}
+    fanout = models.JSONField(null=True, blank=True)
 
     class Meta:
         ordering = ['-started_on']
@@ -103,3 +115,207 @@ class DocumentImport(models.Model):
 
         else:
             parser.clean()
+
+    @property
+    def fanout_chunks(self):
+        # the images are imported first, so that the transcriptions find their parts
+        return self.fanout["images"] + self.fanout["xml"]
+
+    def fan_out(self, resume=True, user_pk=None):
+        """
+        Splits the import of a big archive in chunks of settings.IMPORT_FANOUT_CHUNK_SIZE files
+        imported by document_import_chunk tasks, all the images before the transcriptions,
+        document_import_done closing the import.
+        The chunks of images are imported one after the other, the parts take their position
+        when they are created so they must be created in the order of the archive,
+        the chunks of transcriptions are imported in parallel.
+        Returns False if the import isn't worth splitting and should be processed as usual.
+        """
+        from imports.tasks import document_import_chunk, document_import_done
+
+        parser = None
+        if not self.fanout:
+            min_files = getattr(settings, 'IMPORT_FANOUT_MIN_FILES', 50)
+            if not min_files or self.with_mets or os.path.splitext(self.import_file.name)[1] != '.zip':
+                return False
+            parser = make_parser(self.document, self.import_file, name=self.name, report=self.report)
+            images, xmls = parser.members_by_kind()
+            if len(images) + len(xmls) < min_files:
+                return False
+            size = max(getattr(settings, 'IMPORT_FANOUT_CHUNK_SIZE', 10), 1)
+            self.fanout = {
+                "images": [images[i:i + size] for i in range(0, len(images), size)],
+                "xml": [xmls[i:i + size] for i in range(0, len(xmls), size)],
+                "done": [],
+            }
+            self.processed = 0
+            self.total = len(images) + len(xmls)
+        elif not resume:
+            self.fanout["done"] = []
+            self.processed = 0
+
+        if self.fanout["xml"]:
+            # create the transcription once, the chunks would race to do it
+            (parser or ZipParser(self.document, self.import_file, self.report,
+                                 transcription_name=self.name)).transcription
+
+        self.workflow_state = self.WORKFLOW_STATE_STARTED
+        self.save()
+
+        def chunk_tasks(start, chunks):
+            return [document_import_chunk.si(import_pk=self.pk, chunk=index, user_pk=user_pk)
+                    for index, chunk in enumerate(chunks, start=start)
+                    if index not in self.fanout["done"]]
+
+        steps = chunk_tasks(0, self.fanout["images"])
+        xml_tasks = chunk_tasks(len(self.fanout["images"]), self.fanout["xml"])
+        if xml_tasks:
+            steps.append(group(xml_tasks))
+        steps.append(document_import_done.si(import_pk=self.pk, user_pk=user_pk))
+        chain(*steps).delay()
+        return True
+
+    def complete_chunk(self, index):
+        """
+        Marks a chunk as imported, processed only counts the files of the leading imported chunks
+        so that it never goes backward whatever the order in which the chunks end.
+        """
+        with transaction.atomic():
+            imp = DocumentImport.objects.select_for_update().get(pk=self.pk)
+            done = set(imp.fanout["done"]) | {index}
+            processed = 0
+            for i, chunk in enumerate(imp.fanout_chunks):
+                if i not in done:
+                    break
+                processed += len(chunk)
+            imp.fanout["done"] = sorted(done)
+            imp.processed = max(imp.processed, processed)
+            imp.save(update_fields=["fanout", "processed"])
+        self.fanout, self.processed = imp.fanout, imp.processed
+
+
+class UploadError(Exception):
+    pass
+
+
+class StagedFile(File):
+    """
+    A finished upload, the storage moves it in place rather than copying it,
+    like it does for the TemporaryUploadedFile of the upload handlers.
+    The handle on the staging file has to be closed once it's been handed over.
+    """
+
+    def __init__(self, path, name):
+        super().__init__(open(path, 'rb'), name=name)
+        self.path = path
+        self.content_type = mimetypes.guess_type(name)[0]
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def upload_staging_dir():
+    # on the same filesystem as the media, so that finished uploads can be renamed in place
+    return getattr(settings, 'UPLOAD_STAGING_DIR', os.path.join(settings.MEDIA_ROOT, 'upload_staging'))
+
+
+class Upload(models.Model):
+    """
+    A file uploaded in chunks that can be resumed from its offset if the transfer is interrupted,
+    once complete it's handed to a DocumentImport or a DocumentPart.
+    """
+    CHECKSUM_ALGORITHMS = ('sha1', 'sha256', 'md5')
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    document = models.ForeignKey(Document, on_delete=models.CASCADE)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=256)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return '%s %d/%d' % (self.filename, self.offset, self.size)
+
+    @property
+    def staging_path(self):
+        return os.path.join(upload_staging_dir(), str(self.id))
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def write_chunk(self, stream, offset, length, checksum=None):
+        """
+        Appends length bytes read from stream to the staging file, offset being where the client
+        thinks the upload is at. checksum is an optional '<algorithm> <base64 digest>' string,
+        a chunk not matching it is discarded.
+        Raises an UploadError if the chunk doesn't fit the upload.
+        """
+        if checksum:
+            try:
+                algorithm, expected = checksum.split(' ', 1)
+                expected = base64.b64decode(expected.strip(), validate=True)
+            except ValueError:
+                raise UploadError('Invalid checksum %r.' % checksum)
+            if algorithm not in self.CHECKSUM_ALGORITHMS:
+                raise UploadError('Unsupported checksum algorithm %r.' % algorithm)
+            digest = hashlib.new(algorithm)
+        else:
+            digest = None
+
+        if offset + length > self.size:
+            raise UploadError('The chunk exceeds the size of the upload.')
+
+        os.makedirs(upload_staging_dir(), exist_ok=True)
+        # the chunk is received before taking the lock, a slow client doesn't hold it
+        with tempfile.NamedTemporaryFile(dir=upload_staging_dir(), prefix='%s.' % self.id, suffix='.chunk') as chunk:
+            remaining = length
+            while remaining:
+                data = stream.read(min(remaining, 64 * 1024))
+                if not data:
+                    break
+                chunk.write(data)
+                if digest:
+                    digest.update(data)
+                remaining -= len(data)
+            if remaining:
+                raise UploadError('Incomplete chunk.')
+            if digest and digest.digest() != expected:
+                raise UploadError('Checksum mismatch.')
+            chunk.seek(0)
+
+            with transaction.atomic():
+                # concurrent chunks are serialized, the first one wins
+                upload = Upload.objects.select_for_update().get(pk=self.pk)
+                if offset != upload.offset:
+                    self.offset = upload.offset
+                    raise UploadError('Offset mismatch, the upload is at %d.' % upload.offset)
+
+                with open(self.staging_path, 'ab') as fh:
+                    # drop the tail of an interrupted chunk
+                    fh.truncate(upload.offset)
+                    shutil.copyfileobj(chunk, fh)
+
+                upload.offset += length
+                upload.save(update_fields=['offset', 'updated_at'])
+        self.offset, self.updated_at = upload.offset, upload.updated_at
+
+    def as_file(self):
+        """
+        Returns the finished upload as a file that the storage moves in place.
+        """
+        if not self.complete:
+            raise UploadError('The upload is not complete.')
+        return StagedFile(self.staging_path, self.filename)
+
+    def delete(self, *args, **kwargs):
+        try:
+            os.remove(self.staging_path)
+        except FileNotFoundError:
+            pass  # handed over, or nothing was uploaded
+        return super().delete(*args, **kwargs)
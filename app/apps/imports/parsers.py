@@ -2,25 +2,32 @@ import json
 import logging
 import os
 import re
-import time
+import shutil
+import tempfile
+import threading
 import uuid
 import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from statistics import mean
 
 import pyvips
 import requests
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
 from django.core.validators import get_available_image_extensions
 from django.db import transaction
+from django.db.models import Max
 from django.forms import ValidationError
+from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.translation import gettext as _
-from easy_thumbnails.files import get_thumbnailer
 from lxml import etree
 
 from core.models import (
     Block,
+    Document,
     DocumentMetadata,
     DocumentPart,
     DocumentPartMetadata,
@@ -29,12 +36,17 @@ from core.models import (
     Metadata,
     Transcription,
 )
+from imports.downloads import Downloader
 from imports.mets import METSProcessor
+from imports.pdf import PDF_DPI, rasterize_pages
+from imports.schemas import ESCRIPTORIUM_ALTO, SchemaUnavailable, get_schema
 from users.consumers import send_event
 from versioning.models import NoChangeException
 
 logger = logging.getLogger(__name__)
 XML_EXTENSIONS = ["xml", "alto"]  # , 'abbyy'
+# xml files of archives bigger than this are extracted on disk instead of in memory
+ZIP_SPOOL_MAX_SIZE = 10 * 1024 * 1024
 OWN_RISK = "the validity of the data can not be automatically checked, use at your own risks."
 
 
@@ -50,6 +62,65 @@ class DownloadError(ParseError):
     pass
 
 
+def get_file_size(file_handler):
+    try:
+        return file_handler.size
+    except AttributeError:
+        # temporary files and the like, for archive members use ZipInfo.file_size instead,
+        # seeking to the end of a ZipExtFile decompresses it
+        position = file_handler.tell()
+        size = file_handler.seek(0, os.SEEK_END)
+        file_handler.seek(position)
+        return size
+
+
+def load_xml(file_handler, file_size=None):
+    """
+    Returns the root element of an xml file and whether it has to be streamed,
+    big files are only read up to their first page, cf read_xml_header().
+    """
+    if file_size is None:
+        file_size = get_file_size(file_handler)
+    streaming = file_size > getattr(settings, 'XML_STREAMING_MIN_SIZE', 50) * 1024 * 1024
+    if streaming:
+        return read_xml_header(file_handler), True
+    file_handler.seek(0)
+    root = etree.parse(file_handler).getroot()
+    file_handler.seek(0)
+    return root, False
+
+
+def read_xml_header(file_handler, stop_tags=("Page", "Layout")):
+    """
+    Returns the root element of an xml file with only the children preceding
+    the first element whose local name is in stop_tags (namespaces, schema location, metadata, tags...),
+    without reading the rest of the file.
+    """
+    file_handler.seek(0)
+    root = None
+    for event, elem in etree.iterparse(file_handler, events=("start",)):
+        if root is None:
+            root = elem
+        elif etree.QName(elem).localname in stop_tags:
+            break
+    file_handler.seek(0)
+    return root
+
+
+def iterparse_elements(file_handler, tag, **kwargs):
+    """
+    Yields the elements of an xml file whose local name is tag, one at a time.
+    Each element, and everything preceding it, is cleared once the caller asks for the next one,
+    so that the memory usage is bounded by the biggest element instead of the whole document.
+    """
+    file_handler.seek(0)
+    for event, elem in etree.iterparse(file_handler, events=("end",), tag="{*}%s" % tag, **kwargs):
+        yield elem
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
 class ParserDocument:
     """
     The base class for parsing files to populate a core.Document object
@@ -86,11 +157,7 @@ class ParserDocument:
         pass
 
     def post_process_image(self, part):
-        # generate the card thumbnail right away to show the image card
-        if getattr(settings, 'THUMBNAIL_ENABLE', True):
-            get_thumbnailer(part.image).get_thumbnail(
-                settings.THUMBNAIL_ALIASES[""]["card"]
-            )
+        # the card thumbnail is generated by the convert task and pushed to the client
         send_event("document", part.document.pk, "part:new", {
             "id": part.pk
         })
@@ -118,65 +185,139 @@ class PdfParser(ParserDocument):
         else:
             return 0
 
+    def get_part(self, fname):
+        try:
+            return DocumentPart.objects.filter(
+                document=self.document,
+                original_filename=fname
+            )[0]
+        except IndexError:
+            # we do not use DoesNotExist because documents could have
+            # duplicate image names at some point.
+            return DocumentPart(
+                document=self.document,
+                original_filename=fname
+            )
+
+    def save_page(self, part, pdfname):
+        part.source = f"pdf//{pdfname}"
+        part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
+        part.save()
+        self.post_process_image(part)
+
+    def check_quota(self, user, page_nb, n_pages, start_at):
+        # If quotas are enforced, assert that the user still has free disk storage
+        if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
+            raise DiskQuotaReachedError(
+                _(f"You ran out of disk storage. {n_pages - page_nb} pages were left to import (over {n_pages - start_at})")
+            )
+
+    def report_error(self, page_nb, error):
+        self.report.append(
+            _("Parse error in {filename}: {page}: {error}, skipping it.").format(
+                filename=self.file.name, page=page_nb + 1, error=error
+            ),
+            logger_fct=logger.warning,
+        )
+
     def parse(self, start_at=0, override=False, user=None):
         assert (
             self.report
         ), "A TaskReport instance should be provided while parsing data."
 
+        workers = getattr(settings, 'PDF_IMPORT_WORKERS', 4)
+        try:
+            pdf_path = self.file.path
+        except (AttributeError, NotImplementedError, ValueError):
+            # not stored on the local file system
+            pdf_path = None
+
+        if workers > 1 and pdf_path:
+            yield from self.parse_parallel(pdf_path, workers, start_at=start_at, user=user)
+        else:
+            yield from self.parse_sequential(start_at=start_at, user=user)
+
+    def parse_sequential(self, start_at=0, user=None):
         buff = self.file.read()
         doc = pyvips.Image.pdfload_buffer(buff, n=-1, access='sequential')
         n_pages = doc.get('n-pages')
+        pdfname = os.path.basename(self.file.name)
         try:
             for page_nb in range(start_at, n_pages):
-                # If quotas are enforced, assert that the user still has free disk storage
-                if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
-                    raise DiskQuotaReachedError(
-                        _(f"You ran out of disk storage. {n_pages - page_nb} pages were left to import (over {n_pages - start_at})")
-                    )
-
+                self.check_quota(user, page_nb, n_pages, start_at)
                 page = pyvips.Image.pdfload_buffer(buff,
                                                    page=page_nb,
-                                                   dpi=300,
+                                                   dpi=PDF_DPI,
                                                    access='sequential')
-                pdfname = os.path.basename(self.file.name)
                 fname = '%s_page_%d.png' % (pdfname, page_nb + 1)
-                try:
-                    part = DocumentPart.objects.filter(
-                        document=self.document,
-                        original_filename=fname
-                    )[0]
-                except IndexError:
-                    # we do not use DoesNotExist because documents could have
-                    # duplicate image names at some point.
-                    part = DocumentPart(
-                        document=self.document,
-                        original_filename=fname
-                    )
-
+                part = self.get_part(fname)
                 part.image_file_size = 0
                 part.image.save(fname, ContentFile(page.write_to_buffer('.png')))
                 part.image_file_size = part.image.size
-                part.source = f"pdf//{pdfname}"
-                part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
-                part.save()
-                self.post_process_image(part)
+                self.save_page(part, pdfname)
 
                 yield part
-                page_nb = page_nb + 1
 
         except pyvips.error.Error as e:
-            self.report.append(
-                _("Parse error in {filename}: {page}: {error}, skipping it.").format(
-                    filename=self.file.name, page=page_nb + 1, error=e.args[0]
-                ),
-                logger_fct=logger.warning,
-            )
+            self.report_error(page_nb, e.args[0])
+
+    def parse_parallel(self, pdf_path, workers, start_at=0, user=None):
+        """
+        Pages are rasterized by a pool of processes writing directly at their final place in the storage,
+        parts are still created and yielded in the order of the pages so that the progress
+        and the resuming of the import (start_at) are unchanged.
+        """
+        n_pages = pyvips.Image.pdfload(pdf_path, n=-1, access='sequential').get('n-pages')
+        pdfname = os.path.basename(self.file.name)
+        field = DocumentPart._meta.get_field('image')
+        names = {}
+
+        def jobs():
+            for page_nb in range(start_at, n_pages):
+                fname = '%s_page_%d.png' % (pdfname, page_nb + 1)
+                name = field.storage.get_available_name(
+                    field.generate_filename(DocumentPart(document=self.document), fname),
+                    max_length=field.max_length)
+                names[page_nb] = (fname, name)
+                yield pdf_path, page_nb, field.storage.path(name)
+
+        pages = rasterize_pages(jobs(), workers)
+        try:
+            for page_nb in range(start_at, n_pages):
+                self.check_quota(user, page_nb, n_pages, start_at)
+                job, size, error = next(pages)
+                if error is not None:
+                    self.report_error(page_nb, error)
+                    break
+
+                fname, name = names.pop(page_nb)
+                part = self.get_part(fname)
+                part.image = name
+                part.image_file_size = size
+                self.save_page(part, pdfname)
+
+                yield part
+        finally:
+            # stops the workers and removes the pages rendered in advance
+            pages.close()
 
     def clean(self):
         # if the import went well we are safe to delete the file
         os.remove(os.path.join(settings.MEDIA_ROOT, self.file.path))
 
 
+def member_kind(filename):
+    """
+    Returns 'image' or 'xml' depending on the extension of an archive member, or None if it is ignored.
+    """
+    file_extension = os.path.splitext(filename)[1][1:]
+    if file_extension.lower() in get_available_image_extensions():
+        return 'image'
+    elif file_extension in XML_EXTENSIONS:
+        return 'xml'
+    return None
+
+
 class ZipParser(ParserDocument):
     """
     For now only deals with a flat list of ALTO files
@@ -203,70 +344,194 @@ class ZipParser(ParserDocument):
         with zipfile.ZipFile(self.file) as zfh:
             return len(zfh.infolist())
 
+    def existing_parts(self):
+        """
+        Maps the original filenames of the parts of the document to the first part bearing it.
+        """
+        parts = {}
+        for part in DocumentPart.objects.filter(document=self.document):
+            parts.setdefault(part.original_filename, part)
+        return parts
+
+    def extract_member(self, zfh, finfo):
+        """
+        Images are streamed to the storage, their name in the storage is returned,
+        other files are extracted in a temporary file, kept in memory if small enough.
+        Doesn't touch the database, it is called from the extraction threads.
+        """
+        with zfh.open(finfo) as zipedfh:
+            filename = os.path.basename(finfo.filename)
+            if member_kind(filename) == 'image':
+                field = DocumentPart._meta.get_field('image')
+                content = File(zipedfh, name=filename)
+                content.size = finfo.file_size
+                return field.storage.save(
+                    field.generate_filename(DocumentPart(document=self.document), filename),
+                    content,
+                    max_length=field.max_length)
+
+            tmp = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
+            shutil.copyfileobj(zipedfh, tmp)
+            tmp.seek(0)
+            return File(tmp, name=finfo.filename)
+
+    def discard_member(self, extracted):
+        if isinstance(extracted, File):
+            extracted.close()
+        else:
+            DocumentPart._meta.get_field('image').storage.delete(extracted)
+
+    def extract_members(self, zfh, infos):
+        """
+        Yields the extracted members of infos (cf extract_member) in order.
+        They are extracted by a pool of settings.ZIP_IMPORT_WORKERS threads, each reading
+        its own handle of the archive, at most two members per thread in advance.
+        """
+        workers = getattr(settings, 'ZIP_IMPORT_WORKERS', 4)
+        try:
+            zip_path = self.file.path
+        except (AttributeError, NotImplementedError, ValueError):
+            # not stored on the local file system
+            zip_path = None
+
+        if workers <= 1 or not zip_path:
+            for finfo in infos:
+                yield self.extract_member(zfh, finfo)
+            return
+
+        local = threading.local()
+        handles = []
+
+        def extract(finfo):
+            if not hasattr(local, 'zfh'):
+                local.zfh = zipfile.ZipFile(zip_path)
+                handles.append(local.zfh)
+            return self.extract_member(local.zfh, finfo)
+
+        infos = iter(infos)
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = deque((finfo, executor.submit(extract, finfo))
+                                for finfo in islice(infos, workers * 2))
+                try:
+                    while pending:
+                        finfo, future = pending.popleft()
+                        next_info = next(infos, None)
+                        if next_info is not None:
+                            pending.append((next_info, executor.submit(extract, next_info)))
+                        yield future.result()
+                finally:
+                    # the consumer stopped early, don't leave the members extracted in advance behind
+                    for finfo, future in pending:
+                        if not future.cancel() and future.exception() is None:
+                            self.discard_member(future.result())
+        finally:
+            for handle in handles:
+                handle.close()
+
+    def members_by_kind(self):
+        """
+        Returns the names of the image members and the names of the xml members of the archive.
+        """
+        images, xmls = [], []
+        with zipfile.ZipFile(self.file) as zfh:
+            for finfo in zfh.infolist():
+                kind = member_kind(os.path.basename(finfo.filename))
+                if kind == 'image':
+                    images.append(finfo.filename)
+                elif kind == 'xml':
+                    xmls.append(finfo.filename)
+        return images, xmls
+
     def parse(self, start_at=0, override=False, user=None):
         assert (
             self.report
         ), "A TaskReport instance should be provided while parsing data."
 
         with zipfile.ZipFile(self.file) as zfh:
-            total = len(zfh.infolist())
-            for index, finfo in enumerate(zfh.infolist()):
-                if index < start_at:
+            infolist = zfh.infolist()
+            yield from self.parse_infos(zfh, list(enumerate(infolist))[start_at:], len(infolist),
+                                        start_at=start_at, override=override, user=user)
+
+    def parse_members(self, names, override=False, user=None):
+        """
+        Only imports the members names of the archive, cf DocumentImport.fan_out().
+        """
+        assert (
+            self.report
+        ), "A TaskReport instance should be provided while parsing data."
+
+        with zipfile.ZipFile(self.file) as zfh:
+            infos = [(index, zfh.getinfo(name)) for index, name in enumerate(names)]
+            yield from self.parse_infos(zfh, infos, len(names), override=override, user=user)
+
+    def parse_infos(self, zfh, infos, total, start_at=0, override=False, user=None):
+        """
+        infos is a list of (index, ZipInfo) tuples of the members to import.
+        """
+        # filename -> part, loaded on the first image
+        parts = None
+        members = self.extract_members(zfh, [
+            finfo for index, finfo in infos
+            if member_kind(os.path.basename(finfo.filename))
+        ])
+        try:
+            for index, finfo in infos:
+                filename = os.path.basename(finfo.filename)
+                kind = member_kind(filename)
+                if kind is None:
                     continue
-                with zfh.open(finfo) as zipedfh:
-                    try:
-                        filename = os.path.basename(zipedfh.name)
-                        file_extension = os.path.splitext(filename)[1][1:]
-                        # image
-                        if file_extension.lower() in get_available_image_extensions():
-                            # If quotas are enforced, assert that the user still has free disk storage
-                            if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
-                                raise DiskQuotaReachedError(
-                                    _(f"You ran out of disk storage. {total - index} files were left to import (over {total - start_at})")
-                                )
-                            try:
-                                part = DocumentPart.objects.filter(
-                                    document=self.document,
-                                    original_filename=filename
-                                )[0]
-                            except IndexError:
-                                # we do not use DoesNotExist because documents could have
-                                # duplicate image names at some point.
-                                part = DocumentPart(
-                                    document=self.document,
-                                    original_filename=filename
-                                )
-                            part.image_file_size = 0
-                            part.image.save(filename, ContentFile(zipedfh.read()))
-                            part.image_file_size = part.image.size
-                            part.source = "zip//{0}/{1}".format(
-                                os.path.basename(self.file.name),
-                                filename
-                            )
-                            part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
-                            part.save()
-                            self.post_process_image(part)
 
-                        # xml
-                        elif file_extension in XML_EXTENSIONS:
-                            parser = make_parser(self.document, zipedfh,
-                                                 name=self.name, report=self.report)
+                # image
+                if kind == 'image':
+                    # If quotas are enforced, assert that the user still has free disk storage
+                    if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
+                        raise DiskQuotaReachedError(
+                            _(f"You ran out of disk storage. {total - index} files were left to import (over {total - start_at})")
+                        )
+                    stored_name = next(members)
+                    if parts is None:
+                        parts = self.existing_parts()
+                    part = parts.get(filename)
+                    if part is None:
+                        # we do not use DoesNotExist because documents could have
+                        # duplicate image names at some point.
+                        part = parts[filename] = DocumentPart(
+                            document=self.document,
+                            original_filename=filename
+                        )
+                    part.image = stored_name
+                    part.image_file_size = finfo.file_size
+                    part.source = "zip//{0}/{1}".format(
+                        os.path.basename(self.file.name),
+                        filename
+                    )
+                    part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
+                    part.save()
+                    self.post_process_image(part)
+
+                # xml
+                else:
+                    with next(members) as xmlfh:
+                        try:
+                            parser = make_parser(self.document, xmlfh,
+                                                 name=self.name, report=self.report,
+                                                 file_size=finfo.file_size)
 
                             for part in parser.parse(override=override, user=user):
                                 yield part
-                    except IndexError:
-                        # no file extension!?
-                        pass
-                    except ParseError as e:
-                        # we let go to try other documents
-                        msg = _(
-                            "Parse error in {filename}: {xmlfile}: {error}, skipping it."
-                        ).format(
-                            filename=self.file.name, xmlfile=filename, error=e.args[0]
-                        )
-                        self.report.append(msg, logger_fct=logger.warning)
-                        if user:
-                            user.notify(msg, id="import:warning", level="warning")
+                        except ParseError as e:
+                            # we let go to try other documents
+                            msg = _(
+                                "Parse error in {filename}: {xmlfile}: {error}, skipping it."
+                            ).format(
+                                filename=self.file.name, xmlfile=filename, error=e.args[0]
+                            )
+                            self.report.append(msg, logger_fct=logger.warning)
+                            if user:
+                                user.notify(msg, id="import:warning", level="warning")
+        finally:
+            members.close()
 
     def clean(self):
         # if the import went well we are safe to delete the file
@@ -294,7 +559,8 @@ class METSBaseParser():
                 original_filename=filename
             )
         part.image_file_size = 0
-        part.image.save(filename, ContentFile(image.read()))
+        # streamed to the storage
+        part.image.save(filename, File(image))
         part.image_file_size = part.image.size
         part.source = source
         part.workflow_state = DocumentPart.WORKFLOW_STATE_CONVERTED
@@ -480,7 +746,8 @@ class METSZipParser(ZipParser, METSBaseParser):
                         filename = os.path.basename(zipped_source.name)
 
                         try:
-                            parser = make_parser(self.document, zipped_source, name=f"{self.name} | {layer_name}", report=self.report, zip_allowed=False, pdf_allowed=False)
+                            parser = make_parser(self.document, zipped_source, name=f"{self.name} | {layer_name}", report=self.report, zip_allowed=False, pdf_allowed=False,
+                                                 file_size=archive.getinfo(source).file_size)
                             # We only want to override for the first imported source if there are multiple ones
                             for part in parser.parse(override=(override and index == 0), user=user):
                                 # If we have a page with an image + multiple sources, we don't want to
@@ -510,49 +777,61 @@ class METSZipParser(ZipParser, METSBaseParser):
 
 class XMLParser(ParserDocument):
     ACCEPTED_SCHEMAS = ()
+    # local name of the elements returned by get_pages()
+    PAGE_TAG = "Page"
 
-    def __init__(self, document, file_handler, report, transcription_name=None, xml_root=None):
+    def __init__(self, document, file_handler, report, transcription_name=None, xml_root=None, streaming=False):
         super().__init__(document,
                          file_handler,
                          transcription_name=transcription_name,
                          report=report)
-        if xml_root is not None:
-            self.root = xml_root
+        # big files are read page by page, only their header is kept in self.root, cf iter_pages()
+        self.streaming = streaming
+        if xml_root is None:
             try:
-                self.schema_location = self.root.xpath(
-                    "//*/@xsi:schemaLocation",
-                    namespaces={"xsi": "http://www.w3.org/2001/XMLSchema-instance"},
-                )[0].split(" ")[-1]
-            except (etree.XPathEvalError, IndexError) as e:
-                message = "Cannot Find Schema location %s, %s" % (e.args[0], OWN_RISK)
-                if report:
-                    report.append(message)
-                else:
-                    raise ParseError(message)
-        else:
-            try:
-                self.root = etree.parse(self.file).getroot()
+                xml_root, self.streaming = load_xml(self.file)
             except (AttributeError, etree.XMLSyntaxError) as e:
                 raise ParseError("Invalid XML. %s" % e.args[0])
+        # the number of pages of a streamed file, counted while validating it
+        self.page_count = None
+
+        self.root = xml_root
+        try:
+            self.schema_location = self.root.xpath(
+                "//*/@xsi:schemaLocation",
+                namespaces={"xsi": "http://www.w3.org/2001/XMLSchema-instance"},
+            )[0].split(" ")[-1]
+        except (etree.XPathEvalError, IndexError) as e:
+            message = "Cannot Find Schema location %s, %s" % (e.args[0], OWN_RISK)
+            if report:
+                report.append(message)
+            else:
+                raise ParseError(message)
         # instance attribute storing all line confidences, for computing the average at the end
         # of the import
         self.all_line_confidences = []
+        # typologies already fetched or created, cf get_typology()
+        self.typologies = {}
 
     def validate(self):
         if self.schema_location in self.ACCEPTED_SCHEMAS:
             try:
-                response = requests.get(self.schema_location)
-                content = response.content
-                schema_root = etree.XML(content)
-            except requests.exceptions.RequestException as e:
+                # compiled once per process, from the bundled copy if there is one
+                xmlschema = get_schema(self.schema_location)
+            except (SchemaUnavailable, requests.exceptions.RequestException,
+                    etree.XMLSchemaParseError, etree.XMLSyntaxError) as e:
                 logger.exception(e)
                 if self.report:
                     self.report.append("Can't reach validation document %s, %s" % (
                         self.schema_location, OWN_RISK))
             else:
                 try:
-                    xmlschema = etree.XMLSchema(schema_root)
-                    xmlschema.assertValid(self.root)
+                    if self.streaming:
+                        # validates while parsing, one page at a time
+                        self.page_count = sum(
+                            1 for pageTag in iterparse_elements(self.file, self.PAGE_TAG, schema=xmlschema))
+                    else:
+                        xmlschema.assertValid(self.root)
                 except (
                     AttributeError,
                     etree.DocumentInvalid,
@@ -571,6 +850,16 @@ class XMLParser(ParserDocument):
     def get_pages(self):
         raise NotImplementedError
 
+    def iter_pages(self):
+        if not self.streaming:
+            yield from self.get_pages()
+            return
+
+        for pageTag in iterparse_elements(self.file, self.PAGE_TAG):
+            # the root of the tree being built, it contains the header (descriptions, tags...)
+            self.root = pageTag.getroottree().getroot()
+            yield pageTag
+
     def get_blocks(self, pageTag):
         raise NotImplementedError
 
@@ -589,47 +878,123 @@ class XMLParser(ParserDocument):
     def get_transcription_content(self, lineTag):
         raise NotImplementedError
 
-    def make_transcription(self, line, lineTag, content, avg_confidence=None, user=None):
-        try:
-            # lazily creates the Transcription on the fly if need be cf transcription() property
-            lt = LineTranscription.objects.get(
-                transcription=self.transcription, line=line
-            )
-        except LineTranscription.DoesNotExist:
-            lt = LineTranscription(
-                version_source="import",
-                version_author=user and user.username or "",
+    def get_typology(self, valid_types, name, message):
+        # typologies are looked up (or created) only once per file
+        key = (valid_types.model, name)
+        if key not in self.typologies:
+            typo = valid_types.filter(name=name).first()
+            if typo is None:
+                with transaction.atomic():
+                    # the chunks of an import run in parallel, the names are not unique,
+                    # locking the document makes them create a new type only once
+                    Document.objects.select_for_update().get(pk=self.document.pk)
+                    typo = valid_types.filter(name=name).first()
+                    if typo is None:
+                        typo = valid_types.create(name=name)
+                        self.report.append(message.format(typo.name))
+            self.typologies[key] = typo
+        return self.typologies[key]
+
+    def get_block_type(self, name):
+        return self.get_typology(self.document.valid_block_types, name,
+                                 _("Block type {0} was automatically added to the ontology"))
+
+    def get_line_type(self, name):
+        return self.get_typology(self.document.valid_line_types, name,
+                                 _("Line type {0} was automatically added to the ontology"))
+
+    @staticmethod
+    def external_ids_map(qs, external_ids):
+        """
+        Returns a {external_id: instance} dict of the objects of qs matching external_ids,
+        in a single query.
+        """
+        external_ids = {external_id for external_id in external_ids if external_id}
+        if not external_ids:
+            return {}
+        instances = {}
+        for instance in qs.filter(external_id__in=external_ids).order_by('order'):
+            instances.setdefault(instance.external_id, instance)
+        return instances
+
+    @staticmethod
+    def validate_geometry(instance):
+        # foreign keys are not validated, they are set from already saved objects
+        # and checking them would cost a query each
+        instance.clean_fields(exclude=["document_part", "block", "typology"])
+        instance.clean()
+
+    @staticmethod
+    def save_instances(model, instances, fields, qs):
+        """
+        Creates the new instances (numbered after the existing ones of qs)
+        and updates the given fields of the existing ones, in bulk.
+        """
+        new = [instance for instance in instances if instance.pk is None]
+        existing = [instance for instance in instances if instance.pk is not None]
+        if new:
+            # OrderedModel.save is bypassed by bulk_create, so we have to number the objects ourselves
+            max_order = qs.aggregate(Max("order"))["order__max"]
+            for order, instance in enumerate(new, start=0 if max_order is None else max_order + 1):
+                instance.order = order
+            model.objects.bulk_create(new)
+        model.objects.bulk_update(existing, fields)
+
+    def make_transcriptions(self, contents, user=None):
+        """
+        contents is a list of (line, content, avg_confidence) tuples (one per line),
+        creates or updates (keeping the history) the corresponding LineTranscriptions in bulk.
+        """
+        # lazily creates the Transcription on the fly if need be cf transcription() property
+        existing = {
+            lt.line_id: lt
+            for lt in LineTranscription.objects.filter(
                 transcription=self.transcription,
-                line=line,
-            )
-        else:
-            try:
-                lt.new_version(author=user and user.username,
-                               source='import')  # save current content in history
-            except NoChangeException:
-                pass
-        finally:
+                line__in=[line.pk for line, content, avg_confidence in contents])
+        }
+        to_create, to_update = [], []
+        now = timezone.now()
+        for line, content, avg_confidence in contents:
+            lt = existing.get(line.pk)
+            if lt is None:
+                lt = LineTranscription(
+                    version_source="import",
+                    version_author=user and user.username or "",
+                    transcription=self.transcription,
+                    line=line,
+                )
+                to_create.append(lt)
+            else:
+                try:
+                    lt.new_version(author=user and user.username,
+                                   source='import')  # save current content in history
+                except NoChangeException:
+                    pass
+                # bulk_update doesn't honor auto_now
+                lt.version_updated_at = now
+                to_update.append(lt)
             lt.content = content
             if avg_confidence:
                 lt.avg_confidence = avg_confidence
-            lt.save()
 
-            # update the avg confidence across the whole transcription
-            if self.all_line_confidences:
-                lt.transcription.avg_confidence = mean(self.all_line_confidences)
-            lt.transcription.save()
+        LineTranscription.objects.bulk_create(to_create)
+        LineTranscription.objects.bulk_update(to_update, [
+            "content", "avg_confidence", "versions", "revision",
+            "version_author", "version_source", "version_created_at", "version_updated_at"])
+        return len(to_create) + len(to_update)
 
     def parse(self, start_at=0, override=False, user=None):
         assert (
             self.report
         ), "A TaskReport instance should be provided while parsing data."
 
-        pages = self.get_pages()
-        n_pages = len(pages)
+        n_pages = 0
         n_blocks = 0
         n_lines = 0
+        n_transcriptions = 0
 
-        for pageTag in pages:
+        for pageTag in self.iter_pages():
+            n_pages += 1
             # find the filename to match with existing images
             filename = self.get_filename(pageTag)
             try:
@@ -654,23 +1019,35 @@ class XMLParser(ParserDocument):
                     # store the max average confidence for comparison
                     max_avg_confidence = part.max_avg_confidence
 
-                    blocks = self.get_blocks(pageTag)
+                    blocks = [(block_id, blockTag, self.get_lines(blockTag))
+                              for block_id, blockTag in self.get_blocks(pageTag)]
                     n_blocks += len(blocks)
 
-                    for block_id, blockTag in blocks:
+                    # existing objects are fetched once for the whole page
+                    existing_blocks = self.external_ids_map(part.blocks.all(), [
+                        block_id for block_id, blockTag, lines in blocks
+                        if block_id and not block_id.startswith("eSc_dummyblock_")])
+                    existing_lines = self.external_ids_map(part.lines.all(), [
+                        line_id for block_id, blockTag, lines in blocks for line_id, lineTag in lines])
+
+                    # instances to save, keyed by id() since new instances have no pk
+                    blocks_to_save = {}
+                    page_blocks = []
+                    for block_id, blockTag, lines in blocks:
+                        block = None
                         if block_id and not block_id.startswith("eSc_dummyblock_"):
-                            try:
-                                block = Block.objects.get(document_part=part, external_id=block_id)
-                            except Block.DoesNotExist:
+                            block = existing_blocks.get(block_id)
+                            if block is None:
                                 # not found, create it then
                                 block = Block(document_part=part, external_id=block_id)
+                                existing_blocks[block_id] = block
                             try:
                                 self.update_block(block, blockTag)
                             except TypeError:
                                 block = None
                             else:
                                 try:
-                                    block.full_clean()
+                                    self.validate_geometry(block)
                                 except ValidationError as e:
                                     self.report.append(
                                         _(
@@ -681,30 +1058,35 @@ class XMLParser(ParserDocument):
                                             error=e,
                                         )
                                     )
+                                    blocks_to_save.pop(id(block), None)
                                 else:
-                                    block.save()
-                        else:
-                            block = None
+                                    blocks_to_save[id(block)] = block
+                        page_blocks.append(block)
 
-                        lines = self.get_lines(blockTag)
+                    self.save_instances(Block, list(blocks_to_save.values()),
+                                        ["box", "typology"], part.blocks.all())
+
+                    lines_to_save = {}
+                    contents = {}
+                    for block, (block_id, blockTag, lines) in zip(page_blocks, blocks):
+                        if block is not None and block.pk is None:
+                            # the block didn't validate
+                            block = None
                         n_lines += len(lines)
 
                         for line_id, lineTag in lines:
-                            if line_id:
-                                try:
-                                    line = Line.objects.get(document_part=part, external_id=line_id)
-                                except Line.DoesNotExist:
-                                    line = None
-                            else:
-                                line = None
-
+                            line = existing_lines.get(line_id) if line_id else None
                             if line is None:
                                 # not found, create it then
                                 line = Line(document_part=part, block=block, external_id=line_id)
+                                if line_id:
+                                    existing_lines[line_id] = line
+                                else:
+                                    line.make_external_id()
 
                             self.update_line(line, lineTag)
                             try:
-                                line.full_clean()
+                                self.validate_geometry(line)
                             except ValidationError as e:
                                 self.report.append(
                                     _(
@@ -716,17 +1098,26 @@ class XMLParser(ParserDocument):
                                         error=e,
                                     )
                                 )
+                                lines_to_save.pop(id(line), None)
                             else:
-                                line.save()
+                                lines_to_save[id(line)] = line
 
-                            # needs to be done after line is created!
                             tc = self.get_transcription_content(lineTag)
                             ac = self.get_avg_confidence(lineTag)
                             if ac:
                                 self.all_line_confidences.append(ac)
                                 part_line_confidences.append(ac)
                             if tc:
-                                self.make_transcription(line, lineTag, tc, avg_confidence=ac, user=user)
+                                contents[id(line)] = (line, tc, ac)
+
+                    self.save_instances(Line, list(lines_to_save.values()),
+                                        ["baseline", "mask", "typology"], part.lines.all())
+
+                    # needs to be done after lines are created!
+                    contents = [content for content in contents.values() if content[0].pk is not None]
+                    if contents:
+                        n_transcriptions += self.make_transcriptions(contents, user=user)
+
                     if part_line_confidences:
                         # if applicable, store max avg confidence / best transcription on document part
                         part_avg_confidence = mean(part_line_confidences)
@@ -738,16 +1129,24 @@ class XMLParser(ParserDocument):
                 part.calculate_progress()
                 yield part
 
+        if n_transcriptions:
+            # update the avg confidence across the whole transcription, once per file
+            if self.all_line_confidences:
+                self.transcription.avg_confidence = mean(self.all_line_confidences)
+            self.transcription.save()
+
 
 class AltoParser(XMLParser):
     DEFAULT_NAME = _("Default ALTO Import")
-    escriptorium_alto = "https://gitlab.inria.fr/scripta/escriptorium/-/raw/develop/app/escriptorium/static/alto-4-1-baselines.xsd"
+    escriptorium_alto = ESCRIPTORIUM_ALTO
 
     ACCEPTED_SCHEMAS = (
         "http://www.loc.gov/standards/alto/v4/alto.xsd",
         "http://www.loc.gov/standards/alto/v4/alto-4-0.xsd",
         "http://www.loc.gov/standards/alto/v4/alto-4-1.xsd",
         "http://www.loc.gov/standards/alto/v4/alto-4-2.xsd",
+        "http://www.loc.gov/standards/alto/v4/alto-4-3.xsd",
+        "http://www.loc.gov/standards/alto/v4/alto-4-4.xsd",
         escriptorium_alto
     )
 
@@ -803,12 +1202,7 @@ The ALTO file should contain a Description/sourceImageInformation/fileName tag f
             type_ = None
 
         if type_:
-            typo, created = self.document.valid_block_types.get_or_create(name=type_)
-            block.typology = typo
-            if created:
-                self.report.append(
-                    _("Block type {0} was automatically added to the ontology").format(typo.name)
-                )
+            block.typology = self.get_block_type(type_)
 
     def update_line(self, line, lineTag):
         baseline = lineTag.get("BASELINE")
@@ -866,12 +1260,7 @@ The ALTO file should contain a Description/sourceImageInformation/fileName tag f
             type_ = None
 
         if type_:
-            typo, created = self.document.valid_line_types.get_or_create(name=type_)
-            line.typology = typo
-            if created:
-                self.report.append(
-                    _("Line type {0} was automatically added to the ontology").format(typo.name)
-                )
+            line.typology = self.get_line_type(type_)
 
     def get_transcription_content(self, lineTag):
         return " ".join(
@@ -897,8 +1286,11 @@ class PagexmlParser(XMLParser):
     @property
     def total(self):
         # PAGE file can contain multiple parts
-        if not self.root:
-            self.root = etree.parse(self.file).getroot()
+        if self.streaming:
+            if self.page_count is None:
+                # not validated, the file has to be read once more
+                self.page_count = sum(1 for pageTag in iterparse_elements(self.file, self.PAGE_TAG))
+            return self.page_count
         return len(self.root.findall("Page", self.root.nsmap))
 
     def get_filename(self, pageTag):
@@ -936,12 +1328,7 @@ The PAGE file should contain an attribute imageFilename in Page tag for matching
                     type_ = match.groups()[0]
 
         if type_:
-            typo, created = self.document.valid_block_types.get_or_create(name=type_)
-            block.typology = typo
-            if created:
-                self.report.append(
-                    _("Block type {0} was automatically added to the ontology").format(typo.name)
-                )
+            block.typology = self.get_block_type(type_)
 
     def update_line(self, line, lineTag):
         try:
@@ -974,12 +1361,7 @@ The PAGE file should contain an attribute imageFilename in Page tag for matching
                     type_ = match.groups()[0]
 
         if type_:
-            typo, created = self.document.valid_line_types.get_or_create(name=type_)
-            line.typology = typo
-            if created:
-                self.report.append(
-                    _("Line type {0} was automatically added to the ontology").format(typo.name)
-                )
+            line.typology = self.get_line_type(type_)
 
     def clean_coords(self, coordTag):
         try:
@@ -1044,54 +1426,25 @@ class IIIFManifestParser(ParserDocument):
     def total(self):
         return len(self.canvases)
 
-    @staticmethod
-    def get_image(url: str, retry_limit: int = 4) -> requests.Response:
-        """Retrieve a iiif image from a iiif server
-
-        This method will retry on certain 5XX errors, network and timeout.
-        It will only retry a fixed number of times (default 3),
-        and it backs off a little more on each retry. Failure to retrieve
-        the image within the retry limit will result in a DownloadError
-        being raised. All other unsuccessful requests will raise a
-        DownloadError as well.
-        """
-
-        current_retry = 0
-        while current_retry < retry_limit:
-            current_retry = current_retry + 1
-            time.sleep(0.1 * current_retry)  # avoid being throttled; add a little backoff
-            try:
-                response = requests.get(url, stream=True, verify=False, timeout=10)
-                response.raise_for_status()
-                return response
-
-            except requests.exceptions.HTTPError as http_error:
-                # retry on transient 5XX errors, but keep a record of the retry count
-                if http_error.response.status_code in [500, 502, 503, 504, 507, 508]:
-                    continue
-
-                if http_error.response.status_code == 429:
-                    # the server might tell us when we are free to go, if not let's wait 1s
-                    sleep_time = http_error.response.headers.get('Retry-After', 1)
-                    time.sleep(sleep_time)
-                    continue
-
-                # We probably got a 4XX error, but whatever it is just raise it
-                raise DownloadError(http_error)
-
-            except requests.exceptions.ConnectionError:
-                # network error, retry
-                continue
-
-            except requests.exceptions.Timeout:
-                # timeout, retry
-                continue
-
-        # Max retries has been exceeded
-        raise DownloadError(f"After {current_retry} tries, the server still errors out loading"
-                            f": {url}")
+    def canvas_url(self, canvas):
+        resource = canvas["images"][0]["resource"]
+        uri_template = "{image}/{region}/{size}/{rotation}/{quality}.{format}"
+        return uri_template.format(
+            image=resource["service"]["@id"],
+            region="full",
+            size=getattr(settings, "IIIF_IMPORT_QUALITY", "full"),
+            rotation=0,
+            quality="default",
+            format="jpg",
+        )  # we could gain some time by fetching png, but it's not implemented everywhere.
+        # TODO, we should probably grab the iiif image manifest, it will tell
+        # us important things about the supported file types and the available sizing.
 
     def parse(self, start_at=0, override=False, user=None):
+        """
+        Images are downloaded concurrently (cf imports.downloads.Downloader),
+        parts are still created in the order of the canvases.
+        """
         assert (
             self.report
         ), "A TaskReport instance should be provided while parsing data."
@@ -1108,31 +1461,40 @@ class IIIFManifestParser(ParserDocument):
             pass
 
         total = len(self.canvases)
+        canvases = []  # (index, canvas, url or None, error or None)
         for i, canvas in enumerate(self.canvases):
             if i < start_at:
                 continue
+            try:
+                canvases.append((i, canvas, self.canvas_url(canvas), None))
+            except (KeyError, IndexError) as e:
+                canvases.append((i, canvas, None, e))
 
-            # If quotas are enforced, assert that the user still has free disk storage
-            if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
-                raise DiskQuotaReachedError(
-                    _(f"You ran out of disk storage. {total - i} canvases were left to import (over {total - start_at})")
-                )
+        downloads = Downloader().fetch_all(url for i, canvas, url, error in canvases if url)
+        try:
+            for i, canvas, url, error in canvases:
+                # If quotas are enforced, assert that the user still has free disk storage
+                if not settings.DISABLE_QUOTAS and not user.has_free_disk_storage():
+                    raise DiskQuotaReachedError(
+                        _(f"You ran out of disk storage. {total - i} canvases were left to import (over {total - start_at})")
+                    )
 
-            try:
-                resource = canvas["images"][0]["resource"]
-                uri_template = "{image}/{region}/{size}/{rotation}/{quality}.{format}"
-                url = uri_template.format(
-                    image=resource["service"]["@id"],
-                    region="full",
-                    size=getattr(settings, "IIIF_IMPORT_QUALITY", "full"),
-                    rotation=0,
-                    quality="default",
-                    format="jpg",
-                )  # we could gain some time by fetching png, but it's not implemented everywhere.
-                # TODO, we should probably grab the iiif image manifest, it will tell
-                # us important things about the supported file types and the available sizing.
-                r = self.get_image(url)
+                if error is None:
+                    image, error = next(downloads)
+
+                if error is not None:
+                    self.report.append(
+                        _("Error while fetching {filename}: {error}").format(
+                            filename=url or canvas.get("@id", i), error=error
+                        )
+                    )
+                    if isinstance(error, DownloadError):
+                        error_msg = f"Could not download image: {url}"
+                        user.notify(error_msg, level="warning", id="import:warning")
+                        self.report.append(error_msg)
+                    continue
 
+                resource = canvas["images"][0]["resource"]
                 try:
                     part = DocumentPart.objects.filter(
                         document=self.document,
@@ -1149,24 +1511,16 @@ class IIIFManifestParser(ParserDocument):
                 name = "%d_%s_%s" % (i, uuid.uuid4().hex[:5], url.split("/")[-1])
                 part.original_filename = name
                 part.image_file_size = 0
-                part.image.save(name, ContentFile(r.content), save=False)
+                with image:
+                    # the downloaded file is moved to the storage
+                    part.image.save(name, image, save=False)
                 part.image_file_size = part.image.size
                 part.save()
                 self.post_process_image(part)
 
                 yield part
-                time.sleep(0.1)  # avoid being throttled
-
-            except (KeyError, IndexError, DownloadError) as e:
-                self.report.append(
-                    _("Error while fetching {filename}: {error}").format(
-                        filename=name, error=e
-                    )
-                )
-                if isinstance(e, DownloadError):
-                    error_msg = f"Could not download image: {url}"
-                    user.notify(error_msg, level="warning", id="import:warning")
-                    self.report.append(error_msg)
+        finally:
+            downloads.close()
 
 
 class TranskribusPageXmlParser(PagexmlParser):
@@ -1195,12 +1549,17 @@ class TranskribusPageXmlParser(PagexmlParser):
             raise ParseError(msg)
 
 
-def make_parser(document, file_handler, name=None, report=None, zip_allowed=True, pdf_allowed=True, mets_describer=False, mets_base_uri=None):
+def make_parser(document, file_handler, name=None, report=None, zip_allowed=True, pdf_allowed=True, mets_describer=False, mets_base_uri=None,
+                file_size=None):
+    """
+    file_size can be given when it's known without reading the file, eg for an archive member.
+    """
     # TODO: not great to rely on file name extension
     ext = os.path.splitext(file_handler.name)[1][1:]
     if ext in XML_EXTENSIONS:
         try:
-            root = etree.parse(file_handler).getroot()
+            # the file is parsed once, the format of a file too big to be loaded at once is detected from its header
+            root, streaming = load_xml(file_handler, file_size=file_size)
         except etree.XMLSyntaxError as e:
             raise ParseError(e.msg)
         try:
@@ -1217,18 +1576,25 @@ def make_parser(document, file_handler, name=None, report=None, zip_allowed=True
         #     return AbbyyParser(root, name=name)
         if "alto" in schema.lower():
             return AltoParser(
-                document, file_handler, report, transcription_name=name, xml_root=root
+                document, file_handler, report, transcription_name=name, xml_root=root, streaming=streaming
             )
         elif "PAGE" in schema:
-            if b"Transkribus" in etree.tostring(root):
+            # Transkribus metadata are in the header
+            metadata = root.find("{*}Metadata")
+            if metadata is not None and b"Transkribus" in etree.tostring(metadata):
                 return TranskribusPageXmlParser(
-                    document, file_handler, report, transcription_name=name, xml_root=root
+                    document, file_handler, report, transcription_name=name, xml_root=root, streaming=streaming
                 )
             else:
                 return PagexmlParser(
-                    document, file_handler, report, transcription_name=name, xml_root=root
+                    document, file_handler, report, transcription_name=name, xml_root=root, streaming=streaming
                 )
         elif METSProcessor.NAMESPACES["mets"] in schemas:
+            if streaming:
+                try:
+                    root = etree.parse(file_handler).getroot()
+                except etree.XMLSyntaxError as e:
+                    raise ParseError(e.msg)
             return METSRemoteParser(document, file_handler, report, root, mets_base_uri, transcription_name=name)
 
         else:
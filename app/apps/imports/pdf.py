@@ -0,0 +1,44 @@
+import os
+
+import pyvips
+
+from core.utils import process_pool_imap
+
+# resolution at which the pages of pdf files are rasterized
+PDF_DPI = 300
+
+
+def rasterize_page(job):
+    """
+    Renders a page of a pdf file in a png file at dest_path,
+    returns a (file size, error message) tuple.
+    Runs in a pool worker, it doesn't touch the database.
+    """
+    pdf_path, page_nb, dest_path = job
+    try:
+        page = pyvips.Image.pdfload(pdf_path, page=page_nb, dpi=PDF_DPI, access='sequential')
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        page.pngsave(dest_path)
+    except pyvips.error.Error as e:
+        return None, e.args[0]
+    return os.path.getsize(dest_path), None
+
+
+def rasterize_pages(jobs, workers, window=None):
+    """
+    jobs is an iterable of (pdf path, page number, destination path) tuples,
+    they are rendered by a pool of workers processes, at most window pages in advance.
+    Yields (job, file size, error message) tuples in the order of jobs.
+    Pages rendered but not consumed when the generator is closed are removed.
+    """
+    def discard(job, result):
+        size, error = result
+        if error is None:
+            os.remove(job[2])
+
+    results = process_pool_imap(rasterize_page, jobs, workers, window=window, discard=discard)
+    try:
+        for job, (size, error) in results:
+            yield job, size, error
+    finally:
+        results.close()
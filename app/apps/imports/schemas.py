@@ -0,0 +1,148 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+# local copies of the published schemas, stored under their url (without the scheme)
+BUNDLED_SCHEMAS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "xsd")
+
+ESCRIPTORIUM_ALTO = "https://gitlab.inria.fr/scripta/escriptorium/-/raw/develop/app/escriptorium/static/alto-4-1-baselines.xsd"
+
+ALTO_V4 = os.path.join(BUNDLED_SCHEMAS_DIR, "www.loc.gov", "standards", "alto", "v4", "alto-4-4.xsd")
+
+# published schemas that are already part of the code base,
+# ALTO 4 minor versions only add optional elements so 4.4 validates all of them
+SCHEMA_ALIASES = {
+    ESCRIPTORIUM_ALTO: os.path.join(settings.BASE_DIR, "escriptorium", "static", "alto-4-1-baselines.xsd"),
+    "http://www.loc.gov/standards/alto/v4/alto.xsd": ALTO_V4,
+    "http://www.loc.gov/standards/alto/v4/alto-4-0.xsd": ALTO_V4,
+    "http://www.loc.gov/standards/alto/v4/alto-4-1.xsd": ALTO_V4,
+    "http://www.loc.gov/standards/alto/v4/alto-4-2.xsd": ALTO_V4,
+    "http://www.loc.gov/standards/alto/v4/alto-4-3.xsd": ALTO_V4,
+}
+
+
+class SchemaUnavailable(Exception):
+    pass
+
+
+def local_schema_path(url):
+    """
+    Returns the path of a local copy of the schema published at url, or None.
+    Copies are looked for in settings.XML_SCHEMAS_DIR then in the bundled ones,
+    both being laid out like the urls, ie http://www.loc.gov/standards/alto/v4/alto-4-2.xsd
+    is expected at <dir>/www.loc.gov/standards/alto/v4/alto-4-2.xsd
+    """
+    if url in SCHEMA_ALIASES:
+        return SCHEMA_ALIASES[url]
+
+    segments = url.split("://", 1)[-1].split("?")[0].split("/")
+    if ".." in segments:
+        return None
+    for directory in (getattr(settings, "XML_SCHEMAS_DIR", None), BUNDLED_SCHEMAS_DIR):
+        if directory:
+            path = os.path.join(directory, *segments)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def download_schema(url):
+    if not getattr(settings, "XML_SCHEMAS_REMOTE_TTL", 86400):
+        # air-gapped workers
+        raise SchemaUnavailable("%s is not available locally and remote schemas are disabled." % url)
+    response = requests.get(url, timeout=30)
+    response.raise_for_status()
+    return response.content
+
+
+class SchemaResolver(etree.Resolver):
+    """
+    Resolves the schemas imported or included by a schema with their local copies,
+    downloading them only if there is none.
+    """
+
+    def resolve(self, url, public_id, context):
+        if "://" not in url or url.startswith("file://"):
+            # already local, loaded as usual
+            return None
+        path = local_schema_path(url)
+        if path:
+            return self.resolve_filename(path, context)
+        try:
+            return self.resolve_string(download_schema(url), context, base_url=url)
+        except (SchemaUnavailable, requests.exceptions.RequestException) as e:
+            logger.warning("Can't resolve %s: %s", url, e)
+            # let lxml fail on its own
+            return None
+
+
+class SchemaCache:
+    """
+    A per process cache of compiled XML schemas, memoized by url.
+
+    Local copies are compiled once and kept for the lifetime of the process,
+    downloaded schemas are kept settings.XML_SCHEMAS_REMOTE_TTL seconds,
+    and so are download failures, so that the files of an import don't retry them one by one.
+    """
+
+    def __init__(self):
+        self._schemas = {}  # url -> (XMLSchema, expiration time or None)
+        self._failures = {}  # url -> (exception, expiration time)
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """
+        Returns the compiled schema published at url.
+        Raises SchemaUnavailable or requests.exceptions.RequestException if it can't be found,
+        etree.XMLSchemaParseError or etree.XMLSyntaxError if it is invalid.
+        """
+        with self._lock:
+            schema, expires_at = self._schemas.get(url, (None, None))
+            failure, retry_at = self._failures.get(url, (None, None))
+        if schema is not None and (expires_at is None or expires_at > time.monotonic()):
+            return schema
+        if failure is not None and retry_at > time.monotonic():
+            raise failure
+
+        parser = etree.XMLParser()
+        parser.resolvers.add(SchemaResolver())
+        path = local_schema_path(url)
+        if path:
+            # the original url is kept as base url so that relative imports are resolved the same way
+            schema_root = etree.parse(path, parser, base_url=url)
+            expires_at = None
+            schema = etree.XMLSchema(schema_root)
+        else:
+            expires_at = time.monotonic() + getattr(settings, "XML_SCHEMAS_REMOTE_TTL", 86400)
+            try:
+                schema_root = etree.fromstring(download_schema(url), parser, base_url=url).getroottree()
+                schema = etree.XMLSchema(schema_root)
+            except (requests.exceptions.RequestException,
+                    etree.XMLSchemaParseError, etree.XMLSyntaxError) as e:
+                with self._lock:
+                    self._failures[url] = (e, expires_at)
+                raise
+
+        with self._lock:
+            self._schemas[url] = (schema, expires_at)
+            self._failures.pop(url, None)
+        return schema
+
+    def clear(self):
+        with self._lock:
+            self._schemas.clear()
+            self._failures.clear()
+
+
+schema_cache = SchemaCache()
+
+
+def get_schema(url):
+    return schema_cache.get(url)
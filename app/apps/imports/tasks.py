@@ -4,11 +4,13 @@ import os.path
 from celery import shared_task
 from django.apps import apps
 from django.conf import settings
-from django.db.models import Q
+from django.db.models import Avg, Q, Value
+from django.db.models.functions import Concat
 from django.utils.translation import gettext as _
 
 from escriptorium.utils import send_email
 from imports.export import ENABLED_EXPORTERS
+from imports.parsers import make_parser
 
 # DO NOT REMOVE THIS IMPORT, it will break celery tasks located in this file
 from reporting.tasks import create_task_reporting  # noqa F401
@@ -44,6 +46,11 @@ def document_import(task, import_pk=None, resume=True, task_id=None, user_pk=Non
             "id": imp.document.pk
         })
 
+        if imp.fan_out(resume=resume, user_pk=user_pk):
+            # split across workers, document_import_done takes care of the end of the import
+            task.request.keep_report_open = True
+            return
+
         for obj in imp.process(resume=resume):
             send_event('document', imp.document.pk, "import:progress", {
                 "id": imp.document.pk,
@@ -74,6 +81,120 @@ def document_import(task, import_pk=None, resume=True, task_id=None, user_pk=Non
         imp.report.end()
 
 
+def import_failed(imp, user, error):
+    imp.workflow_state = imp.WORKFLOW_STATE_ERROR
+    imp.error_message = str(error)[:512]
+    imp.save(update_fields=["workflow_state", "error_message"])
+    if user:
+        user.notify(_("Something went wrong during the import!"),
+                    links=[{'text': 'Report', 'src': imp.report.uri}],
+                    id="import-error", level='danger')
+    send_event('document', imp.document.pk, "import:error", {
+        "id": imp.document.pk,
+        "reason": str(error)
+    })
+
+
+class ChunkReport:
+    """
+    Gathers the messages of a chunk of an import, they are appended to the report
+    of the import at once as concurrent chunks would overwrite each other's.
+    """
+
+    def __init__(self):
+        self.messages = ''
+
+    def append(self, text, logger_fct=None):
+        if logger_fct:
+            logger_fct(text)
+        self.messages += text + '\n'
+
+
+@shared_task(bind=True, autoretry_for=(MemoryError,), default_retry_delay=60)
+def document_import_chunk(task, import_pk=None, chunk=None, user_pk=None):
+    """
+    Imports a chunk of the members of an archive, cf DocumentImport.fan_out().
+    It has no report of its own, it writes to the report of the import.
+    """
+    DocumentImport = apps.get_model('imports', 'DocumentImport')
+    TaskReport = apps.get_model('reporting', 'TaskReport')
+    User = apps.get_model('users', 'User')
+
+    imp = DocumentImport.objects.select_related('document', 'report').get(pk=import_pk)
+    if imp.workflow_state != DocumentImport.WORKFLOW_STATE_STARTED:
+        # canceled, or another chunk failed
+        return
+
+    user = User.objects.get(pk=user_pk)
+    report = ChunkReport()
+    parser = make_parser(imp.document, imp.import_file, name=imp.name, report=report)
+    try:
+        for obj in parser.parse_members(imp.fanout_chunks[chunk], override=imp.override, user=user):
+            pass
+    except Exception as e:
+        logger.exception(e)
+        imp.report.refresh_from_db()
+        imp.report.messages += report.messages
+        imp.report.error(str(e))
+        import_failed(imp, user, e)
+        return
+
+    if report.messages:
+        TaskReport.objects.filter(pk=imp.report.pk).update(messages=Concat('messages', Value(report.messages)))
+
+    imp.complete_chunk(chunk)
+    send_event('document', imp.document.pk, "import:progress", {
+        "id": imp.document.pk,
+        "progress": imp.processed,
+        "total": imp.total
+    })
+
+
+@shared_task(bind=True)
+def document_import_done(task, import_pk=None, user_pk=None):
+    """
+    Ends an import split across workers, once all its chunks are imported.
+    Like the chunks it writes to the report of the import.
+    """
+    DocumentImport = apps.get_model('imports', 'DocumentImport')
+    LineTranscription = apps.get_model('core', 'LineTranscription')
+    User = apps.get_model('users', 'User')
+
+    imp = DocumentImport.objects.select_related('document', 'report').get(pk=import_pk)
+    if imp.workflow_state != DocumentImport.WORKFLOW_STATE_STARTED:
+        return
+
+    user = User.objects.get(pk=user_pk)
+    parser = make_parser(imp.document, imp.import_file, name=imp.name, report=imp.report)
+    if imp.fanout["xml"]:
+        # each chunk only knows about its own lines
+        transcription = parser.transcription
+        avg = (LineTranscription.objects
+               .filter(transcription=transcription, avg_confidence__isnull=False)
+               .aggregate(avg=Avg("avg_confidence"))["avg"])
+        if avg is not None:
+            transcription.avg_confidence = avg
+            transcription.save()
+
+    imp.workflow_state = DocumentImport.WORKFLOW_STATE_DONE
+    imp.processed = imp.total
+    imp.save(update_fields=["workflow_state", "processed"])
+    parser.clean()
+
+    imp.report.refresh_from_db()
+    if user:
+        if imp.report.messages:
+            user.notify(_("Import finished with warnings!"),
+                        links=[{'text': _('Details'), 'src': imp.report.uri}],
+                        level='warning')
+        else:
+            user.notify(_("Import done!"), level='success')
+    send_event('document', imp.document.pk, "import:done", {"id": imp.document.pk})
+    imp.report.end()
+    # the chunks have no report of their own, the import accounts for them
+    imp.report.calc_cpu_cost(os.cpu_count())
+
+
 @shared_task(bind=True)
 def document_export(task, file_format, part_pks,
                     transcription_pk, region_types, document_pk=None, include_images=False,
@@ -1,9 +1,14 @@
+import base64
+import hashlib
 import os.path
+import zipfile
+from io import BytesIO
 from unittest import mock
 
 from django.core.files.base import ContentFile
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
+from django.test import override_settings
 from django.urls import reverse
 
 from core.models import (
@@ -15,8 +20,9 @@ from core.models import (
     Transcription,
 )
 from core.tests.factory import CoreFactoryTestCase
-from imports.models import DocumentImport
+from imports.models import DocumentImport, Upload
 from imports.parsers import AltoParser, IIIFManifestParser
+from imports.tests.test_downloads import IIIFStandIn
 from reporting.models import TaskReport
 
 # DO NOT REMOVE THIS IMPORT, it will break a lot of tests
@@ -81,7 +87,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_single.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(60):
+            with self.assertNumQueries(41):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -105,7 +111,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_single_baselines.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(44):
+            with self.assertNumQueries(41):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -129,7 +135,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test.zip'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(77):
+            with self.assertNumQueries(55):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -145,6 +151,70 @@ class XmlImportTestCase(CoreFactoryTestCase):
         self.assertEqual(self.part2.blocks.count(), 1)
         self.assertEqual(self.part2.lines.count(), 1)
 
+    @override_settings(IMPORT_FANOUT_MIN_FILES=1, IMPORT_FANOUT_CHUNK_SIZE=1)
+    def test_alto_multi_fanout(self):
+        uri = reverse('api:document-imports', kwargs={'pk': self.document.pk})
+        filename = 'test.zip'
+        mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
+        with open(mock_path, 'rb') as fh:
+            response = self.client.post(uri, {
+                'upload_file': SimpleUploadedFile(filename, fh.read())
+            })
+            self.assertEqual(response.status_code, 200)
+
+        imp = DocumentImport.objects.get()
+        self.assertEqual(imp.workflow_state, DocumentImport.WORKFLOW_STATE_DONE)
+        self.assertEqual(len(imp.fanout["done"]), len(imp.fanout_chunks))
+        self.assertEqual(imp.processed, imp.total)
+
+        self.assertEqual(self.part1.blocks.count(), 1)
+        self.assertEqual(self.part1.lines.count(), 3)
+        self.assertEqual(self.part2.blocks.count(), 1)
+        self.assertEqual(self.part2.lines.count(), 1)
+
+    @override_settings(IMPORT_FANOUT_MIN_FILES=1, IMPORT_FANOUT_CHUNK_SIZE=1)
+    def test_images_fanout(self):
+        uri = reverse('api:document-imports', kwargs={'pk': self.document.pk})
+        names = ['c.png', 'a.png', 'b.png', 'd.png']
+        archive = BytesIO()
+        with open(os.path.join(os.path.dirname(__file__), 'mocks', 'test.png'), 'rb') as fh:
+            image = fh.read()
+        with zipfile.ZipFile(archive, 'w') as zfh:
+            for name in names:
+                zfh.writestr(name, image)
+        response = self.client.post(uri, {
+            'upload_file': SimpleUploadedFile('images.zip', archive.getvalue())
+        })
+        self.assertEqual(response.status_code, 200)
+
+        imp = DocumentImport.objects.get()
+        self.assertEqual(imp.workflow_state, DocumentImport.WORKFLOW_STATE_DONE)
+        # the parts are in the order of the archive
+        parts = self.document.parts.order_by('order')
+        self.assertEqual([part.original_filename for part in parts],
+                         ['test1.png', 'test2.png', 'test3.png'] + names)
+        self.assertEqual(len({part.order for part in parts}), len(parts))
+        # a single report for the whole import
+        self.assertEqual(list(TaskReport.objects.filter(document=self.document)
+                              .values_list('method', flat=True)),
+                         ['imports.tasks.document_import'])
+
+    def test_fanout_report_open(self):
+        uri = reverse('api:document-imports', kwargs={'pk': self.document.pk})
+        archive = BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zfh:
+            zfh.write(os.path.join(os.path.dirname(__file__), 'mocks', 'test.png'), 'a.png')
+        # the chunks of the import are still running when document_import returns
+        with mock.patch.object(DocumentImport, 'fan_out', return_value=True):
+            response = self.client.post(uri, {
+                'upload_file': SimpleUploadedFile('images.zip', archive.getvalue())
+            })
+        self.assertEqual(response.status_code, 200)
+
+        report = TaskReport.objects.get(method='imports.tasks.document_import')
+        self.assertEqual(report.workflow_state, TaskReport.WORKFLOW_STATE_STARTED)
+        self.assertIsNone(report.done_at)
+
     def test_alto_types(self):
         bt = BlockType.objects.create(name="test_block_type")
         lt = LineType.objects.create(name="test_line_type")
@@ -154,7 +224,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_composedblock.alto'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(86):
+            with self.assertNumQueries(55):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -351,7 +421,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_pagexml.zip'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(412):  # there's a lot of lines in there
+            with self.assertNumQueries(45):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -383,7 +453,7 @@ class XmlImportTestCase(CoreFactoryTestCase):
         filename = 'test_pagexml_types.xml'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
         with open(mock_path, 'rb') as fh:
-            with self.assertNumQueries(92):
+            with self.assertNumQueries(56):
                 response = self.client.post(uri, {
                     'upload_file': SimpleUploadedFile(filename, fh.read())
                 })
@@ -411,8 +481,11 @@ class XmlImportTestCase(CoreFactoryTestCase):
     def test_iiif(self):
         filename = 'iiif.json'
         mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
-        with open(mock_path, 'rb') as fh:
-
+        # images are served by a local stand-in
+        filename = 'test.png'
+        with open(os.path.join(os.path.dirname(__file__), 'mocks', filename), 'rb') as fh:
+            image = fh.read()
+        with IIIFStandIn(image) as server:
             imp = DocumentImport(
                 document=self.document,
                 name='test',
@@ -426,29 +499,25 @@ class XmlImportTestCase(CoreFactoryTestCase):
             )
             imp.import_file.save(
                 'iiif_manifest.json',
-                ContentFile(fh.read()))
+                ContentFile(server.manifest(mock_path)))
 
             # we don't go through the form but we want to test json validation
-            fh.seek(0)
-            IIIFManifestParser(self.document, fh, imp.report).validate()
+            with imp.import_file.open('rb') as fh:
+                IIIFManifestParser(self.document, fh, imp.report).validate()
 
             imp.save()
 
-        # mock images grabbing
-        filename = 'test.png'
-        mock_path = os.path.join(os.path.dirname(__file__), 'mocks', filename)
-        with open(mock_path, 'rb') as fh:
-            # mock the image grabbing
-            mock_resp = mock.Mock(content=fh.read(), status_code=200)
-            with mock.patch('requests.get', return_value=mock_resp):
-                for part in imp.process():  # exhaust the generator
-                    pass
+            for part in imp.process():  # exhaust the generator
+                pass
 
         self.assertEqual(imp.workflow_state, imp.WORKFLOW_STATE_DONE)
         self.assertEqual(imp.processed, 5)
+        self.assertEqual(len(server.requests), 5)
 
         # +2 from factory # change 7 by 8 i addedpart 3 manually
         self.assertEqual(self.document.parts.count(), 8)
+        part = self.document.parts.get(original_filename__startswith='0_')
+        self.assertEqual(part.image_file_size, len(image))
 
     def test_cancel(self):
         # Note: not actually testing celery's revoke
@@ -477,9 +546,11 @@ class ImportEndpointTestCase(CoreFactoryTestCase):
         self.client.force_login(self.user)
         mock_iiif = os.path.join(os.path.dirname(__file__), 'mocks', 'iiif.json')
 
-        # Note image grabbing get mocked with the same .json file but it doesn't matter
+        # Note images are served by a local stand-in with the content of the .json file but it doesn't matter
         with open(mock_iiif, 'rb') as fh:
-            mock_resp = mock.Mock(content=fh.read(), status_code=200)
+            content = fh.read()
+        with IIIFStandIn(content) as server:
+            mock_resp = mock.Mock(content=server.manifest(mock_iiif), status_code=200)
             with mock.patch('requests.get', return_value=mock_resp):
                 with mock.patch('imports.parsers.ParserDocument.post_process_image'):
                     uri = reverse('api:import-list', kwargs={'document_pk': self.doc.pk})
@@ -519,19 +590,24 @@ class ImportEndpointTestCase(CoreFactoryTestCase):
                                        status_code=200,
                                        headers={'content-type': 'text/xml'})
         with open(mock_xml, 'rb') as fh:
-            mock_xml_resp = mock.Mock(content=fh.read(),
+            xml = fh.read()
+            mock_xml_resp = mock.Mock(content=xml,
+                                      iter_content=mock.Mock(return_value=[xml]),
                                       status_code=200,
                                       headers={'content-type': 'text/xml'})
         with open(mock_image, 'rb') as fh:
-            mock_img_resp = mock.Mock(content=fh.read(),
+            image = fh.read()
+            mock_img_resp = mock.Mock(content=image,
+                                      iter_content=mock.Mock(return_value=[image]),
                                       status_code=200,
                                       headers={'content-type': 'image/png'})
 
-        with mock.patch('requests.get', side_effect=[mock_mets_resp,
-                                                     mock_img_resp,
-                                                     mock_xml_resp,
-                                                     mock_img_resp,
-                                                     mock_xml_resp]):
+        def mocked_get(uri, **kwargs):
+            # the files of the METS are fetched concurrently
+            return mock_img_resp if uri.endswith('.png') else mock_xml_resp
+
+        with mock.patch('requests.get', return_value=mock_mets_resp), \
+             mock.patch('requests.Session.get', side_effect=mocked_get):
             uri = reverse('api:import-list', kwargs={'document_pk': self.doc.pk})
             resp = self.client.post(uri, {
                 'mode': 'mets',
@@ -562,6 +638,58 @@ class ImportEndpointTestCase(CoreFactoryTestCase):
             self.assertEqual(part1.blocks.first().box, [[0, 0], [850, 0], [850, 1083], [0, 1083]])
             self.assertEqual(part1.lines.count(), 3)
 
+    def test_xml_chunked_upload(self):
+        part1 = self.factory.make_part(name='part 1',
+                                       document=self.doc,
+                                       original_filename='test1.png')
+
+        self.client.force_login(self.user)
+        mock_xml = os.path.join(os.path.dirname(__file__), 'mocks', 'test.zip')
+        with open(mock_xml, 'rb') as fh:
+            content = fh.read()
+        resp = self.client.post(reverse('api:upload-list', kwargs={'document_pk': self.doc.pk}),
+                                {'filename': 'test.zip', 'size': len(content)})
+        self.assertEqual(resp.status_code, 201, resp.content)
+        upload = Upload.objects.get(pk=resp.json()['id'])
+        uri = reverse('api:upload-detail', kwargs={'document_pk': self.doc.pk, 'pk': upload.pk})
+
+        half = len(content) // 2
+        resp = self.client.patch(uri, content[:half], content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertEqual(resp['Upload-Offset'], str(half))
+
+        # a wrong checksum or offset doesn't move the upload forward
+        resp = self.client.patch(uri, content[half:], content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET=str(half),
+                                 HTTP_UPLOAD_CHECKSUM='sha256 ' + base64.b64encode(b'nope').decode())
+        self.assertEqual(resp.status_code, 409)
+        resp = self.client.patch(uri, content[half:], content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET='0')
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self.client.get(uri).json()['offset'], half)
+        # the rejected chunks are not left behind
+        self.assertFalse([name for name in os.listdir(os.path.dirname(upload.staging_path))
+                          if name.startswith('%s.' % upload.pk)])
+
+        checksum = base64.b64encode(hashlib.sha256(content[half:]).digest()).decode()
+        resp = self.client.patch(uri, content[half:], content_type='application/offset+octet-stream',
+                                 HTTP_UPLOAD_OFFSET=str(half),
+                                 HTTP_UPLOAD_CHECKSUM='sha256 ' + checksum)
+        self.assertEqual(resp.status_code, 200, resp.content)
+        self.assertTrue(resp.json()['complete'])
+
+        resp = self.client.post(reverse('api:import-list', kwargs={'document_pk': self.doc.pk}), {
+            'mode': 'xml',
+            'upload': upload.pk
+        })
+        self.assertEqual(resp.status_code, 201, resp.content)
+        self.assertFalse(Upload.objects.exists())
+        self.assertFalse(os.path.exists(upload.staging_path))
+        with DocumentImport.objects.get().import_file.open('rb') as fh:
+            self.assertEqual(fh.read(), content)
+        self.assertEqual(part1.lines.count(), 3)
+
     def test_pdf(self):
         pass
 
@@ -0,0 +1,129 @@
+import json
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock
+
+from django.test import SimpleTestCase
+
+from imports.downloads import Downloader, TokenBucket, retry_after
+from imports.parsers import DownloadError
+
+
+class IIIFStandIn:
+    """
+    A local http server standing in for IIIF image servers in tests.
+
+    Every request is answered with image, except the first `throttle` ones
+    that get a 429 with a Retry-After header of `retry_after` seconds.
+    The requested paths are recorded in self.requests.
+    """
+
+    def __init__(self, image, throttle=0, retry_after=0):
+        self.image = image
+        self.throttle = throttle
+        self.retry_after = retry_after
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stand_in._lock:
+                    stand_in.requests.append(self.path)
+                    throttled = len(stand_in.requests) <= stand_in.throttle
+                if throttled:
+                    self.send_response(429)
+                    self.send_header('Retry-After', str(stand_in.retry_after))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(stand_in.image)))
+                self.end_headers()
+                self.wfile.write(stand_in.image)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def manifest(self, path):
+        """
+        Returns the content of the manifest at path, its images being served by the stand-in.
+        """
+        with open(path) as fh:
+            manifest = json.load(fh)
+        for i, canvas in enumerate(manifest['sequences'][0]['canvases']):
+            for image in canvas['images']:
+                image['resource']['service']['@id'] = '%s/iiif/%d' % (self.base_url, i)
+        return json.dumps(manifest).encode()
+
+
+class TokenBucketTestCase(SimpleTestCase):
+    def test_rate(self):
+        bucket = TokenBucket(50, capacity=1)
+        start = time.monotonic()
+        for i in range(6):
+            bucket.acquire()
+        # the first token is available right away
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_no_limit(self):
+        bucket = TokenBucket(0)
+        start = time.monotonic()
+        for i in range(100):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.05)
+
+    def test_pause(self):
+        bucket = TokenBucket(0)
+        bucket.pause(0.1)
+        start = time.monotonic()
+        bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(Mock(headers={'Retry-After': '3'})), 3)
+        self.assertEqual(retry_after(Mock(headers={})), 1)
+        self.assertEqual(retry_after(Mock(headers={'Retry-After': 'soon'})), 1)
+        self.assertAlmostEqual(retry_after(Mock(headers={'Retry-After': formatdate(time.time() + 30)})), 30, delta=2)
+
+
+class DownloaderTestCase(SimpleTestCase):
+    def test_fetch_all(self):
+        with IIIFStandIn(b'image content', throttle=2) as server:
+            urls = ['%s/iiif/%d/full/full/0/default.jpg' % (server.base_url, i) for i in range(5)]
+            downloader = Downloader(workers=3, host_concurrency=2, host_rate=0)
+            results = list(downloader.fetch_all(urls))
+
+        # the throttled requests are retried
+        self.assertEqual(len(server.requests), 7)
+        self.assertEqual(len(results), 5)
+        for image, error in results:
+            self.assertIsNone(error)
+            with image:
+                self.assertEqual(image.size, len(b'image content'))
+                self.assertEqual(image.read(), b'image content')
+
+    def test_fetch_error(self):
+        with IIIFStandIn(b'image content', throttle=10) as server:
+            downloader = Downloader(workers=1, host_rate=0, retry_limit=2)
+            with self.assertRaises(DownloadError):
+                downloader.fetch(server.base_url + '/iiif/0/full/full/0/default.jpg')
+        self.assertEqual(len(server.requests), 2)
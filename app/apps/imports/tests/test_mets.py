@@ -1,8 +1,10 @@
 import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import Mock, patch
 from zipfile import ZipFile
 
+from django.core.files import File
 from django.test import override_settings
 from lxml import etree, html
 from requests.exceptions import RequestException
@@ -328,7 +330,7 @@ class METSProcessorTestCase(CoreFactoryTestCase):
         ])
         self.assertEqual(mets_page, METSPage(image=None, sources={}, metadata={}))
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("imports.mets.METSProcessor.check_is_image")
     def test_process_single_page_remote_file_not_found(self, mock_check_is_image, mock_get):
         mock_get.side_effect = RequestException("Uhoh, something went wrong.")
@@ -371,10 +373,10 @@ class METSProcessorTestCase(CoreFactoryTestCase):
             "mods/note-about-reproduction": "Present",
         }))
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("imports.mets.METSProcessor.check_is_image")
     def test_process_single_page_remote_file(self, mock_check_is_image, mock_get):
-        mock_get.return_value = Mock(content=b"some content", status_code=200)
+        mock_get.return_value = Mock(content=b"some content", status_code=200, iter_content=Mock(return_value=[b"some content"]))
         mock_check_is_image.side_effect = [(True, "image/png"), (False, "text/xml")]
 
         processor = METSProcessor(self.root, self.report, mets_base_uri="https://whatever.com")
@@ -383,12 +385,12 @@ class METSProcessorTestCase(CoreFactoryTestCase):
         mets_page = processor.process_single_page(pages[0], files)
 
         self.assertEqual(mets_page.image.name, "Kifayat_al-ghulam.pdf_000005.png")
-        self.assertTrue(isinstance(mets_page.image, io.BytesIO))
+        self.assertTrue(isinstance(mets_page.image, File))
         self.assertEqual(mets_page.image.read(), b"some content")
 
         self.assertEqual(list(mets_page.sources.keys()), ["transcript"])
         self.assertEqual(mets_page.sources["transcript"].name, "Kifayat_al-ghulam.pdf_000005.xml")
-        self.assertTrue(isinstance(mets_page.sources["transcript"], io.BytesIO))
+        self.assertTrue(isinstance(mets_page.sources["transcript"], File))
         self.assertEqual(mets_page.sources["transcript"].read(), b"some content")
 
         self.assertDictEqual(mets_page.metadata, {
@@ -466,10 +468,10 @@ class METSProcessorTestCase(CoreFactoryTestCase):
             "mets-header/agent-role-CREATOR-type-ORGANIZATION": "eScriptorium testing",
         })
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("imports.mets.METSProcessor.check_is_image")
     def test_process_remote_file(self, mock_check_is_image, mock_get):
-        mock_get.return_value = Mock(content=b"some content", status_code=200)
+        mock_get.return_value = Mock(content=b"some content", status_code=200, iter_content=Mock(return_value=[b"some content"]))
         mock_check_is_image.side_effect = [(True, "image/png"), (False, "text/xml")] * 4
 
         processor = METSProcessor(self.root, self.report, mets_base_uri="https://whatever.com")
@@ -483,12 +485,12 @@ class METSProcessorTestCase(CoreFactoryTestCase):
         ]
         for index, mets_page in enumerate(mets_pages):
             self.assertEqual(mets_page.image.name, f"{names[index]}.png")
-            self.assertTrue(isinstance(mets_page.image, io.BytesIO))
+            self.assertTrue(isinstance(mets_page.image, File))
             self.assertEqual(mets_page.image.read(), b"some content")
 
             self.assertEqual(list(mets_page.sources.keys()), ["transcript"])
             self.assertEqual(mets_page.sources["transcript"].name, f"{names[index]}.xml")
-            self.assertTrue(isinstance(mets_page.sources["transcript"], io.BytesIO))
+            self.assertTrue(isinstance(mets_page.sources["transcript"], File))
             self.assertEqual(mets_page.sources["transcript"].read(), b"some content")
 
             if not index:
@@ -508,3 +510,30 @@ class METSProcessorTestCase(CoreFactoryTestCase):
             "mets-header/status": "Validated",
             "mets-header/agent-role-CREATOR-type-ORGANIZATION": "eScriptorium testing",
         })
+
+    def test_prefetch_window(self):
+        processor = METSProcessor(self.root, self.report, mets_base_uri="https://whatever.com")
+        files = processor.get_files_from_file_sec()
+        pages = processor.get_pages_from_struct_map()
+        uris = list(processor.remote_uris(pages, files))
+        self.assertEqual(len(uris), 8)
+
+        with patch.object(METSProcessor, "fetch_remote_file", side_effect=lambda uri: (uri, None)) as fetch:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                processor.prefetch(executor, pages, files, window=3)
+                self.assertEqual([uri for uri, future in processor.prefetched], uris[:3])
+
+                # using a file submits the next one
+                self.assertEqual(processor.get_remote_file(uris[0]), (uris[0], None))
+                self.assertEqual([uri for uri, future in processor.prefetched], uris[1:4])
+
+                # the files skipped over are dropped
+                self.assertEqual(processor.get_remote_file(uris[2]), (uris[2], None))
+                self.assertEqual([uri for uri, future in processor.prefetched], uris[3:5])
+
+                processor.discard_prefetched()
+                self.assertFalse(processor.prefetched)
+                # not prefetched
+                self.assertEqual(processor.get_remote_file(uris[7]), (uris[7], None))
+
+        self.assertEqual([call.args[0] for call in fetch.call_args_list], uris[:5] + [uris[7]])
@@ -1,20 +1,34 @@
 import os
+from io import BytesIO
 from unittest.mock import Mock, patch
 from zipfile import ZipFile
 
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import override_settings
 from lxml import etree
+from PIL import Image
 from requests.exceptions import RequestException
 
 from core.models import (
     Block,
     DocumentMetadata,
+    DocumentPart,
     DocumentPartMetadata,
     Line,
     LineTranscription,
     Metadata,
 )
 from core.tests.factory import CoreFactoryTestCase
-from imports.parsers import METSRemoteParser, METSZipParser, ParseError
+from imports.models import DocumentImport
+from imports.parsers import (
+    METSRemoteParser,
+    METSZipParser,
+    ParseError,
+    PdfParser,
+    ZipParser,
+    make_parser,
+    read_xml_header,
+)
 from reporting.models import TaskReport
 
 SAMPLES_DIR = os.path.join(
@@ -22,15 +36,21 @@ SAMPLES_DIR = os.path.join(
     "samples",
 )
 
+MOCKS_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    "mocks",
+)
+
 PFX = "{http://www.loc.gov/METS/}"
 
 
-def mocked_get(uri):
+def mocked_get(uri, **kwargs):
     with ZipFile(SAMPLES_DIR + "/complex_archive.zip") as archive:
         filename = os.path.basename(uri)
         try:
             with archive.open(filename) as file:
-                return Mock(content=file.read(), status_code=200)
+                content = file.read()
+                return Mock(content=content, status_code=200, iter_content=Mock(return_value=[content]))
         except Exception:
             raise RequestException("Uhoh, something went wrong.")
 
@@ -70,7 +90,7 @@ class METSRemoteParserTestCase(CoreFactoryTestCase):
 
         self.assertTrue("An error occurred during the processing of the remote METS file: Uhoh, something went wrong." in str(context.exception))
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("imports.mets.METSProcessor.check_is_image")
     def test_parse_mets_with_one_source(self, mock_check_is_image, mock_get):
         mock_get.side_effect = mocked_get
@@ -102,7 +122,7 @@ class METSRemoteParserTestCase(CoreFactoryTestCase):
         self.assertEqual(Line.objects.count(), 66)
         self.assertEqual(LineTranscription.objects.count(), 65)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("imports.mets.METSProcessor.check_is_image")
     def test_parse_mets_with_tags_prefixed_by_namespace(self, mock_check_is_image, mock_get):
         mock_get.side_effect = mocked_get
@@ -128,7 +148,7 @@ class METSRemoteParserTestCase(CoreFactoryTestCase):
         self.assertEqual(Line.objects.count(), 66)
         self.assertEqual(LineTranscription.objects.count(), 65)
 
-    @patch("requests.get")
+    @patch("requests.Session.get")
     @patch("imports.mets.METSProcessor.check_is_image")
     def test_parse_mets_with_multiple_sources(self, mock_check_is_image, mock_get):
         mock_get.side_effect = mocked_get
@@ -262,3 +282,223 @@ class METSZipParserTestCase(CoreFactoryTestCase):
         self.assertEqual(Block.objects.count(), 17)
         self.assertEqual(Line.objects.count(), 66)
         self.assertEqual(LineTranscription.objects.count(), 129)
+
+
+class XMLStreamingTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.factory.make_document()
+        self.part = self.factory.make_part(document=self.document, original_filename="test1.png")
+        self.report = TaskReport.objects.create(
+            user=self.document.owner,
+            label="XML import",
+            document=self.document,
+            method="imports.tasks.document_import",
+        )
+
+    def test_read_xml_header(self):
+        with open(os.path.join(MOCKS_DIR, "test_pagexml_types.xml"), "rb") as fh:
+            root = read_xml_header(fh)
+            # the file is rewound for the next reader
+            self.assertEqual(fh.tell(), 0)
+        self.assertEqual(etree.QName(root).localname, "PcGts")
+        self.assertEqual(root.find("Metadata/Creator", root.nsmap).text[:4], "prov")
+        self.assertTrue(root.xpath(
+            "//*/@xsi:schemaLocation",
+            namespaces={"xsi": "http://www.w3.org/2001/XMLSchema-instance"}))
+
+    @override_settings(XML_STREAMING_MIN_SIZE=0)
+    def test_pagexml_streaming(self):
+        with open(os.path.join(MOCKS_DIR, "test_pagexml_types.xml"), "rb") as fh:
+            parser = make_parser(self.document, fh, report=self.report)
+            self.assertTrue(parser.streaming)
+            self.assertEqual(parser.total, 1)
+            self.assertEqual(list(parser.parse()), [self.part])
+
+        self.assertEqual(self.part.blocks.count(), 4)
+        self.assertEqual(self.part.lines.count(), 3)
+        self.assertEqual(self.part.lines.all()[2].typology.name, "new_line_type")
+        self.assertEqual(LineTranscription.objects.filter(line__document_part=self.part).count(), 3)
+
+    def test_duplicate_typologies(self):
+        # left behind by chunks of an import that created the same type at the same time
+        self.document.valid_line_types.create(name="new_line_type")
+        self.document.valid_line_types.create(name="new_line_type")
+        with open(os.path.join(MOCKS_DIR, "test_pagexml_types.xml"), "rb") as fh:
+            parser = make_parser(self.document, fh, report=self.report)
+            self.assertEqual(list(parser.parse()), [self.part])
+        self.assertEqual(self.part.lines.all()[2].typology.name, "new_line_type")
+        self.assertEqual(self.document.valid_line_types.filter(name="new_line_type").count(), 2)
+
+    def test_parsed_once(self):
+        with open(os.path.join(MOCKS_DIR, "test_pagexml_types.xml"), "rb") as fh:
+            with patch.object(etree, "parse", wraps=etree.parse) as parse_mock:
+                with patch("imports.parsers.read_xml_header") as header_mock:
+                    parser = make_parser(self.document, fh, report=self.report)
+        self.assertFalse(parser.streaming)
+        # the format is detected from the whole tree that is then handed to the parser
+        self.assertEqual(parse_mock.call_count, 1)
+        header_mock.assert_not_called()
+        self.assertEqual(parser.total, 1)
+
+    @override_settings(XML_STREAMING_MIN_SIZE=0)
+    def test_streaming_total(self):
+        with open(os.path.join(MOCKS_DIR, "test_pagexml_types.xml"), "rb") as fh:
+            # validated with the bundled schema
+            content = fh.read().replace(b"2013-07-15", b"2019-07-15")
+        fh = BytesIO(content)
+        fh.name = "test_pagexml_types.xml"
+        parser = make_parser(self.document, fh, report=self.report)
+        parser.validate()
+        # the pages are counted while validating the file
+        with patch("imports.parsers.iterparse_elements") as iterparse_mock:
+            self.assertEqual(parser.total, 1)
+        iterparse_mock.assert_not_called()
+
+    def test_archive_member_size(self):
+        archive = BytesIO()
+        with open(os.path.join(MOCKS_DIR, "test_single.alto"), "rb") as fh:
+            with ZipFile(archive, "w") as zfh:
+                zfh.writestr("test_single.alto", fh.read())
+        with ZipFile(archive) as zfh:
+            info = zfh.getinfo("test_single.alto")
+            with zfh.open(info) as member:
+                # seeking to the end of a zipped file would decompress it
+                with patch("imports.parsers.get_file_size") as size_mock:
+                    parser = make_parser(self.document, member, report=self.report, file_size=info.file_size)
+        size_mock.assert_not_called()
+        self.assertFalse(parser.streaming)
+
+    @override_settings(XML_STREAMING_MIN_SIZE=0)
+    def test_alto_streaming(self):
+        with open(os.path.join(MOCKS_DIR, "test_composedblock.alto"), "rb") as fh:
+            parser = make_parser(self.document, fh, report=self.report)
+            self.assertTrue(parser.streaming)
+            self.assertEqual(list(parser.parse()), [self.part])
+
+        self.assertEqual(self.part.blocks.count(), 3)
+        # the tags are found in the header
+        self.assertEqual(self.part.blocks.all()[1].typology.name, "test_block_type")
+        self.assertEqual(self.part.lines.all()[2].typology.name, "new_line_type")
+
+
+# the images stay in the folder of the document
+@override_settings(IMAGE_DEDUPLICATION=False)
+class ZipParserTestCase(CoreFactoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = self.factory.make_user()
+        self.document = self.factory.make_document(owner=self.user)
+        self.part = self.factory.make_part(document=self.document, original_filename="page1.png")
+        self.report = TaskReport.objects.create(
+            user=self.user,
+            label="Zip import",
+            document=self.document,
+            method="imports.tasks.document_import",
+        )
+        self.image = self.factory.make_image_file().read()
+        archive = BytesIO()
+        with ZipFile(archive, "w") as zfh:
+            zfh.writestr("images/page1.png", self.image)
+            zfh.writestr("images/page2.png", self.image)
+            zfh.writestr("README", "not imported")
+        self.imp = DocumentImport.objects.create(
+            document=self.document,
+            started_by=self.user,
+            import_file=SimpleUploadedFile("test.zip", archive.getvalue()),
+        )
+
+    def tearDown(self):
+        # the parts created by the import, the others are cleaned up by the factory
+        for part in DocumentPart.objects.filter(document=self.document).exclude(pk=self.part.pk):
+            part.delete()
+        self.imp.import_file.delete()
+        super().tearDown()
+
+    def check_images(self):
+        self.assertEqual(self.document.parts.count(), 2)
+        # the existing part is updated
+        self.part.refresh_from_db()
+        self.assertEqual(self.part.source, "zip//test.zip/page1.png")
+        self.assertEqual(self.part.image_file_size, len(self.image))
+        new_part = self.document.parts.get(original_filename="page2.png")
+        self.assertTrue(new_part.image.name.startswith("documents/%d/page2" % self.document.pk))
+        with new_part.image.open("rb") as fh:
+            self.assertEqual(fh.read(), self.image)
+
+    @override_settings(ZIP_IMPORT_WORKERS=2)
+    def test_parse_images(self):
+        parser = ZipParser(self.document, self.imp.import_file, self.report)
+        list(parser.parse(user=self.user))
+        self.check_images()
+
+    @override_settings(ZIP_IMPORT_WORKERS=1)
+    def test_parse_images_sequential(self):
+        parser = ZipParser(self.document, self.imp.import_file, self.report)
+        list(parser.parse(user=self.user))
+        self.check_images()
+
+
+class PdfParserTestCase(CoreFactoryTestCase):
+    # rendered at the resolution they are saved with
+    SIZES = [(75, 50), (100, 125), (50, 150)]
+
+    def setUp(self):
+        super().setUp()
+        self.user = self.factory.make_user()
+        self.document = self.factory.make_document(owner=self.user)
+        self.report = TaskReport.objects.create(
+            user=self.user,
+            label="Pdf import",
+            document=self.document,
+            method="imports.tasks.document_import",
+        )
+        pages = [Image.new("RGB", size, color=(155, 0, 0)) for size in self.SIZES]
+        pdf = BytesIO()
+        pages[0].save(pdf, "PDF", resolution=300, save_all=True, append_images=pages[1:])
+        self.imp = DocumentImport.objects.create(
+            document=self.document,
+            started_by=self.user,
+            import_file=SimpleUploadedFile("test.pdf", pdf.getvalue()),
+        )
+
+    def tearDown(self):
+        for part in DocumentPart.objects.filter(document=self.document):
+            part.delete()
+        self.imp.import_file.delete()
+        super().tearDown()
+
+    def page_files(self, part):
+        directory = os.path.dirname(part.image.path)
+        return sorted(f for f in os.listdir(directory) if f.startswith("test.pdf_page_"))
+
+    @override_settings(PDF_IMPORT_WORKERS=2)
+    def test_parse_parallel(self):
+        parser = PdfParser(self.document, self.imp.import_file, self.report)
+        parts = list(parser.parse(user=self.user))
+
+        names = ["test.pdf_page_%d.png" % i for i in range(1, 4)]
+        self.assertEqual([part.original_filename for part in parts], names)
+        self.assertEqual(list(self.document.parts.values_list("original_filename", flat=True)), names)
+        for part, size in zip(parts, self.SIZES):
+            self.assertEqual(part.source, "pdf//test.pdf")
+            self.assertEqual(part.image_file_size, os.path.getsize(part.image.path))
+            with Image.open(part.image.path) as im:
+                self.assertEqual(im.size, size)
+
+    @override_settings(PDF_IMPORT_WORKERS=2)
+    def test_parse_parallel_closed(self):
+        parser = PdfParser(self.document, self.imp.import_file, self.report)
+        pages = parser.parse(user=self.user)
+        part = next(pages)
+        # the next pages are rendered in advance
+        pages.close()
+
+        self.assertEqual(self.document.parts.count(), 1)
+        self.assertEqual([f for f in self.page_files(part) if not f.startswith("test.pdf_page_1")], [])
+
+    @override_settings(PDF_IMPORT_WORKERS=2)
+    def test_parse_parallel_resume(self):
+        parser = PdfParser(self.document, self.imp.import_file, self.report)
+        parts = list(parser.parse(start_at=2, user=self.user))
+        self.assertEqual([part.original_filename for part in parts], ["test.pdf_page_3.png"])
@@ -0,0 +1,92 @@
+import os
+from unittest.mock import Mock, patch
+
+import requests
+from django.test import SimpleTestCase, override_settings
+from lxml import etree
+
+from imports.schemas import (
+    ESCRIPTORIUM_ALTO,
+    SchemaCache,
+    SchemaUnavailable,
+    local_schema_path,
+)
+
+MOCKS_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "mocks")
+
+ALTO_4_0 = "http://www.loc.gov/standards/alto/v4/alto-4-0.xsd"
+PAGE_2019 = "http://schema.primaresearch.org/PAGE/gts/pagecontent/2019-07-15/pagecontent.xsd"
+
+REMOTE_XSD = b"""<?xml version="1.0" encoding="UTF-8"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">
+  <xs:element name="root" type="xs:string"/>
+</xs:schema>"""
+
+
+class SchemaCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = SchemaCache()
+
+    @patch("imports.schemas.requests.get")
+    def test_bundled(self, get_mock):
+        schema = self.cache.get(ESCRIPTORIUM_ALTO)
+        # compiled once
+        self.assertIs(self.cache.get(ESCRIPTORIUM_ALTO), schema)
+        self.assertIsNotNone(self.cache.get(PAGE_2019))
+        # imports (xlink) are resolved locally too
+        get_mock.assert_not_called()
+
+        root = etree.parse(os.path.join(MOCKS_DIR, "test_single_baselines.alto"))
+        self.assertTrue(schema.validate(root))
+
+        # ALTO 4.x are all validated with the bundled 4.4
+        alto = self.cache.get(ALTO_4_0)
+        get_mock.assert_not_called()
+        root = etree.parse(os.path.join(MOCKS_DIR, "test_single.alto"))
+        self.assertTrue(alto.validate(root))
+
+    def test_local_schema_path(self):
+        self.assertTrue(local_schema_path(PAGE_2019).endswith("pagecontent.xsd"))
+        self.assertIsNone(local_schema_path("http://www.loc.gov/standards/../../../etc/passwd"))
+        self.assertIsNone(local_schema_path("http://example.com/unknown.xsd"))
+
+    @override_settings(XML_SCHEMAS_REMOTE_TTL=60)
+    @patch("imports.schemas.time.monotonic")
+    @patch("imports.schemas.requests.get")
+    def test_remote_ttl(self, get_mock, monotonic_mock):
+        get_mock.return_value = Mock(content=REMOTE_XSD)
+        monotonic_mock.return_value = 1000
+        schema = self.cache.get("http://example.com/remote.xsd")
+        self.assertIs(self.cache.get("http://example.com/remote.xsd"), schema)
+        self.assertEqual(get_mock.call_count, 1)
+
+        # expired
+        monotonic_mock.return_value = 1061
+        self.cache.get("http://example.com/remote.xsd")
+        self.assertEqual(get_mock.call_count, 2)
+
+    @override_settings(XML_SCHEMAS_REMOTE_TTL=60)
+    @patch("imports.schemas.time.monotonic")
+    @patch("imports.schemas.requests.get")
+    def test_remote_failure_ttl(self, get_mock, monotonic_mock):
+        get_mock.side_effect = requests.exceptions.ConnectTimeout
+        monotonic_mock.return_value = 1000
+        for i in range(3):
+            with self.assertRaises(requests.exceptions.ConnectTimeout):
+                self.cache.get("http://example.com/remote.xsd")
+        # not retried for every file
+        self.assertEqual(get_mock.call_count, 1)
+
+        monotonic_mock.return_value = 1061
+        get_mock.side_effect = None
+        get_mock.return_value = Mock(content=REMOTE_XSD)
+        self.assertIsNotNone(self.cache.get("http://example.com/remote.xsd"))
+        self.assertEqual(get_mock.call_count, 2)
+
+    @override_settings(XML_SCHEMAS_REMOTE_TTL=0)
+    @patch("imports.schemas.requests.get")
+    def test_remote_disabled(self, get_mock):
+        with self.assertRaises(SchemaUnavailable):
+            self.cache.get("http://example.com/remote.xsd")
+        get_mock.assert_not_called()
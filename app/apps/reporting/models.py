@@ -73,7 +73,7 @@ class TaskReport(models.Model):
         self.started_at = datetime.now(timezone.utc)
         self.save()
 
-    def cancel(self, username):
+    def cancel(self, username, revoke=True):
         self.workflow_state = self.WORKFLOW_STATE_CANCELED
         self.done_at = datetime.now(timezone.utc)
 
@@ -82,7 +82,9 @@ class TaskReport(models.Model):
             canceled_by = f"user {username}"
         self.append(f"Canceled by {canceled_by}")
 
-        app.control.revoke(self.task_id, terminate=True)
+        # a task processing several parts has a report per part, it skips the canceled ones
+        if revoke:
+            app.control.revoke(self.task_id, terminate=True)
         self.save()
 
     def error(self, message):
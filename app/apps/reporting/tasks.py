@@ -146,6 +146,10 @@ def end_task_reporting(task_id, task, *args, **kwargs):
     # or canceled by the Document.cancel_tasks API endpoint
     from reporting.models import TASK_FINAL_STATES
 
+    if kwargs.get("state") == states.SUCCESS and getattr(task.request, 'keep_report_open', False):
+        # the task handed its work over to other tasks, the last one of them ends the report
+        return
+
     if report.workflow_state not in TASK_FINAL_STATES:
         if kwargs.get("state") == states.SUCCESS:
             report.end()
@@ -249,8 +249,15 @@ REPORTING_TASKS_BLACKLIST = [
     # if the user still has disk space but no cpu quota it will just slow everything down
     # to forbid thumbnails creation or image compression.
     'core.tasks.convert',
+    'core.tasks.ingest',
     'core.tasks.lossless_compression',
-    'core.tasks.generate_part_thumbnails'
+    'core.tasks.generate_part_thumbnails',
+    # the parts of a batch have their own reports, cf Document.queue_batch
+    'core.tasks.document_pipeline',
+    'core.tasks.document_binarize',
+    # the chunks of an import split across workers write to the report of the import
+    'imports.tasks.document_import_chunk',
+    'imports.tasks.document_import_done',
 ]
 
 CHANNEL_LAYERS = {
@@ -389,6 +396,12 @@ THUMBNAIL_ALIASES = {
 #     'jpeg': '/usr/bin/jpegoptim -S200 {filename}'
 # }
 
+# generate tiles of the part images at all zoom levels during ingest, for the editor to load only the viewport
+IMAGE_PYRAMIDS = os.getenv('IMAGE_PYRAMIDS', "False").lower() not in ("false", "0")
+IMAGE_PYRAMID_TILE_SIZE = int(os.getenv('IMAGE_PYRAMID_TILE_SIZE', 256))
+# identical images share a single master, its thumbnails and tiles, in MEDIA_ROOT/images
+IMAGE_DEDUPLICATION = os.getenv('IMAGE_DEDUPLICATION', "False").lower() not in ("false", "0")
+
 
 ENABLE_COOKIE_CONSENT = os.getenv('ENABLE_COOKIE_CONSENT', True)
 
@@ -401,6 +414,73 @@ IIIF_IMPORT_QUALITY = 'full'
 
 KRAKEN_TRAINING_DEVICE = os.getenv('KRAKEN_TRAINING_DEVICE', 'cpu')
 KRAKEN_TRAINING_LOAD_THREADS = int(os.getenv('KRAKEN_TRAINING_LOAD_THREADS', 0))
+# Number of lines sent to the recognizer at once, 0 means the whole page
+KRAKEN_RECOGNITION_BATCH_SIZE = int(os.getenv('KRAKEN_RECOGNITION_BATCH_SIZE', 0))
+
+# Per worker process cache of loaded kraken models
+# maximum number of models kept in memory
+KRAKEN_MODEL_CACHE_MAX_COUNT = int(os.getenv('KRAKEN_MODEL_CACHE_MAX_COUNT', 4))
+# maximum cumulated size of the cached model files, in Mb
+KRAKEN_MODEL_CACHE_MAX_SIZE = int(os.getenv('KRAKEN_MODEL_CACHE_MAX_SIZE', 512))
+# load the default segmentation model when a worker process boots
+KRAKEN_MODEL_CACHE_PRELOAD = os.getenv('KRAKEN_MODEL_CACHE_PRELOAD', "True").lower() not in ("false", "0")
+
+# Number of images segmented or transcribed by a single document_pipeline task,
+# 0 falls back to one tasks chain per image
+INFERENCE_PIPELINE_CHUNK_SIZE = int(os.getenv('INFERENCE_PIPELINE_CHUNK_SIZE', 10))
+# Number of images decoded in advance by the pipeline
+INFERENCE_PIPELINE_PREFETCH = int(os.getenv('INFERENCE_PIPELINE_PREFETCH', 2))
+
+# Number of processes computing the lines masks of a page,
+# only used for pages with at least MASKS_PARALLEL_MIN_LINES lines to compute
+MASKS_WORKERS = int(os.getenv('MASKS_WORKERS', 4))
+MASKS_PARALLEL_MIN_LINES = int(os.getenv('MASKS_PARALLEL_MIN_LINES', 50))
+# Number of processes binarizing the pages of a document with the streaming (libvips) binarizer
+BINARIZATION_WORKERS = int(os.getenv('BINARIZATION_WORKERS', 4))
+# Masks recalculations of a part requested within this delay (in seconds) are merged in a single task (0 disables it),
+# but a request is never delayed more than MASKS_COALESCE_MAX_DELAY seconds
+MASKS_COALESCE_WINDOW = float(os.getenv('MASKS_COALESCE_WINDOW', 1))
+MASKS_COALESCE_MAX_DELAY = float(os.getenv('MASKS_COALESCE_MAX_DELAY', 5))
+
+# Cache of decoded page images used by segmentation, transcription and masks computation
+# maximum size of the in memory cache of each worker process, in Mb (0 disables it),
+# a few pages, every process computing masks or running the pipeline holds its own
+PAGE_IMAGE_CACHE_MAX_SIZE = int(os.getenv('PAGE_IMAGE_CACHE_MAX_SIZE', 128))
+# directory of the memory mapped rasters shared by all processes of a host, and its maximum size in Mb,
+# disabled unless a directory is given
+PAGE_IMAGE_CACHE_DIR = os.getenv('PAGE_IMAGE_CACHE_DIR') or None
+PAGE_IMAGE_CACHE_DISK_SIZE = int(os.getenv('PAGE_IMAGE_CACHE_DISK_SIZE', 1024))
+# Regions of the part images rendered by the IIIF image endpoint, shared by all processes of a host, size in Mb (0 disables it)
+IIIF_IMAGE_CACHE_DIR = os.getenv('IIIF_IMAGE_CACHE_DIR', '/tmp/escriptorium-iiif')
+IIIF_IMAGE_CACHE_DISK_SIZE = int(os.getenv('IIIF_IMAGE_CACHE_DISK_SIZE', 1024))
+
+# ALTO and PAGE files bigger than this (in Mb) are imported page by page instead of being loaded at once
+XML_STREAMING_MIN_SIZE = int(os.getenv('XML_STREAMING_MIN_SIZE', 50))
+# Directory of local copies of the XML schemas used to validate imports, laid out like their urls
+# (ie <dir>/www.loc.gov/standards/alto/v4/alto-4-2.xsd), they complete the bundled ones
+XML_SCHEMAS_DIR = os.getenv('XML_SCHEMAS_DIR', None)
+# Downloaded schemas are kept this number of seconds by each process, 0 disables the downloads
+XML_SCHEMAS_REMOTE_TTL = int(os.getenv('XML_SCHEMAS_REMOTE_TTL', 86400))
+
+# Number of processes rasterizing the pages of an imported pdf file, 1 renders them one by one in the import task
+PDF_IMPORT_WORKERS = int(os.getenv('PDF_IMPORT_WORKERS', 4))
+# Number of threads extracting the members of an imported zip file, 1 extracts them one by one in the import task
+ZIP_IMPORT_WORKERS = int(os.getenv('ZIP_IMPORT_WORKERS', 4))
+# Number of threads downloading the images of a IIIF manifest, each server is sent
+# at most IIIF_IMPORT_HOST_CONCURRENCY requests at once and IIIF_IMPORT_HOST_RATE per second (0 for no limit)
+IIIF_IMPORT_WORKERS = int(os.getenv('IIIF_IMPORT_WORKERS', 8))
+IIIF_IMPORT_HOST_CONCURRENCY = int(os.getenv('IIIF_IMPORT_HOST_CONCURRENCY', 4))
+IIIF_IMPORT_HOST_RATE = float(os.getenv('IIIF_IMPORT_HOST_RATE', 5))
+# Number of threads fetching the remote files of a METS import, 1 fetches them one by one
+METS_IMPORT_WORKERS = int(os.getenv('METS_IMPORT_WORKERS', 8))
+# archives holding at least this many files are imported in chunks spread across workers, 0 disables it
+IMPORT_FANOUT_MIN_FILES = int(os.getenv('IMPORT_FANOUT_MIN_FILES', 50))
+IMPORT_FANOUT_CHUNK_SIZE = int(os.getenv('IMPORT_FANOUT_CHUNK_SIZE', 10))
+# resumable uploads, their size in bytes is unlimited with 0
+UPLOAD_STAGING_DIR = os.getenv('UPLOAD_STAGING_DIR', os.path.join(MEDIA_ROOT, 'upload_staging'))
+UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', 0))
+# uploads without a new chunk for this long are removed by the cleanup_uploads command
+UPLOAD_EXPIRATION_HOURS = int(os.getenv('UPLOAD_EXPIRATION_HOURS', 48))
 
 REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
@@ -1054,9 +1054,9 @@ const actions = {
         }
     },
     /**
-     * Update a part's workflow status.
+     * Update a part's workflow status, and its thumbnail once generated.
      */
-    updatePartTaskStatus({ commit, state }, { id, process, status }) {
+    updatePartTaskStatus({ commit, state }, { id, process, status, data }) {
         if (id) {
             const part = structuredClone(
                 state.parts.find((p) => p.pk.toString() === id.toString()),
@@ -1064,6 +1064,9 @@ const actions = {
             if (part) {
                 part.workflow[process] =
                     status === "canceled" ? "error" : status;
+                if (process === "generate_part_thumbnails" && data?.card) {
+                    part.thumbnail = data.card;
+                }
                 commit("updatePart", part);
             }
         }